@@ -0,0 +1,63 @@
+"""
+单个采样点从解析到BSON的开销对比：pydantic校验+model_dump vs __slots__记录
+运行：cd src && python -m bench.bench_sample_record
+"""
+import argparse
+import time
+
+import bson
+from bson import ObjectId
+
+from server.timedTask.model import TimedTaskDevCPUAndMEMModel, parse_vmstat_sample
+
+RECV = "5452595 3352595 2152595 52595 10 10 70 10 10 1 2"
+
+
+def by_model(timed_task_id, task_id):
+    swpd_mem, free_mem, buff_mem, cache_mem, bi_io, bo_io, us_cpu, sy_cpu, id_cpu, wa_cpu, st_cpu = RECV.split()
+    return TimedTaskDevCPUAndMEMModel(
+        taskID=task_id,
+        timedTaskID=timed_task_id,
+        swpdMem=float(swpd_mem),
+        freeMem=float(free_mem),
+        buffMem=float(buff_mem),
+        cacheMem=float(cache_mem),
+        biIo=float(bi_io),
+        boIo=float(bo_io),
+        usCpu=float(us_cpu) / 100,
+        syCpu=float(sy_cpu) / 100,
+        idCpu=float(id_cpu) / 100,
+        waCpu=float(wa_cpu) / 100,
+        stCpu=float(st_cpu) / 100
+    ).model_dump(by_alias=True)
+
+
+def by_record(timed_task_id, task_id):
+    return parse_vmstat_sample(RECV, timed_task_id, task_id).to_document()
+
+
+def run(func, count: int, batch: int) -> dict:
+    timed_task_id, task_id = ObjectId(), "TimedTask_bench"
+    start = time.perf_counter()
+    for _ in range(count // batch):
+        docs = [func(timed_task_id, task_id) for _ in range(batch)]
+        # insert_many时的BSON编码
+        for doc in docs:
+            bson.encode(doc)
+    cost = time.perf_counter() - start
+    return {"name": func.__name__, "count": count, "usPerSample": cost / count * 1e6, "samplesPerSecond": count / cost}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=100000)
+    parser.add_argument("--batch", type=int, default=1000)
+    args = parser.parse_args()
+    results = [run(func, args.count, args.batch) for func in (by_model, by_record)]
+    for result in results:
+        print(f"{result['name']:<10} {result['usPerSample']:8.2f} us/sample {result['samplesPerSecond']:12.0f} samples/s")
+    print(f"speedup: {results[0]['usPerSample'] / results[1]['usPerSample']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,316 @@
+"""
+生成测试用的历史数据：定时任务、执行记录、设备运行状况采样
+- 每个任务的采样数服从对数正态分布，少数任务数据量很大；--big-tasks可以额外生成指定采样数的任务
+- cpu有日周期变化，一部分任务空闲内存缓慢下降（内存泄漏），按--miss-rate错过执行、--error-rate执行出错
+- 生成的任务状态都是已结束的（完成、停止、删除），不会被调度器加载
+- 多进程并行生成，每个进程内多个insert_many同时进行
+运行：cd src && python -m bench.generate_history --tasks 10000 --samples 10000000 --workers 4
+"""
+import argparse
+import asyncio
+import math
+import multiprocessing
+import time
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+import numpy as np
+from bson import ObjectId
+from motor.core import AgnosticCollection
+
+from config import Config
+from server.timedTask.model import TaskStatus, TimedTaskKind, DEV_CPU_MEM_COLUMNS
+from server.timedTask.sample_storage import BUCKET_COLLECT, SAMPLE_COLLECT, build_bucket_documents
+from utils.mongo_client import AsyncMongoClient
+
+TASK_COLLECT = "timed_task_collect"
+RECORD_COLLECT = "timed_task_record_collect"
+
+INTERVALS = (5, 10, 30, 60)
+RUN_RESULT = "定时任务执行！"
+MISSED_RESULT = "定时任务错过了执行时间！"
+ERROR_RESULT = "执行出错了！ssh连接断开"
+
+# (任务序号, 采样数)
+TaskSpec = Tuple[int, int]
+
+
+def plan_tasks(tasks: int, samples: int, big_tasks: List[int], seed: int) -> List[TaskSpec]:
+    rng = np.random.default_rng(seed)
+    specs = []
+    if tasks:
+        weights = rng.lognormal(0, 1.5, tasks)
+        counts = np.floor(weights / weights.sum() * samples).astype(np.int64)
+        # 取整丢掉的部分随机补上，保证总数正好是samples
+        np.add.at(counts, rng.integers(0, tasks, samples - int(counts.sum())), 1)
+        specs = [(index, int(count)) for index, count in enumerate(counts)]
+    specs.extend((tasks + index, count) for index, count in enumerate(big_tasks))
+    return specs
+
+
+def _shard(specs: List[TaskSpec], workers: int) -> List[List[TaskSpec]]:
+    """按采样数从大到小轮流分配，各个进程的数据量差不多"""
+    shards = [[] for _ in range(workers)]
+    loads = [0] * workers
+    for spec in sorted(specs, key=lambda x: -x[1]):
+        index = loads.index(min(loads))
+        shards[index].append(spec)
+        loads[index] += spec[1]
+    return shards
+
+
+class _TaskData:
+    """一个任务的所有采样、记录，用numpy按列生成"""
+
+    def __init__(self, rng: np.random.Generator, index: int, samples: int, args: argparse.Namespace, now: datetime):
+        self.index = index
+        self.timed_task_id = ObjectId()
+        self.task_id = f"TimedTask_history_{index}_{TimedTaskKind.CPU_MEM_RECORD}"
+        self.task_name = f"历史数据{index:07d}"
+        self.interval = int(rng.choice(INTERVALS))
+        # 多生成一些执行次数，保证执行成功的次数够samples个，多出来的截掉
+        fail_rate = args.miss_rate + args.error_rate
+        runs = int(math.ceil(samples / (1 - fail_rate) + 5 * math.sqrt(samples * fail_rate) + 10))
+        outcome = rng.random(runs)
+        missed = outcome < args.miss_rate
+        error = (outcome >= args.miss_rate) & (outcome < fail_rate)
+        executed_index = np.flatnonzero(~(missed | error))[:samples]
+        runs = int(executed_index[-1]) + 1 if samples else 0
+        self.missed, self.error = missed[:runs], error[:runs]
+        self.samples = samples
+
+        end = now - timedelta(seconds=float(rng.uniform(0, args.days * 86400)))
+        self.start = end - timedelta(seconds=runs * self.interval)
+        self.end = end
+        offsets = np.arange(runs, dtype=np.float64) * self.interval + rng.uniform(0, 0.5, runs)
+        self.sample_offsets = offsets[executed_index]
+
+        start_us = np.datetime64(self.start, "us")
+        self.run_times = (start_us + (offsets * 1e6).astype("timedelta64[us]")).tolist()
+        self.sample_times = [self.run_times[i] for i in executed_index.tolist()]
+        self.columns = self._columns(rng, args)
+
+    def _columns(self, rng: np.random.Generator, args: argparse.Namespace) -> dict:
+        n = self.samples
+        hours = np.array([t.hour + t.minute / 60 for t in self.sample_times]) if n else np.zeros(0)
+        # cpu：基线 + 白天高晚上低的日周期 + 噪声 + 偶尔的尖峰
+        base = rng.uniform(5, 50)
+        amplitude = rng.uniform(0, base * 0.8)
+        cpu = base + amplitude * np.sin((hours - 8) / 24 * 2 * np.pi) + rng.normal(0, 4, n)
+        cpu += np.where(rng.random(n) < 0.005, rng.uniform(20, 60, n), 0)
+        cpu = np.clip(cpu, 0, 100)
+        us, sy = cpu * 0.7, cpu * 0.25
+        wa = np.minimum(cpu * 0.05 + np.abs(rng.normal(0, 0.5, n)), 100 - cpu)
+        st = np.zeros(n)
+        idle = np.clip(100 - us - sy - wa - st, 0, 100)
+
+        total_mem = float(rng.choice((1, 2, 4, 8))) * 1024 * 1024
+        hours_elapsed = self.sample_offsets / 3600
+        leak = rng.uniform(20, 200) * 1024 if rng.random() < args.leak_rate else 0.0
+        free = total_mem * rng.uniform(0.3, 0.7) - leak * hours_elapsed + rng.normal(0, total_mem * 0.002, n)
+        free = np.clip(free, total_mem * 0.02, total_mem * 0.9)
+        swpd = np.where(free <= total_mem * 0.1, leak * hours_elapsed * 0.5, 0.0)
+        buff = np.full(n, total_mem * rng.uniform(0.01, 0.05))
+        cache = np.clip(total_mem * rng.uniform(0.05, 0.2) + np.cumsum(rng.normal(0, total_mem * 0.0005, n)),
+                        0, total_mem * 0.3)
+        return {
+            "freeMem": np.round(free), "swpdMem": np.round(swpd), "buffMem": np.round(buff),
+            "cacheMem": np.round(cache), "biIo": rng.integers(0, 50, n).astype(np.float64),
+            "boIo": rng.integers(0, 80, n).astype(np.float64),
+            "usCpu": np.round(us) / 100, "syCpu": np.round(sy) / 100, "waCpu": np.round(wa) / 100,
+            "stCpu": np.round(st) / 100, "idCpu": np.round(idle) / 100,
+        }
+
+    def task_document(self, rng: np.random.Generator) -> dict:
+        status = TaskStatus(int(rng.choice((TaskStatus.COMPLETED, TaskStatus.STOPPED, TaskStatus.DELETED),
+                                           p=(0.8, 0.15, 0.05))))
+        return {
+            "_id": self.timed_task_id,
+            "taskID": self.task_id,
+            "taskNo": f"{self.start:%Y%m%d%H%M%S}{self.index % 1000000:06d}",
+            "taskName": self.task_name,
+            "timedTaskKind": TimedTaskKind.CPU_MEM_RECORD,
+            "taskStatus": int(status),
+            "taskRunCounts": self.samples,
+            "createUser": "history",
+            "createTime": self.start,
+            "updateUser": "history",
+            "updateTime": self.end,
+            "resourceID": None,
+            "objIP": f"10.{rng.integers(0, 256)}.{rng.integers(0, 256)}.{rng.integers(1, 255)}",
+            "objSshUser": "root",
+            "objSshPassword": "root",
+            "objSshPort": 22,
+            "crontab": None,
+            "interval": self.interval,
+            "planExecuteTime": [self.start, self.end],
+            "coalesce": True,
+            "maxInstances": 1,
+            "misfireGraceTime": 60,
+            "isShow": status != TaskStatus.DELETED,
+        }
+
+    def sample_documents(self, start: int, stop: int) -> List[dict]:
+        names = DEV_CPU_MEM_COLUMNS
+        columns = [self.columns[name][start:stop].tolist() for name in names]
+        task_id, timed_task_id = self.task_id, self.timed_task_id
+        return [
+            {"taskID": task_id, "recordTime": record_time, **dict(zip(names, values)),
+             "timedTaskID": timed_task_id, "isShow": True}
+            for record_time, *values in zip(self.sample_times[start:stop], *columns)
+        ]
+
+    def record_documents(self, start: int, stop: int) -> List[dict]:
+        """执行记录：每次执行、错过、出错各一条"""
+        missed, error = self.missed[start:stop].tolist(), self.error[start:stop].tolist()
+        task_id, task_name, timed_task_id = self.task_id, self.task_name, self.timed_task_id
+        return [
+            {
+                "taskID": task_id, "taskName": task_name, "operateTime": run_time,
+                "operateResult": MISSED_RESULT if is_missed else ERROR_RESULT if is_error else RUN_RESULT,
+                "timedTaskID": timed_task_id, "isShow": True,
+            }
+            for run_time, is_missed, is_error in zip(self.run_times[start:stop], missed, error)
+        ]
+
+
+class _Loader:
+    """限制同时进行的insert_many数量，生成下一批数据和写入上一批同时进行"""
+
+    def __init__(self, concurrency: int):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.tasks = set()
+        self.errors = []
+        self.inserted = {TASK_COLLECT: 0, RECORD_COLLECT: 0, SAMPLE_COLLECT: 0, BUCKET_COLLECT: 0}
+
+    async def insert(self, collect_name: str, documents: List[dict]):
+        if not documents:
+            return
+        await self.semaphore.acquire()
+        task = asyncio.create_task(self._insert(collect_name, documents))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _insert(self, collect_name: str, documents: List[dict]):
+        try:
+            collect: AgnosticCollection = AsyncMongoClient[collect_name]
+            await collect.insert_many(documents, ordered=False, bypass_document_validation=True)
+            self.inserted[collect_name] += len(documents)
+        except Exception as e:
+            self.errors.append(e)
+        finally:
+            self.semaphore.release()
+
+    async def wait(self):
+        if self.tasks:
+            await asyncio.gather(*self.tasks)
+        if self.errors:
+            raise self.errors[0]
+
+
+async def _load_shard(worker: int, specs: List[TaskSpec], args: argparse.Namespace) -> dict:
+    AsyncMongoClient.start(Config.MONGO_STR)
+    AsyncMongoClient.switch_db(args.database)
+    rng = np.random.default_rng(args.seed + worker + 1)
+    loader = _Loader(args.concurrency)
+    now = datetime.now().replace(microsecond=0)
+    last_report = time.monotonic()
+    try:
+        for task_start in range(0, len(specs), args.batch):
+            task_batch = [_TaskData(rng, index, samples, args, now) for index, samples in
+                          specs[task_start:task_start + args.batch]]
+            await loader.insert(TASK_COLLECT, [task.task_document(rng) for task in task_batch])
+            for task in task_batch:
+                for start in range(0, task.samples, args.batch):
+                    samples = task.sample_documents(start, start + args.batch)
+                    if args.storage == "bucket":
+                        # 跨批次的小时会拆成两个桶，对查询没有影响
+                        await loader.insert(BUCKET_COLLECT, build_bucket_documents(samples, Config.SAMPLE_BUCKET_SIZE))
+                    else:
+                        await loader.insert(SAMPLE_COLLECT, samples)
+                if not args.no_records:
+                    for start in range(0, len(task.run_times), args.batch):
+                        await loader.insert(RECORD_COLLECT, task.record_documents(start, start + args.batch))
+                if time.monotonic() - last_report > 10:
+                    last_report = time.monotonic()
+                    print(f"[worker {worker}] {loader.inserted}", flush=True)
+        await loader.wait()
+    finally:
+        AsyncMongoClient.close()
+    return loader.inserted
+
+
+def _worker(worker: int, specs: List[TaskSpec], args: argparse.Namespace) -> dict:
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        ...
+    return asyncio.run(_load_shard(worker, specs, args))
+
+
+async def _prepare(args: argparse.Namespace):
+    AsyncMongoClient.start(Config.MONGO_STR)
+    AsyncMongoClient.switch_db(args.database)
+    try:
+        if not await AsyncMongoClient.ping(timeout=3):
+            raise SystemExit("无法连接mongodb")
+        if args.drop:
+            for collect_name in (TASK_COLLECT, RECORD_COLLECT, SAMPLE_COLLECT, BUCKET_COLLECT):
+                await AsyncMongoClient[collect_name].drop()
+    finally:
+        AsyncMongoClient.close()
+
+
+async def _create_indexes(args: argparse.Namespace):
+    from bootstrap import init_mongo
+    Config.MONGO_DATABASE = args.database
+    await init_mongo()
+    AsyncMongoClient.close()
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="生成测试用的历史数据")
+    parser.add_argument("--tasks", type=int, default=1000, help="定时任务数")
+    parser.add_argument("--samples", type=int, default=1000000, help="采样点总数（不含--big-tasks）")
+    parser.add_argument("--big-tasks", default="", help="额外生成的大任务的采样数，逗号分隔，比如10000,1000000")
+    parser.add_argument("--days", type=float, default=90, help="任务的结束时间分布在最近多少天内")
+    parser.add_argument("--miss-rate", type=float, default=0.01, help="错过执行的比例")
+    parser.add_argument("--error-rate", type=float, default=0.002, help="执行出错的比例")
+    parser.add_argument("--leak-rate", type=float, default=0.05, help="内存泄漏的任务比例")
+    parser.add_argument("--no-records", action="store_true", help="不生成执行记录")
+    parser.add_argument("--workers", type=int, default=max(multiprocessing.cpu_count() // 2, 1), help="进程数")
+    parser.add_argument("--concurrency", type=int, default=4, help="每个进程同时进行的insert_many数")
+    parser.add_argument("--batch", type=int, default=5000, help="每次insert_many的文档数")
+    parser.add_argument("--storage", choices=("document", "bucket"), default=Config.SAMPLE_STORAGE,
+                        help="采样的存储方式，和服务的SAMPLE_STORAGE保持一致")
+    parser.add_argument("--database", default=Config.MONGO_DATABASE)
+    parser.add_argument("--drop", action="store_true", help="先删除三个集合")
+    parser.add_argument("--no-index", action="store_true", help="写入后不创建索引")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    big_tasks = [int(x) for x in args.big_tasks.split(",") if x.strip()]
+    specs = plan_tasks(args.tasks, args.samples, big_tasks, args.seed)
+    asyncio.run(_prepare(args))
+
+    start = time.perf_counter()
+    shards = [shard for shard in _shard(specs, args.workers) if shard]
+    if len(shards) == 1:
+        results = [_worker(0, shards[0], args)]
+    else:
+        with multiprocessing.get_context("spawn").Pool(len(shards)) as pool:
+            results = pool.starmap(_worker, [(index, shard, args) for index, shard in enumerate(shards)])
+    cost = time.perf_counter() - start
+    total = {name: sum(result[name] for result in results) for name in results[0]}
+    samples = sum(count for _, count in specs)
+    print(f"写入完成，耗时{cost:.1f}秒：{total}，采样{samples / cost:.0f}条/秒")
+
+    if not args.no_index:
+        start = time.perf_counter()
+        asyncio.run(_create_indexes(args))
+        print(f"创建索引耗时{time.perf_counter() - start:.1f}秒")
+
+
+if __name__ == "__main__":
+    main()
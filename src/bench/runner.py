@@ -0,0 +1,184 @@
+"""
+基准测试的注册、执行和结果对比
+每个基准测试返回若干指标，结果写成json，可以和保存的基线比较，变差超过阈值时认为性能回退
+"""
+import asyncio
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import traceback
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+
+@dataclass
+class Metric:
+    value: float
+    unit: str
+    higher_is_better: bool
+
+    def to_dict(self) -> dict:
+        return {"value": self.value, "unit": self.unit, "higherIsBetter": self.higher_is_better}
+
+
+class BenchResult:
+    def __init__(self, **params):
+        self.params = params
+        self.metrics: Dict[str, Metric] = dict()
+
+    def add(self, name: str, value: float, unit: str, higher_is_better: bool):
+        self.metrics[name] = Metric(value, unit, higher_is_better)
+        return self
+
+    def add_rate(self, name: str, count: int, seconds: float, unit: str):
+        return self.add(name, count / seconds if seconds > 0 else 0.0, unit, True)
+
+    def add_latency(self, name: str, seconds: Sequence[float]):
+        """记录一组耗时的p50、p95、平均值（毫秒）"""
+        ordered = sorted(seconds)
+        self.add(f"{name}P50Ms", ordered[len(ordered) // 2] * 1000, "ms", False)
+        self.add(f"{name}P95Ms", ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)] * 1000, "ms", False)
+        self.add(f"{name}MeanMs", statistics.fmean(ordered) * 1000, "ms", False)
+        return self
+
+    def to_dict(self) -> dict:
+        return {
+            "params": self.params,
+            "metrics": {name: metric.to_dict() for name, metric in self.metrics.items()},
+        }
+
+
+class SkipBench(Exception):
+    """缺少运行条件（比如没有mongodb）时跳过"""
+
+
+@dataclass
+class Bench:
+    name: str
+    func: Callable[..., Awaitable[List[Tuple[str, BenchResult]]]]
+    requires: Tuple[str, ...] = field(default_factory=tuple)
+    description: str = ""
+
+
+BENCHES: Dict[str, Bench] = dict()
+
+
+def benchmark(name: str, requires: Tuple[str, ...] = (), description: str = ""):
+    """
+    注册一个基准测试，函数为 async def func(ctx) -> BenchResult 或 [(子名称, BenchResult)]
+    requires 为需要的资源：mongo、ssh
+    """
+    def decorator(func):
+        BENCHES[name] = Bench(name, func, requires, description or (func.__doc__ or "").strip())
+        return func
+    return decorator
+
+
+async def measure(func: Callable[[], Awaitable], repeat: int, warmup: int = 1) -> List[float]:
+    for _ in range(warmup):
+        await func()
+    costs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await func()
+        costs.append(time.perf_counter() - start)
+    return costs
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5
+        ).stdout.strip() or None
+    except Exception:
+        return None
+
+
+async def run_benches(names: Sequence[str], ctx, available: Dict[str, bool]) -> dict:
+    results, skipped = dict(), dict()
+    for name in names:
+        bench = BENCHES[name]
+        missing = [r for r in bench.requires if not available.get(r)]
+        if missing:
+            skipped[name] = f"缺少{','.join(missing)}"
+            print(f"[skip] {name}: {skipped[name]}")
+            continue
+        print(f"[run ] {name}")
+        try:
+            output = await bench.func(ctx)
+        except SkipBench as e:
+            skipped[name] = str(e)
+            print(f"[skip] {name}: {e}")
+            continue
+        except Exception:
+            skipped[name] = traceback.format_exc(limit=3)
+            print(f"[fail] {name}\n{skipped[name]}")
+            continue
+        if isinstance(output, BenchResult):
+            output = [("", output)]
+        for sub_name, result in output:
+            key = f"{name}/{sub_name}" if sub_name else name
+            results[key] = result.to_dict()
+            for metric_name, metric in result.metrics.items():
+                print(f"       {key:<40} {metric_name:<24} {metric.value:>14.3f} {metric.unit}")
+    return {
+        "meta": {
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "commit": _git_commit(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "eventLoop": type(asyncio.get_running_loop()).__module__,
+        },
+        "results": results,
+        "skipped": skipped,
+    }
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> List[dict]:
+    """
+    和基线比较同名的指标，change为正表示变好
+    :param threshold: 变差超过该比例时认为回退，比如0.1
+    """
+    rows = []
+    for key, result in current["results"].items():
+        base_result = baseline.get("results", {}).get(key)
+        if base_result is None:
+            continue
+        for metric_name, metric in result["metrics"].items():
+            base_metric = base_result["metrics"].get(metric_name)
+            if base_metric is None or not base_metric["value"]:
+                continue
+            ratio = metric["value"] / base_metric["value"] - 1
+            change = ratio if metric["higherIsBetter"] else -ratio
+            rows.append({
+                "bench": key,
+                "metric": metric_name,
+                "baseline": base_metric["value"],
+                "current": metric["value"],
+                "change": change,
+                "regression": change < -threshold,
+            })
+    return rows
+
+
+def print_comparison(rows: List[dict]):
+    for row in rows:
+        flag = "REGRESSION" if row["regression"] else ""
+        print(
+            f"{row['bench']:<40} {row['metric']:<24} {row['baseline']:>14.3f} -> {row['current']:>14.3f} "
+            f"{row['change']:>+8.1%} {flag}"
+        )
+
+
+def load_json(path: str) -> dict:
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def dump_json(data: dict, path: str):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
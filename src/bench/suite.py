@@ -0,0 +1,360 @@
+"""
+采集、存储、查询热点路径的基准测试
+运行：cd src && python -m bench.suite --output bench-result.json --baseline bench-baseline.json
+- 需要mongodb的测试使用Config.MONGO_STR，连不上时跳过
+- 需要ssh的测试默认在本进程内启动模拟设备（simulator.device_fleet），也可以用--external-fleet连接已经启动的模拟设备
+- 查询的测试使用库里现有的数据，可以先用 python -m bench.generate_history 生成
+和基线相比有指标变差超过--threshold时退出码为1
+"""
+import argparse
+import asyncio
+import io
+import random
+import sys
+import time
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+from bson import ObjectId
+
+from bench import bench_sample_record
+from bench.runner import (
+    BENCHES, BenchResult, SkipBench, benchmark, measure, run_benches, compare, print_comparison, load_json, dump_json
+)
+from config import Config
+from server.timedTask.model import TimedTaskKind, VMSTAT_COMMAND
+from server.timedTask.sample_storage import count_samples, sample_collect
+from server.util import response_data_format
+from simulator.device_fleet import DeviceFleet, FleetOptions
+from utils.mongo_client import AsyncMongoClient
+from utils.pydis import Pydis
+
+try:
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    ...
+
+
+class BenchContext:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.fleet: Optional[DeviceFleet] = None
+        self._http = None
+
+    @property
+    def ssh_ports(self) -> range:
+        return range(self.args.base_port, self.args.base_port + self.args.devices)
+
+    async def http(self):
+        """不经过网络直接调用ASGI应用，包括中间件、参数校验和响应编码"""
+        if self._http is None:
+            try:
+                import httpx
+            except ImportError:
+                raise SkipBench("需要安装httpx")
+            from main import app
+            self._http = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench")
+        return self._http
+
+    async def close(self):
+        if self._http is not None:
+            await self._http.aclose()
+        if self.fleet is not None:
+            await self.fleet.close()
+
+
+def _quiet():
+    """NoFTPSSHClientSession会打印收到的所有内容，测试时丢弃"""
+    return redirect_stdout(io.StringIO())
+
+
+@benchmark("sample_record", description="采样点从解析到BSON编码的开销")
+async def bench_sample_record_cost(ctx: BenchContext):
+    output = []
+    for func in (bench_sample_record.by_model, bench_sample_record.by_record):
+        data = bench_sample_record.run(func, ctx.args.samples, 1000)
+        output.append((data["name"], BenchResult(count=data["count"])
+                       .add("usPerSample", data["usPerSample"], "us", False)
+                       .add("samplesPerSecond", data["samplesPerSecond"], "samples/s", True)))
+    return output
+
+
+def _detail_like_document(samples: int) -> dict:
+    now = datetime.now()
+    return {
+        "timedTaskKind": TimedTaskKind.CPU_MEM_RECORD,
+        "recordsTotal": 20,
+        "records": [
+            {"taskID": "TimedTask_bench", "taskName": "bench", "operateTime": now, "operateResult": "执行成功"}
+            for _ in range(20)
+        ],
+        "resultsTotal": samples,
+        "results": [
+            {
+                "taskID": "TimedTask_bench", "recordTime": now - timedelta(seconds=i * 5), "timedTaskID": ObjectId(),
+                "freeMem": 3352595.0, "swpdMem": 5452595.0, "buffMem": 2152595.0, "cacheMem": 52595.0,
+                "biIo": 10.0, "boIo": 10.0, "usCpu": 0.7, "syCpu": 0.1, "waCpu": 0.01, "stCpu": 0.02, "idCpu": 0.1,
+            }
+            for i in range(samples)
+        ],
+    }
+
+
+@benchmark("response_format", description="response_data_format处理详情数据的开销")
+async def bench_response_format(ctx: BenchContext):
+    output = []
+    for samples in (100, 1000, 10000):
+        document = _detail_like_document(samples)
+        repeat = max(3, ctx.args.repeat * 100 // samples)
+
+        async def format_document():
+            response_data_format(document)
+
+        costs = await measure(format_document, repeat)
+        output.append((f"samples={samples}", BenchResult(samples=samples, repeat=repeat)
+                       .add_latency("format", costs)
+                       .add("samplesPerSecond", samples / min(costs), "samples/s", True)))
+    return output
+
+
+async def _run_pipeline(ctx: BenchContext, source: str, targets: List[Tuple[str, int]]) -> BenchResult:
+    from server.timedTask.util import get_device_cpu_and_mem, dev_cpu_mem_writer
+
+    timed_task_ids = [ObjectId() for _ in targets]
+    old_source = Config.SAMPLE_SOURCE
+    Config.SAMPLE_SOURCE = source
+    errors = 0
+    try:
+        with _quiet():
+            start = time.perf_counter()
+            for round_index in range(ctx.args.rounds):
+                results = await asyncio.gather(*(
+                    get_device_cpu_and_mem(
+                        timed_task_id, f"TimedTask_bench_{index}", host, ctx.args.username, ctx.args.password, port
+                    )
+                    for index, (timed_task_id, (host, port)) in enumerate(zip(timed_task_ids, targets))
+                ), return_exceptions=True)
+                errors += sum(isinstance(result, Exception) for result in results)
+            await dev_cpu_mem_writer.flush()
+            cost = time.perf_counter() - start
+    finally:
+        Config.SAMPLE_SOURCE = old_source
+        await sample_collect().delete_many({"timedTaskID": {"$in": timed_task_ids}})
+    count = len(targets) * ctx.args.rounds
+    return (BenchResult(tasks=len(targets), rounds=ctx.args.rounds, errors=errors)
+            .add_rate("samplesPerSecond", count - errors, cost, "samples/s")
+            .add("errorRate", errors / count, "ratio", False))
+
+
+@benchmark("pipeline_example", requires=("mongo",), description="get_device_cpu_and_mem端到端（示例数据，不经过ssh）")
+async def bench_pipeline_example(ctx: BenchContext):
+    return await _run_pipeline(ctx, "example", [("127.0.0.1", 22)] * ctx.args.devices)
+
+
+@benchmark("pipeline_ssh", requires=("mongo", "ssh"), description="get_device_cpu_and_mem端到端（通过ssh采集模拟设备）")
+async def bench_pipeline_ssh(ctx: BenchContext):
+    return await _run_pipeline(ctx, "ssh", [(ctx.args.ssh_host, port) for port in ctx.ssh_ports])
+
+
+@benchmark("ssh_send_recv", requires=("ssh",), description="send_and_recv按输出大小的吞吐")
+async def bench_ssh_send_recv(ctx: BenchContext):
+    output = []
+    with _quiet():
+        client = await Pydis.get_ssh_client(
+            ctx.args.ssh_host, ctx.args.username, ctx.args.password, port=ctx.ssh_ports[0]
+        )
+        for lines in (1, 1000, 20000):
+            command = VMSTAT_COMMAND if lines == 1 else f"seq {lines}"
+            size = len((await client.send_and_recv(command, timeout=60))[0])
+            costs = await measure(lambda: client.send_and_recv(command, timeout=60), ctx.args.repeat)
+            output.append((f"lines={lines}", BenchResult(lines=lines, bytes=size)
+                           .add_latency("command", costs)
+                           .add_rate("megabytesPerSecond", size * len(costs) / 1e6, sum(costs), "MB/s")))
+    return output
+
+
+@benchmark("pydis_connect", requires=("ssh",), description="Pydis并发建立ssh连接")
+async def bench_pydis_connect(ctx: BenchContext):
+    output = []
+    ports = list(ctx.ssh_ports)
+    for concurrency in sorted({1, min(50, len(ports)), len(ports)}):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def connect(port: int):
+            async with semaphore:
+                await Pydis.get_ssh_client(ctx.args.ssh_host, ctx.args.username, ctx.args.password, port=port)
+
+        targets = ports[:max(concurrency, min(len(ports), 20))]
+        with _quiet():
+            start = time.perf_counter()
+            results = await asyncio.gather(*(connect(port) for port in targets), return_exceptions=True)
+            cost = time.perf_counter() - start
+            for key in list(Pydis._object_map):
+                await Pydis.close_object(key)
+        errors = sum(isinstance(result, Exception) for result in results)
+        output.append((f"concurrency={concurrency}", BenchResult(connections=len(targets), errors=errors)
+                       .add_rate("connectsPerSecond", len(targets) - errors, cost, "connects/s")))
+    return output
+
+
+@benchmark("search", requires=("mongo",), description="/interview/timedTask/search延迟，cold为每次清空缓存")
+async def bench_search(ctx: BenchContext):
+    from server.timedTask.util import invalidate_timed_task_cache
+
+    client = await ctx.http()
+    tasks = await AsyncMongoClient["timed_task_collect"].estimated_document_count()
+    if tasks == 0:
+        raise SkipBench("timed_task_collect中没有数据")
+    output = []
+    for page, limit in ((1, 20), (max(tasks // 20 // 2, 1), 20)):
+        async def search():
+            response = await client.post("/interview/timedTask/search", json={"page": page, "limit": limit})
+            if response.json()["code"] != 0:
+                raise Exception(response.json()["msg"])
+
+        async def cold_search():
+            invalidate_timed_task_cache()
+            await search()
+
+        output.append((f"page={page}", BenchResult(tasks=tasks, page=page, limit=limit)
+                       .add_latency("cold", await measure(cold_search, ctx.args.repeat))
+                       .add_latency("cached", await measure(search, ctx.args.repeat))))
+    return output
+
+
+async def _detail_targets(ctx: BenchContext) -> List[Tuple[ObjectId, int]]:
+    """从定时任务里随机取一些，找出采样数最接近各个数量级的任务"""
+    if ctx.args.detail_task:
+        ids = [ObjectId(task_id) for task_id in ctx.args.detail_task]
+    else:
+        tasks = await AsyncMongoClient["timed_task_collect"].aggregate([
+            {"$match": {"isShow": True, "timedTaskKind": TimedTaskKind.CPU_MEM_RECORD}},
+            {"$sample": {"size": 20}},
+            {"$project": {"_id": 1}},
+        ]).to_list(None)
+        ids = [task["_id"] for task in tasks]
+    counts = [(task_id, await count_samples(task_id)) for task_id in ids]
+    counts = [item for item in counts if item[1] > 0]
+    if ctx.args.detail_task:
+        return counts
+    targets = dict()
+    for scale in (10_000, 1_000_000, 10_000_000):
+        if counts:
+            task_id, count = min(counts, key=lambda item: abs(item[1] - scale))
+            targets[task_id] = count
+    return sorted(targets.items(), key=lambda item: item[1])
+
+
+@benchmark("detail", requires=("mongo",), description="/interview/timedTask/detail延迟，按任务的采样数分组")
+async def bench_detail(ctx: BenchContext):
+    from server.timedTask.util import invalidate_timed_task_cache
+
+    client = await ctx.http()
+    targets = await _detail_targets(ctx)
+    if not targets:
+        raise SkipBench("没有带采样数据的定时任务")
+    output = []
+    body = {"recordPage": 1, "recordLimit": 20, "resultPage": 1, "resultLimit": 500}
+    for timed_task_id, count in targets:
+        async def detail():
+            invalidate_timed_task_cache(timed_task_id, search=False)
+            response = await client.post(f"/interview/timedTask/detail?timedTaskID={timed_task_id}", json=body)
+            if response.json()["code"] != 0:
+                raise Exception(response.json()["msg"])
+
+        repeat = ctx.args.repeat if count < 1_000_000 else max(ctx.args.repeat // 10, 3)
+        output.append((f"samples={count}", BenchResult(timedTaskID=str(timed_task_id), samples=count, repeat=repeat)
+                       .add_latency("detail", await measure(detail, repeat))))
+    return output
+
+
+async def prepare(ctx: BenchContext, names: List[str]) -> dict:
+    required = {r for name in names for r in BENCHES[name].requires}
+    available = {"mongo": False, "ssh": False}
+    if "mongo" in required and not ctx.args.no_mongo:
+        from bootstrap import init_mongo
+        # 先确认能连上，连不上时init_mongo创建索引会一直等到服务器选择超时
+        AsyncMongoClient.start(Config.MONGO_STR)
+        available["mongo"] = await AsyncMongoClient.ping(timeout=3)
+        AsyncMongoClient.close()
+        if available["mongo"]:
+            await init_mongo()
+    if "ssh" in required and not ctx.args.no_ssh:
+        if not ctx.args.external_fleet:
+            ctx.fleet = DeviceFleet(FleetOptions(
+                devices=ctx.args.devices, host=ctx.args.ssh_host, base_port=ctx.args.base_port,
+                username=ctx.args.username, password=ctx.args.password, latency=ctx.args.latency, jitter=0,
+            ))
+            await ctx.fleet.start()
+        available["ssh"] = True
+    return available
+
+
+async def main(args: argparse.Namespace) -> int:
+    names = args.only.split(",") if args.only else list(BENCHES)
+    unknown = [name for name in names if name not in BENCHES]
+    if unknown:
+        print(f"未知的测试：{unknown}，可选：{list(BENCHES)}")
+        return 2
+    random.seed(0)
+    ctx = BenchContext(args)
+    try:
+        available = await prepare(ctx, names)
+        result = await run_benches(names, ctx, available)
+    finally:
+        await ctx.close()
+        AsyncMongoClient.close()
+    result["meta"]["args"] = vars(args)
+    if args.output:
+        dump_json(result, args.output)
+        print(f"结果已写入{args.output}")
+
+    regressions = []
+    if args.baseline and not args.save_baseline:
+        try:
+            baseline = load_json(args.baseline)
+        except FileNotFoundError:
+            print(f"基线{args.baseline}不存在，使用--save-baseline保存")
+        else:
+            rows = compare(result, baseline, args.threshold)
+            print_comparison(rows)
+            regressions = [row for row in rows if row["regression"]]
+    if args.baseline and args.save_baseline:
+        dump_json(result, args.baseline)
+        print(f"基线已保存到{args.baseline}")
+    return 1 if regressions else 0
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="基准测试")
+    parser.add_argument("--only", default=None, help="只运行这些测试，逗号分隔")
+    parser.add_argument("--list", action="store_true", help="列出所有测试")
+    parser.add_argument("--output", default=None, help="结果json文件")
+    parser.add_argument("--baseline", default=None, help="基线json文件")
+    parser.add_argument("--save-baseline", action="store_true", help="把本次结果保存为基线")
+    parser.add_argument("--threshold", type=float, default=0.1, help="指标变差超过该比例时认为回退")
+    parser.add_argument("--repeat", type=int, default=20, help="延迟类测试的重复次数")
+    parser.add_argument("--rounds", type=int, default=5, help="端到端采集的轮数")
+    parser.add_argument("--samples", type=int, default=100000, help="sample_record的采样数")
+    parser.add_argument("--no-mongo", action="store_true")
+    parser.add_argument("--no-ssh", action="store_true")
+    parser.add_argument("--devices", type=int, default=100, help="模拟设备数，也是端到端采集的任务数")
+    parser.add_argument("--external-fleet", action="store_true", help="使用已经启动的模拟设备")
+    parser.add_argument("--ssh-host", default="127.0.0.1")
+    parser.add_argument("--base-port", type=int, default=21000)
+    parser.add_argument("--username", default="root")
+    parser.add_argument("--password", default="root")
+    parser.add_argument("--latency", type=float, default=0.0, help="模拟设备的响应延迟（秒）")
+    parser.add_argument("--detail-task", action="append", default=None, help="detail测试使用的定时任务ID，可以多次指定")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    if arguments.list:
+        for bench in BENCHES.values():
+            print(f"{bench.name:<20} {','.join(bench.requires) or '-':<10} {bench.description}")
+        sys.exit(0)
+    sys.exit(asyncio.run(main(arguments)))
@@ -0,0 +1,115 @@
+"""
+api进程（main.py）和采集进程（collector.py）共用的启动、关闭流程
+"""
+from typing import List, cast
+
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.triggers.interval import IntervalTrigger
+from motor.core import AgnosticCollection
+from pymongo.errors import OperationFailure
+
+from config import Config
+from server.timedTask.aggregate import SampleAggregator, SUMMARY_COLLECT
+from server.timedTask.archive import ARCHIVE_COLLECT, archive_old_samples
+from server.timedTask.report import REPORT_COLLECT, ReportRollup, rollup_report
+from server.timedTask.stats import mark_stats_replayed
+from server.timedTask.sample_storage import BUCKET_COLLECT, SAMPLE_COLLECT, create_sample_spool
+from server.timedTask.util import dev_cpu_mem_writer, load_timed_task_jobs, watch_timed_task_changes
+from utils.mongo_client import AsyncMongoClient, available_compressors, mask_uri
+from utils.monitor import LoopMonitor, SchedulerMonitor
+from utils.scheduler import Scheduler
+from utils.tracing import TRACE_COLLECT
+
+
+async def init_mongo():
+    AsyncMongoClient.start(
+        Config.MONGO_STR,
+        analytics_read_preference=Config.MONGO_ANALYTICS_READ_PREFERENCE,
+        maxPoolSize=Config.MONGO_MAX_POOL_SIZE,
+        minPoolSize=Config.MONGO_MIN_POOL_SIZE,
+        compressors=available_compressors(Config.MONGO_COMPRESSORS) or None,
+        serverSelectionTimeoutMS=Config.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        connectTimeoutMS=Config.MONGO_CONNECT_TIMEOUT_MS,
+        socketTimeoutMS=Config.MONGO_SOCKET_TIMEOUT_MS or None,
+    )
+    AsyncMongoClient.switch_db(Config.MONGO_DATABASE)
+    print(f"mongodb连接：{mask_uri(Config.MONGO_STR)}，{AsyncMongoClient.settings()}")
+    if Config.MONGO_WARMUP:
+        # 第一批请求不用等待建立连接、认证
+        connected = await AsyncMongoClient.warm_up(Config.MONGO_MIN_POOL_SIZE)
+        print(f"mongodb连接池预热：{connected}/{Config.MONGO_MIN_POOL_SIZE}")
+    indexes = [
+        ("job_lock", [("ttl_time", 1)], {"expireAfterSeconds": 30}),
+        (SUMMARY_COLLECT, [("timedTaskID", 1), ("period", 1), ("start", 1)], {"unique": True}),
+        (SAMPLE_COLLECT, [("timedTaskID", 1), ("recordTime", 1)], {}),
+        # 报表汇总按时间范围扫描所有任务的采样
+        (SAMPLE_COLLECT, [("recordTime", 1)], {}),
+        ("timed_task_record_collect", [("timedTaskID", 1), ("operateTime", -1)], {}),
+        (ARCHIVE_COLLECT, [("timedTaskID", 1), ("day", 1)], {"unique": True}),
+        (BUCKET_COLLECT, [("timedTaskID", 1), ("start", 1)], {}),
+        (BUCKET_COLLECT, [("start", 1)], {}),
+        (REPORT_COLLECT, [("timedTaskID", 1), ("period", 1), ("start", 1)], {"unique": True}),
+        (REPORT_COLLECT, [("period", 1), ("start", 1)], {}),
+        (TRACE_COLLECT, [("time", 1)], {"expireAfterSeconds": Config.TRACE_RETENTION}),
+    ]
+    for collect_name, keys, kwargs in indexes:
+        collect = cast(AgnosticCollection, AsyncMongoClient[collect_name])
+        try:
+            await collect.create_index(keys, **kwargs)
+        except OperationFailure as e:
+            print("创建索引失败：", str(e))
+
+
+async def _on_sample_replay(samples: List[dict]):
+    """磁盘缓冲回放的采样可能早于报表汇总的水位、已经缓存的统计窗口，回放后标记需要重新计算"""
+    await ReportRollup.mark_samples_dirty(samples)
+    await mark_stats_replayed(samples)
+
+
+async def init_scheduler():
+    # 停机等原因错过的多次执行默认合并成一次，单个任务可以在任务上覆盖这些配置
+    async_scheduler = AsyncIOScheduler(job_defaults={
+        "coalesce": True,
+        "max_instances": 1,
+        "misfire_grace_time": 60,
+    })
+    Scheduler.init("async", async_scheduler)
+    Scheduler.start()
+    # 只有运行调度、写入采样的进程才占用磁盘缓冲的槽位，并接手其他已退出进程遗留的数据
+    spool = create_sample_spool(dev_cpu_mem_writer.collect_name)
+    if spool is not None:
+        dev_cpu_mem_writer.attach_spool(spool)
+    dev_cpu_mem_writer.on_replay = _on_sample_replay
+    SampleAggregator.samples_settled = dev_cpu_mem_writer.is_idle
+    # 先全量加载，再通过change stream同步其他worker、进程后续的修改（第一次启动时打开stream后会再全量同步一次）
+    await load_timed_task_jobs()
+    watch_timed_task_changes()
+    Scheduler.add_job(
+        archive_old_samples, IntervalTrigger(seconds=Config.SAMPLE_ARCHIVE_INTERVAL), _id="archive_old_samples"
+    )
+    Scheduler.add_job(rollup_report, IntervalTrigger(seconds=Config.REPORT_ROLLUP_INTERVAL), _id="rollup_report")
+
+
+async def close_collection():
+    """把内存里还没写入的采样数据、汇总写完"""
+    await dev_cpu_mem_writer.close()
+    await SampleAggregator.close()
+
+
+async def readiness(scheduler_enabled: bool = True) -> dict:
+    """/status返回的就绪信息，mongodb不通或者调度器应该运行却没有运行时ready为False"""
+    mongo_ok = await AsyncMongoClient.ping()
+    scheduler_running = Scheduler.is_running()
+    loop_lag = LoopMonitor.lag.snapshot()
+    fire_lag = SchedulerMonitor.fire_lag.snapshot()
+    return {
+        "ready": mongo_ok and (scheduler_running or not scheduler_enabled),
+        "mongo": mongo_ok,
+        "scheduler": {
+            "enabled": scheduler_enabled,
+            "running": scheduler_running,
+            "jobs": len(Scheduler.async_scheduler.get_jobs()) if scheduler_running else 0,
+            "fireLag": {key: fire_lag[key] for key in ("count", "p50", "p95", "p99", "max")},
+        },
+        "loopLag": {key: loop_lag[key] for key in ("count", "p50", "p95", "p99", "max")},
+    }
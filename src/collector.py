@@ -0,0 +1,81 @@
+"""
+独立的采集进程：只运行调度器和采集、写入流程，调度器通过change stream获取定时任务的变化
+运行：cd src && python -m collector
+api进程需要设置环境变量 SCHEDULER_ENABLED=0
+"""
+import asyncio
+
+from contextlib import asynccontextmanager
+
+import uvicorn
+from fastapi import FastAPI, APIRouter, Response
+
+from bootstrap import init_mongo, init_scheduler, close_collection, readiness
+from config import Config
+from server.admin.api import router as admin_router
+from server.timedTask.api import get_timed_task_recent
+from server.timedTask.util import RecentSampleSource
+from utils.compression import CompressionMiddleware
+from utils.metrics import MetricsMiddleware, metrics_endpoint
+from utils.mongo_client import AsyncMongoClient
+from utils.monitor import LoopMonitor
+from utils.scheduler import Scheduler
+from utils.tracing import TracingMiddleware, trace_writer
+
+try:
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    ...
+
+
+@asynccontextmanager
+async def lifespan(application: FastAPI):
+    LoopMonitor.start()
+    # 采集进程只有一个worker，所有采样都经过它的缓冲区，最近的点直接从内存读
+    RecentSampleSource.ring_complete = True
+    await init_mongo()
+    await init_scheduler()
+    yield
+    Scheduler.shutdown()
+    await close_collection()
+    await trace_writer.close()
+    AsyncMongoClient.close()
+    LoopMonitor.stop()
+
+
+# 最近的采样点只在采集进程的内存里，所以由采集进程提供查询
+router = APIRouter()
+router.add_api_route(
+    "/timedTask/recent", get_timed_task_recent, methods=["POST"], summary="查看定时任务最近的运行状况"
+)
+
+app = FastAPI(
+    title="113TestWeb collector",
+    description="定时任务采集进程",
+    version="0.0.1",
+    lifespan=lifespan
+)
+app.include_router(router, prefix="/interview", tags=["collector"])
+if Config.ADMIN_ENABLED:
+    app.include_router(admin_router, prefix="/admin", tags=["admin"])
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(TracingMiddleware)
+app.add_middleware(MetricsMiddleware)
+app.add_api_route("/metrics", metrics_endpoint, include_in_schema=False)
+
+
+@app.get("/status")
+async def service_is_healthy(response: Response):
+    data = await readiness()
+    if not data["ready"]:
+        response.status_code = 503
+    return {
+        "status": "ok" if data["ready"] else "unavailable",
+        **data
+    }
+
+
+if __name__ == "__main__":
+    # 调度器和内存中的数据都在进程内，只能有一个worker
+    uvicorn.run(app, host=Config.COLLECTOR_HOST, port=Config.COLLECTOR_PORT, workers=1)
@@ -1,18 +1,20 @@
 import asyncio
 
 from contextlib import asynccontextmanager
-from typing import cast
 
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from fastapi import FastAPI
+from fastapi import FastAPI, Response
 from fastapi.middleware.cors import CORSMiddleware
-from motor.core import AgnosticCollection
-from pymongo.errors import OperationFailure
 
+from bootstrap import init_mongo, init_scheduler, close_collection, readiness
+from server.timedTask.util import watch_timed_task_cache
 from router import router
 from config import Config
+from utils.compression import CompressionMiddleware
+from utils.metrics import MetricsMiddleware, metrics_endpoint
 from utils.mongo_client import AsyncMongoClient
+from utils.monitor import LoopMonitor
 from utils.scheduler import Scheduler
+from utils.tracing import TracingMiddleware, trace_writer
 
 try:
     import uvloop
@@ -22,21 +24,22 @@ except ImportError:
 
 @asynccontextmanager
 async def lifespan(application: FastAPI):
-    AsyncMongoClient.start(Config.MONGO_STR)
-    AsyncMongoClient.switch_db(Config.MONGO_DATABASE)
-    config_db = cast(AgnosticCollection, AsyncMongoClient["job_lock"])
-    try:
-        await config_db.create_index(
-            [("ttl_time", 1)], expireAfterSeconds=30
-        )
-    except OperationFailure as e:
-        print("创建索引失败：", str(e))
-
-    async_scheduler = AsyncIOScheduler()
-    Scheduler.init("async", async_scheduler)
-    Scheduler.start()
+    LoopMonitor.start()
+    await init_mongo()
+    # 使用独立的采集进程（python -m collector）时，api进程不运行调度器
+    if Config.SCHEDULER_ENABLED:
+        await init_scheduler()
+    else:
+        # 执行状态由采集进程写入，通过change stream清理本进程的定时任务缓存
+        watch_timed_task_cache()
     yield
+    # 同时取消change stream的监听
+    Scheduler.shutdown()
+    if Config.SCHEDULER_ENABLED:
+        await close_collection()
+    await trace_writer.close()
     AsyncMongoClient.close()
+    LoopMonitor.stop()
 
 
 app = FastAPI(
@@ -57,11 +60,19 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# 压缩放在最里层，耗时统计包含压缩的时间
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(TracingMiddleware)
+app.add_middleware(MetricsMiddleware)
 app.include_router(router, prefix="")
+app.add_api_route("/metrics", metrics_endpoint, include_in_schema=False)
 
 @app.get("/status")
-async def service_is_healthy():
-    await asyncio.sleep(0.1)
+async def service_is_healthy(response: Response):
+    data = await readiness(Config.SCHEDULER_ENABLED)
+    if not data["ready"]:
+        response.status_code = 503
     return {
-        "status": "ok"
+        "status": "ok" if data["ready"] else "unavailable",
+        **data
     }
@@ -1,6 +1,11 @@
 from fastapi import APIRouter
 
+from config import Config
+from server.admin.api import router as admin_router
 from server.timedTask.api import router as timed_task_router
 
 router = APIRouter()
 router.include_router(timed_task_router, prefix="/interview", tags=["timed_task"])
+# 性能分析、监控接口和对外接口在同一个端口，只在需要时开启
+if Config.ADMIN_ENABLED:
+    router.include_router(admin_router, prefix="/admin", tags=["admin"])
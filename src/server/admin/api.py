@@ -0,0 +1,147 @@
+import secrets
+from typing import Optional, Literal
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from fastapi.responses import PlainTextResponse
+
+from config import Config
+from server.model import ResponseCode
+from server.util import response_data_format
+from server.timedTask.detector import TaskAnomalyDetector
+from server.timedTask.util import recent_sample_store, timed_task_search_cache, timed_task_info_cache
+from utils.monitor import SchedulerMonitor, LoopMonitor
+from utils.profiler import CpuProfiler, MemoryProfiler, ProfilerBusyError
+from utils.pydis import Pydis
+from utils.scheduler import Scheduler
+from utils.slow_query import SlowQueryProfiler
+from utils.ssh import NoFTPAsyncSSH
+
+
+
+async def verify_admin_token(token: Optional[str] = Header(None, alias="X-Admin-Token")):
+    if Config.ADMIN_TOKEN and not secrets.compare_digest(token or "", Config.ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="管理接口需要正确的X-Admin-Token")
+
+
+router = APIRouter(dependencies=[Depends(verify_admin_token)])
+
+
+@router.get("/scheduler", summary="定时任务的触发延迟和执行耗时")
+async def get_scheduler_monitor(top: int = Query(20, ge=1, le=1000, description="返回触发延迟最大的任务数")):
+    return {
+        "code": ResponseCode.SUCCESS,
+        "msg": "获取调度器监控数据成功",
+        "data": SchedulerMonitor.snapshot(top)
+    }
+
+
+@router.get("/loop", summary="事件循环延迟和阻塞时的调用栈")
+async def get_loop_monitor():
+    return {
+        "code": ResponseCode.SUCCESS,
+        "msg": "获取事件循环监控数据成功",
+        "data": response_data_format(LoopMonitor.snapshot())
+    }
+
+
+@router.get("/slowQueries", summary="mongodb慢查询，按耗时倒序")
+async def get_slow_queries(
+        limit: int = Query(50, ge=1, le=1000),
+        collection: Optional[str] = Query(None, description="只看某个集合")
+):
+    return {
+        "code": ResponseCode.SUCCESS,
+        "msg": "获取慢查询成功",
+        "data": response_data_format({
+            "threshold": SlowQueryProfiler.threshold,
+            "explainSampleRate": SlowQueryProfiler.explain_sample_rate,
+            "records": SlowQueryProfiler.snapshot(limit, collection),
+        })
+    }
+
+
+@router.delete("/slowQueries", summary="清空慢查询记录")
+async def clear_slow_queries():
+    SlowQueryProfiler.clear()
+    return {
+        "code": ResponseCode.SUCCESS,
+        "msg": "清空慢查询记录成功",
+        "data": None
+    }
+
+
+@router.post("/profile/cpu", summary="对当前进程做一段时间的cpu分析")
+async def profile_cpu(
+        seconds: float = Query(10, gt=0, le=120),
+        mode: Literal["sample", "cprofile", "yappi"] = Query("sample", description="sample输出折叠栈，可直接生成火焰图"),
+        interval: float = Query(0.005, ge=0.001, le=1, description="sample模式的采样间隔（秒）"),
+        top: int = Query(50, ge=1, le=1000, description="cprofile、yappi模式输出的函数数")
+):
+    try:
+        result = await CpuProfiler.run(seconds, mode, interval, top)
+    except (ProfilerBusyError, ValueError) as e:
+        return {
+            "code": ResponseCode.GENERAL_FAULT,
+            "msg": str(e),
+            "data": None
+        }
+    return PlainTextResponse(result)
+
+
+def _state_sizes() -> dict:
+    """可能持续增长的进程内状态"""
+    ssh_buffer = 0
+    for handler in list(Pydis._object_map.values()):
+        if isinstance(handler, NoFTPAsyncSSH) and handler.session is not None:
+            ssh_buffer += len(handler.session.received_data)
+    return {
+        "pydisObjects": len(Pydis._object_map),
+        "pydisStopMap": len(Pydis._object_stop_map),
+        "sshReceivedBuffer": ssh_buffer,
+        "schedulerJobs": len(Scheduler.async_scheduler.get_jobs()) if Scheduler.is_running() else 0,
+        "schedulerMonitorJobs": len(SchedulerMonitor._jobs),
+        "schedulerMonitorRunning": len(SchedulerMonitor._running),
+        "sampleRings": len(recent_sample_store._rings),
+        "detectorStates": len(TaskAnomalyDetector._states),
+        "searchCache": len(timed_task_search_cache._data),
+        "infoCache": len(timed_task_info_cache._data),
+    }
+
+
+@router.post("/profile/memory/start", summary="开启tracemalloc并保存基准快照")
+async def start_memory_profile(frames: int = Query(10, ge=1, le=100, description="每次分配记录的栈深度")):
+    return {
+        "code": ResponseCode.SUCCESS,
+        "msg": "开启内存分析成功",
+        "data": {**(await MemoryProfiler.start(frames)), "state": _state_sizes()}
+    }
+
+
+@router.get("/profile/memory/diff", summary="和基准快照比较内存分配的增长")
+async def get_memory_diff(
+        top: int = Query(30, ge=1, le=500),
+        group_by: Literal["lineno", "traceback", "filename"] = Query("lineno", alias="groupBy"),
+        reset: bool = Query(False, description="是否把当前快照作为新的基准")
+):
+    try:
+        data = await MemoryProfiler.diff(top, group_by, reset)
+    except ValueError as e:
+        return {
+            "code": ResponseCode.GENERAL_FAULT,
+            "msg": str(e),
+            "data": None
+        }
+    return {
+        "code": ResponseCode.SUCCESS,
+        "msg": "获取内存分析结果成功",
+        "data": {**data, "state": _state_sizes()}
+    }
+
+
+@router.post("/profile/memory/stop", summary="关闭tracemalloc")
+async def stop_memory_profile():
+    return {
+        "code": ResponseCode.SUCCESS,
+        "msg": "关闭内存分析成功",
+        "data": MemoryProfiler.stop()
+    }
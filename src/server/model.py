@@ -5,6 +5,12 @@ from pydantic.json_schema import JsonSchemaValue
 from pydantic_core import core_schema
 
 
+class ResponseCode:
+    NO_PERMIT = -1
+    SUCCESS = 0
+    GENERAL_FAULT = 1
+
+
 class PyandticObjectId(ObjectId):
 
     """
@@ -0,0 +1,322 @@
+import asyncio
+import math
+import traceback
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from motor.core import AgnosticCollection
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from config import Config
+from server.model import PyandticObjectId
+from server.timedTask.model import DEV_CPU_MEM_COLUMNS
+from server.timedTask.sample_storage import find_samples
+from utils.mongo_client import AsyncMongoClient
+from utils.sketch import DDSketch
+
+SUMMARY_COLLECT = "timed_task_dev_cpu_mem_summary_collect"
+# cpu为派生指标：1 - idCpu
+SUMMARY_METRICS = ("cpu", *DEV_CPU_MEM_COLUMNS)
+SUMMARY_PERCENTILES = (0.5, 0.95, 0.99)
+
+PERIOD_HOUR = "hour"
+PERIOD_RUN = "run"
+
+_sketch = DDSketch()
+
+
+class _Accumulator:
+    __slots__ = ("count", "sum", "sum_sq", "min", "max", "bins")
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.sum_sq = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.bins: Dict[str, int] = dict()
+
+    def add(self, value: float):
+        self.count += 1
+        self.sum += value
+        self.sum_sq += value * value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        key = _sketch.key(value)
+        self.bins[key] = self.bins.get(key, 0) + 1
+
+    def merge(self, other: "_Accumulator"):
+        self.count += other.count
+        self.sum += other.sum
+        self.sum_sq += other.sum_sq
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        for key, count in other.bins.items():
+            self.bins[key] = self.bins.get(key, 0) + count
+
+
+_BucketKey = Tuple[PyandticObjectId, str, Optional[datetime]]
+
+
+def _sample_values(sample: dict) -> Dict[str, float]:
+    values = {name: sample.get(name) for name in DEV_CPU_MEM_COLUMNS}
+    if values["idCpu"] is not None:
+        values["cpu"] = 1 - values["idCpu"]
+    return {name: value for name, value in values.items() if value is not None}
+
+
+def _accumulate(metrics: Dict[str, _Accumulator], sample: dict):
+    for name, value in _sample_values(sample).items():
+        if (acc := metrics.get(name)) is None:
+            acc = metrics[name] = _Accumulator()
+        acc.add(value)
+
+
+def _metrics_document(metrics: Dict[str, _Accumulator]) -> dict:
+    """和$inc累加出来的文档结构一致"""
+    return {
+        name: {
+            "count": acc.count, "sum": acc.sum, "sumSq": acc.sum_sq, "min": acc.min, "max": acc.max,
+            "sketch": dict(acc.bins),
+        }
+        for name, acc in metrics.items()
+    }
+
+
+class SampleAggregator:
+    """
+    在采样写入时增量维护每个定时任务的汇总文档：整个运行期间一份、每小时一份
+    数据先在内存里累加，定时或者攒够一批之后用bulk_write一次性$inc/$min/$max到mongodb
+    网络错误等不知道是否已经写入的批次不能重试（$inc不是幂等的），记下涉及的小时，
+    等这个小时的采样都写入之后从原始采样重新计算整个小时，再由所有小时合并出整个运行期间的汇总
+    """
+    flush_interval: float = Config.SUMMARY_FLUSH_INTERVAL
+    flush_batch_size: int = Config.SUMMARY_FLUSH_BATCH
+
+    _pending: Dict[_BucketKey, Dict[str, _Accumulator]] = dict()
+    _pending_samples: int = 0
+    # 写入结果未知、需要从原始采样重新计算的小时
+    _dirty_hours: Set[Tuple[PyandticObjectId, datetime]] = set()
+    # 原始采样是否都已经写入（没有攒批中、磁盘缓冲中的数据），由启动流程设置
+    samples_settled: Callable[[], bool] = staticmethod(lambda: True)
+    recomputed_hours: int = 0
+    _flush_task: Optional[asyncio.Task] = None
+    _flush_event: Optional[asyncio.Event] = None
+    _flush_lock = asyncio.Lock()
+
+    @classmethod
+    def add(cls, sample: dict):
+        timed_task_id = sample.get("timedTaskID")
+        record_time: datetime = sample.get("recordTime")
+        if timed_task_id is None or record_time is None:
+            return
+        hour = record_time.replace(minute=0, second=0, microsecond=0)
+        for bucket_key in ((timed_task_id, PERIOD_RUN, None), (timed_task_id, PERIOD_HOUR, hour)):
+            _accumulate(cls._pending.setdefault(bucket_key, dict()), sample)
+        cls._pending_samples += 1
+        cls._ensure_flush_task()
+        if cls._pending_samples >= cls.flush_batch_size:
+            cls._flush_event.set()
+
+    @classmethod
+    def _ensure_flush_task(cls):
+        if cls._flush_task is not None and not cls._flush_task.done():
+            return
+        cls._flush_event = asyncio.Event()
+        cls._flush_task = asyncio.get_running_loop().create_task(cls._flush_loop())
+
+    @classmethod
+    async def _flush_loop(cls):
+        while True:
+            try:
+                await asyncio.wait_for(cls._flush_event.wait(), cls.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            cls._flush_event.clear()
+            await cls.flush()
+
+    @classmethod
+    async def flush(cls):
+        async with cls._flush_lock:
+            await cls._write_pending()
+            if cls._dirty_hours:
+                await cls._recompute_dirty()
+
+    @classmethod
+    async def _write_pending(cls):
+        if not cls._pending:
+            return
+        pending, cls._pending, cls._pending_samples = cls._pending, dict(), 0
+        now = datetime.now()
+        operations = []
+        for (timed_task_id, period, start), metrics in pending.items():
+            inc, min_dict, max_dict = dict(), dict(), dict()
+            for name, acc in metrics.items():
+                prefix = f"metrics.{name}"
+                inc[f"{prefix}.count"] = acc.count
+                inc[f"{prefix}.sum"] = acc.sum
+                inc[f"{prefix}.sumSq"] = acc.sum_sq
+                min_dict[f"{prefix}.min"] = acc.min
+                max_dict[f"{prefix}.max"] = acc.max
+                for key, count in acc.bins.items():
+                    inc[f"{prefix}.sketch.{key}"] = count
+            operations.append(UpdateOne(
+                {"timedTaskID": timed_task_id, "period": period, "start": start},
+                {"$inc": inc, "$min": min_dict, "$max": max_dict, "$set": {"updateTime": now}},
+                upsert=True
+            ))
+        bucket_keys = list(pending.keys())
+        summary_collect: AgnosticCollection = AsyncMongoClient[SUMMARY_COLLECT]
+        try:
+            await summary_collect.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            # $inc不是幂等的，只有失败的桶合并回去下次再写（例如两个进程同时upsert同一个新桶的E11000）
+            errors = e.details.get("writeErrors", [])
+            print(f"汇总写入失败{len(errors)}个桶：{errors[0].get('errmsg') if errors else e}")
+            for error in errors:
+                cls._requeue(bucket_keys[error["index"]], pending[bucket_keys[error["index"]]])
+        except Exception:
+            # 网络错误等情况不知道哪些已经写入了，重试可能重复累加，这一批涉及的小时之后重新计算
+            print(traceback.format_exc())
+            cls._dirty_hours.update(
+                (timed_task_id, start) for timed_task_id, period, start in bucket_keys if period == PERIOD_HOUR
+            )
+
+    @classmethod
+    async def _recompute_dirty(cls):
+        """已经结束SUMMARY_RECOMPUTE_DELAY秒、原始采样都已经写入的小时，从原始采样重新计算"""
+        if not cls.samples_settled():
+            return
+        deadline = datetime.now() - timedelta(hours=1, seconds=Config.SUMMARY_RECOMPUTE_DELAY)
+        ready = [key for key in cls._dirty_hours if key[1] <= deadline]
+        tasks = set()
+        for timed_task_id, hour in ready:
+            try:
+                await cls._recompute_hour(timed_task_id, hour)
+            except Exception:
+                print(traceback.format_exc())
+                continue
+            cls._dirty_hours.discard((timed_task_id, hour))
+            tasks.add(timed_task_id)
+        for timed_task_id in tasks:
+            try:
+                await cls._recompute_run(timed_task_id)
+            except Exception:
+                print(traceback.format_exc())
+
+    @classmethod
+    async def _recompute_hour(cls, timed_task_id: PyandticObjectId, hour: datetime):
+        metrics: Dict[str, _Accumulator] = dict()
+        samples = await find_samples(
+            timed_task_id, hour, hour + timedelta(hours=1) - timedelta(milliseconds=1), include_hidden=True
+        )
+        for sample in samples:
+            _accumulate(metrics, sample)
+        summary_collect: AgnosticCollection = AsyncMongoClient[SUMMARY_COLLECT]
+        await summary_collect.update_one(
+            {"timedTaskID": timed_task_id, "period": PERIOD_HOUR, "start": hour},
+            {"$set": {"metrics": _metrics_document(metrics), "updateTime": datetime.now()}},
+            upsert=True
+        )
+        cls.recomputed_hours += 1
+
+    @classmethod
+    async def _recompute_run(cls, timed_task_id: PyandticObjectId):
+        """整个运行期间的汇总等于所有小时汇总之和，在flush锁内执行，期间本进程不会有新的$inc"""
+        summary_collect: AgnosticCollection = AsyncMongoClient[SUMMARY_COLLECT]
+        metrics = _merge_summary_docs(
+            await summary_collect.find({"timedTaskID": timed_task_id, "period": PERIOD_HOUR}).to_list(None)
+        )
+        await summary_collect.update_one(
+            {"timedTaskID": timed_task_id, "period": PERIOD_RUN, "start": None},
+            {"$set": {"metrics": _metrics_document(metrics), "updateTime": datetime.now()}},
+            upsert=True
+        )
+
+    @classmethod
+    def _requeue(cls, bucket_key: _BucketKey, metrics: Dict[str, _Accumulator]):
+        current = cls._pending.setdefault(bucket_key, dict())
+        for name, acc in metrics.items():
+            if name in current:
+                current[name].merge(acc)
+            else:
+                current[name] = acc
+
+    @classmethod
+    async def close(cls):
+        if cls._flush_task is not None:
+            cls._flush_task.cancel()
+            cls._flush_task = None
+        await cls.flush()
+
+
+def _merge_summary_docs(docs: List[dict]) -> Dict[str, _Accumulator]:
+    merged: Dict[str, _Accumulator] = dict()
+    for doc in docs:
+        for name, data in doc.get("metrics", {}).items():
+            acc = merged.setdefault(name, _Accumulator())
+            acc.count += data.get("count", 0)
+            acc.sum += data.get("sum", 0)
+            acc.sum_sq += data.get("sumSq", 0)
+            acc.min = min(acc.min, data.get("min", math.inf))
+            acc.max = max(acc.max, data.get("max", -math.inf))
+            for key, count in data.get("sketch", {}).items():
+                acc.bins[key] = acc.bins.get(key, 0) + count
+    return merged
+
+
+def _summary_from_docs(docs) -> dict:
+    merged = _merge_summary_docs(docs)
+    result = dict()
+    for name in SUMMARY_METRICS:
+        acc = merged.get(name)
+        if acc is None or acc.count == 0:
+            result[name] = None
+            continue
+        mean = acc.sum / acc.count
+        sketch = DDSketch(_sketch.relative_accuracy, _sketch.min_value)
+        sketch.merge_bins(acc.bins)
+        p50, p95, p99 = sketch.quantiles(SUMMARY_PERCENTILES)
+        result[name] = {
+            "count": acc.count,
+            "mean": mean,
+            "std": math.sqrt(max(acc.sum_sq / acc.count - mean * mean, 0)),
+            "min": acc.min,
+            "max": acc.max,
+            "p50": p50,
+            "p95": p95,
+            "p99": p99,
+        }
+    return result
+
+
+async def get_sample_summary(
+        timed_task_id: PyandticObjectId,
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None
+) -> dict:
+    """
+    不传时间时直接读取整个运行期间的汇总文档
+    传了时间时合并窗口内每小时的汇总，窗口按整点对齐
+    """
+    summary_collect: AgnosticCollection = AsyncMongoClient[SUMMARY_COLLECT]
+    if start_time is None and end_time is None:
+        docs = await summary_collect.find(
+            {"timedTaskID": timed_task_id, "period": PERIOD_RUN}
+        ).to_list(None)
+    else:
+        start_range = dict()
+        if start_time is not None:
+            start_range["$gte"] = start_time.replace(minute=0, second=0, microsecond=0)
+        if end_time is not None:
+            start_range["$lt"] = end_time
+        docs = await summary_collect.find(
+            {"timedTaskID": timed_task_id, "period": PERIOD_HOUR, "start": start_range}
+        ).to_list(None)
+    return {
+        "hours": len(docs) if start_time is not None or end_time is not None else None,
+        "metrics": _summary_from_docs(docs),
+    }
@@ -1,73 +1,89 @@
+import asyncio
+import math
 import traceback
-from typing import cast
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple, cast
 
-from fastapi import APIRouter, Query
+import numpy as np
+from fastapi import APIRouter, Query, Path
 from motor.core import AgnosticCollection
 
+from server.model import ResponseCode
 from server.timedTask.model import *
-from server.timedTask.util import get_task_id, get_device_cpu_and_mem
+from server.timedTask.util import (
+    apply_timed_task_operations,
+    get_next_run_times,
+    get_recent_samples,
+    timed_task_info_cache,
+    timed_task_search_cache,
+)
+from server.timedTask.aggregate import get_sample_summary
+from server.timedTask.archive import (
+    archived_until,
+    find_archive_manifests,
+    load_archived_columns,
+    load_manifest_samples,
+    manifest_shown_count,
+)
+from server.timedTask.report import get_report
+from server.timedTask.sample_storage import first_record_time, sample_collect, sample_collect_name, sample_pipeline
+from server.timedTask.stats import get_sample_stats, closed_window_stats_cache
 from server.util import response_data_format
+from utils.cache import make_cache_key
 from utils.mongo_client import AsyncMongoClient
-from utils.scheduler import Scheduler
+from utils.tracing import TracedRoute, span
 
-router = APIRouter()
+router = APIRouter(route_class=TracedRoute)
 
-class ResponseCode:
-    NO_PERMIT = -1
-    SUCCESS = 0
-    GENERAL_FAULT = 1
+_OPERATE_NAME = {
+    TimedTaskOperate.ADD: "添加",
+    TimedTaskOperate.EDIT: "编辑",
+    TimedTaskOperate.STOP: "停止",
+    TimedTaskOperate.PAUSE: "暂停",
+    TimedTaskOperate.DELETE: "删除",
+    TimedTaskOperate.RESUME: "恢复",
+}
 
 
 @router.post("/timedTask", summary="操作定时任务")
 async def operate_timed_task(request: TimedTaskOperateModel):
-    timed_task_collect = cast(AgnosticCollection, AsyncMongoClient["timed_task_collect"])
     response = {
         "code": ResponseCode.GENERAL_FAULT,
         "msg": None,
         "data": None
     }
     try:
-        if request.operate == TimedTaskOperate.ADD:
-            task_id = get_task_id(request.timedTaskKind)
-            timed_task_data = TimedTaskModel(
-                taskID=task_id,
-                **request.model_dump(exclude={"taskID", }, by_alias=True)
-            )
-            new_timed_task = await timed_task_collect.insert_one(timed_task_data.model_dump(by_alias=True))
-            timed_task_id = new_timed_task.inserted_id
-            return_data = await timed_task_collect.find_one({
-                "_id": timed_task_id, "isShow": True
-            }, projection={'_id': False, "isShow": False})
-            try:
-                if request.timedTaskKind == TimedTaskKind.CPU_MEM_RECORD:
-                    if request.interval is not None:
-                        Scheduler.add_job(
-                            get_device_cpu_and_mem,
-                            "interval", _id=task_id,
-                            seconds=request.interval,
-                            start_date=request.planRunTime[0],
-                            end_date=request.planRunTime[1],
-                            args=(
-                                timed_task_id, task_id, request.objIP,
-                                request.loginUser, request.loginPassword,
-                                request.sshUser, request.sshPassword
-                            )
-                        )
-                    else:
-                        ...
-            except Exception as e:
-                await timed_task_collect.find_one_and_update(
-                    {"_id": timed_task_id}, {"$set": {"isShow": False}})
-                raise Exception(e)
-            response["code"] = ResponseCode.SUCCESS
-            response["msg"] = f"{request.taskName}添加成功！"
-            response['data'] = response_data_format(return_data)
+        result = (await apply_timed_task_operations([request]))[0]
+        if not result["success"]:
+            raise Exception(result["msg"])
+        response["code"] = ResponseCode.SUCCESS
+        response["msg"] = f"{result['data']['taskName']}{_OPERATE_NAME[request.operate]}成功！"
+        response['data'] = response_data_format(result["data"])
     except Exception as e:
         print(traceback.format_exc())
         response['msg'] = f'操作定时任务数据失败：{e}'
     return response
 
 
+@router.post("/timedTask/bulk", summary="批量操作定时任务")
+async def bulk_operate_timed_task(request: BulkTimedTaskOperateModel):
+    response = {
+        "code": ResponseCode.GENERAL_FAULT,
+        "msg": None,
+        "data": None
+    }
+    try:
+        results = await apply_timed_task_operations(request.operations)
+        success_count = sum(1 for result in results if result["success"])
+        response["code"] = ResponseCode.SUCCESS
+        response["msg"] = f"成功{success_count}个，失败{len(results) - success_count}个"
+        response['data'] = response_data_format(results)
+    except Exception as e:
+        print(traceback.format_exc())
+        response['msg'] = f'批量操作定时任务失败：{e}'
+    return response
+
+
 @router.post("/timedTask/search", summary="查询现有的定时任务")
 async def search_timed_task(request: GetTimedTaskModel):
     timed_task_collect = cast(AgnosticCollection, AsyncMongoClient["timed_task_collect"])
@@ -127,18 +143,60 @@ async def search_timed_task(request: GetTimedTaskModel):
         ]
         if request.timed_task_id:
             default_query_dict["$match"]["_id"] = request.timed_task_id
-        datas = await timed_task_collect.aggregate(aggregate_conditions).to_list(None)
-        if len(datas) == 0:
-            raise Exception("查询数据异常！")
+
+        async def _search():
+            datas = await timed_task_collect.aggregate(aggregate_conditions).to_list(None)
+            if len(datas) == 0:
+                raise Exception("查询数据异常！")
+            return datas[0]
+
+        data = await timed_task_search_cache.get_or_load(
+            make_cache_key("search", request.model_dump(by_alias=True)), _search
+        )
+        # 下次执行时间随时间变化，不放进缓存
+        response["data"] = response_data_format({
+            **data,
+            "list": [{**item, "nextRunTimes": get_next_run_times(item)} for item in data["list"]]
+        })
         response["code"] = ResponseCode.SUCCESS
         response["msg"] = '获取定时任务数据成功'
-        response["data"] = response_data_format(datas[0])
     except Exception as e:
         print(traceback.format_exc())
         response['msg'] = '获取定时任务数据失败:' + str(e)
     return response
 
 
+async def _archived_page(
+        manifests: List[dict],
+        start_time: Optional[datetime],
+        end_time: Optional[datetime],
+        fields: Optional[List[str]],
+        skip: int,
+        limit: int
+) -> Tuple[int, List[dict]]:
+    """
+    归档部分按recordTime降序分页，返回归档的总条数和跳过skip条之后的最多limit条
+    整个在时间范围内的文件直接用manifest里的条数，只读取跨过边界的文件和这一页用到的文件
+    """
+    total = 0
+    page = []
+    # 一个任务的manifest按天升序、时间范围不重叠，倒过来就是降序
+    for manifest in reversed(manifests):
+        count = manifest_shown_count(manifest, start_time, end_time)
+        documents = None
+        if count is None:
+            documents = await load_manifest_samples(manifest, start_time, end_time, fields)
+            count = len(documents)
+        offset = max(skip - total, 0)
+        if offset < count and len(page) < limit:
+            if documents is None:
+                documents = await load_manifest_samples(manifest, start_time, end_time, fields)
+            documents.reverse()
+            page.extend(documents[offset:offset + limit - len(page)])
+        total += count
+    return total, page
+
+
 @router.post('/timedTask/detail', summary="查看定时任务详情")
 async def get_timed_task_detail(
         *,
@@ -152,14 +210,18 @@ async def get_timed_task_detail(
         "data": None
     }
     try:
-        time_interval_dict = []
+        # 已经归档到minio的部分不在mongodb里查，mongodb只查归档到的时间之后
+        with span("archive_manifests"):
+            manifests = await find_archive_manifests(timed_task_id, request.start_time, request.end_time)
+        sample_start = request.start_time
+        if until := archived_until(manifests).get(timed_task_id):
+            until += timedelta(milliseconds=1)
+            sample_start = max(sample_start, until) if sample_start else until
         time_record_dict = []
-        if request.startTime:
-            time_record_dict.append({"$gte": ["$operateTime", request.startTime]})
-            time_interval_dict.append({"$gte": ["$recordTime", request.startTime]})
-        if request.endTime:
-            time_record_dict.append({"$lte": ["$operateTime", request.endTime]})
-            time_interval_dict.append({"$lte": ["$recordTime", request.endTime]})
+        if request.start_time:
+            time_record_dict.append({"$gte": ["$operateTime", request.start_time]})
+        if request.end_time:
+            time_record_dict.append({"$lte": ["$operateTime", request.end_time]})
 
         default_query_dict = {
             "$match": {
@@ -235,17 +297,8 @@ async def get_timed_task_detail(
                         'timedTaskID': '$_id'
                     },
                     'pipeline': [
-                        {
-                            '$match': {
-                                '$expr': {
-                                    '$and': [
-                                        {'$eq': ['$$timedTaskID', '$timedTaskID']},
-                                        {'$eq': [True, '$isShow']},
-                                        *time_interval_dict
-                                    ]
-                                }
-                            }
-                        },
+                        # 只查一个任务，直接用常量条件，和存储方式无关
+                        *sample_pipeline(timed_task_id, sample_start, request.end_time, request.fields),
                         {'$sort': {'recordTime': -1}},
                         {
                             '$project': {
@@ -296,18 +349,16 @@ async def get_timed_task_detail(
             }
         }
 
-        task_info = await timed_task_collect.find_one(
-            {"_id": timed_task_id, "isShow": True}
-        )
+        with span("find_one"):
+            task_info = await timed_task_info_cache.get_or_load(
+                str(timed_task_id),
+                lambda: timed_task_collect.find_one({"_id": timed_task_id, "isShow": True})
+            )
         if task_info is None:
             raise Exception("未找到该定时任务")
         result_collect_name: str
         if task_info["timedTaskKind"] == TimedTaskKind.CPU_MEM_RECORD:
-            result_lookup_dict[0]["$lookup"]["from"] = "timed_task_dev_cpu_mem_collect"
-            result_lookup_dict[0]["$lookup"]["pipeline"].pop()
-            result_lookup_dict.pop()
-            result_lookup_dict.pop()
-            result_lookup_dict[0]["$lookup"]["pipeline"][1]["$sort"]["recordTime"] = 1
+            result_lookup_dict[0]["$lookup"]["from"] = sample_collect_name()
         else:
             raise Exception("暂时只有设备运行状况类型定时任务结果")
 
@@ -318,13 +369,252 @@ async def get_timed_task_detail(
             project_dict
         ]
         print(aggregates_conditions)
-        datas = await timed_task_collect.aggregate(aggregates_conditions).to_list(None)
+        with span("aggregate"):
+            analytics_collect = AsyncMongoClient.analytics("timed_task_collect")
+            datas = await analytics_collect.aggregate(aggregates_conditions).to_list(None)
         if len(datas) == 0:
             raise Exception('获取数据异常，请联系113')
+        # 按recordTime降序时归档的部分都排在mongodb的后面，两部分合起来分页
+        if manifests:
+            sample_total = datas[0].get("resultsTotal") or 0
+            results = datas[0].get("results") or []
+            with span("archive"):
+                archived_total, archived = await _archived_page(
+                    manifests, request.start_time, request.end_time, request.fields,
+                    max((request.result_page - 1) * request.result_limit - sample_total, 0),
+                    request.result_limit - len(results)
+                )
+            datas[0]["resultsTotal"] = sample_total + archived_total
+            datas[0]["results"] = results + archived
+        response["code"] = ResponseCode.SUCCESS
+        response["msg"] = '获取定时任务数据成功'
+        with span("format"):
+            response["data"] = response_data_format(datas[0])
+    except Exception as e:
+        print(traceback.format_exc())
+        response['msg'] = '定时任务数据查询失败:' + str(e)
+    return response
+
+
+@router.post('/timedTask/recent', summary="查看定时任务最近的运行状况")
+async def get_timed_task_recent(
+        *,
+        timed_task_id: PyandticObjectId = Query(..., alias="timedTaskID"),
+        request: GetTimedTaskRecentModel
+):
+    response = {
+        "code": ResponseCode.GENERAL_FAULT,
+        "msg": None,
+        "data": None
+    }
+    try:
+        datas = await get_recent_samples(
+            timed_task_id, last_n=request.last_n, last_seconds=request.last_seconds, fields=request.fields
+        )
         response["code"] = ResponseCode.SUCCESS
         response["msg"] = '获取定时任务数据成功'
-        response["data"] = response_data_format(datas[0])
+        response["data"] = response_data_format({"total": len(datas), "results": datas})
     except Exception as e:
         print(traceback.format_exc())
         response['msg'] = '定时任务数据查询失败:' + str(e)
     return response
+
+
+def _add_archived_buckets(
+        sums: Dict[str, np.ndarray],
+        counts: Dict[str, np.ndarray],
+        columns: Dict[str, np.ndarray],
+        start_time: datetime,
+        bucket_ms: int
+):
+    """把归档的采样按时间桶累加到sums、counts，nan不计数"""
+    bucket_count = len(next(iter(sums.values())))
+    offsets = (columns["recordTime"] - np.datetime64(start_time, "ms")).astype(np.int64)
+    buckets = np.minimum(offsets // bucket_ms, bucket_count - 1)
+    for name in sums:
+        valid = ~np.isnan(columns[name])
+        sums[name] += np.bincount(buckets[valid], weights=columns[name][valid], minlength=bucket_count)
+        counts[name] += np.bincount(buckets[valid], minlength=bucket_count)
+
+
+@router.post('/timedTask/compare', summary="多个定时任务的运行状况对比")
+async def compare_timed_task(request: CompareTimedTaskModel):
+    timed_task_collect = cast(AgnosticCollection, AsyncMongoClient["timed_task_collect"])
+    response = {
+        "code": ResponseCode.GENERAL_FAULT,
+        "msg": None,
+        "data": None
+    }
+    try:
+        timed_task_ids = list(dict.fromkeys(request.timed_task_ids))
+        start_time, end_time = request.start_time, request.end_time or datetime.now()
+        manifests = await find_archive_manifests(timed_task_ids, start_time, end_time)
+        if start_time is None:
+            first_times = [manifest["start"] for manifest in manifests]
+            first_times.append(await first_record_time(timed_task_ids))
+            start_time = min((t for t in first_times if t is not None), default=end_time)
+        # 所有任务使用同一套时间桶，保证返回的序列是对齐的
+        bucket_ms = max(math.ceil((end_time - start_time).total_seconds() * 1000 / request.max_points), 1000)
+        bucket_count = max(math.ceil((end_time - start_time).total_seconds() * 1000 / bucket_ms), 1)
+        columns = request.fields or DEV_CPU_MEM_COLUMNS
+
+        # 有归档数据的任务，mongodb只查归档之后的部分，按查询的开始时间分组
+        until = archived_until(manifests)
+        id_groups: Dict[datetime, List[PyandticObjectId]] = {}
+        for _id in timed_task_ids:
+            task_start = max(start_time, until[_id] + timedelta(milliseconds=1)) if _id in until else start_time
+            id_groups.setdefault(task_start, []).append(_id)
+        # 返回和、个数而不是平均值，才能和归档的部分合并
+        group_stage = {
+            "$group": {
+                "_id": {
+                    "timedTaskID": "$timedTaskID",
+                    "bucket": {"$floor": {"$divide": [{"$subtract": ["$recordTime", start_time]}, bucket_ms]}}
+                },
+                **{name: {"$sum": f"${name}"} for name in columns},
+                **{f"{name}Count": {"$sum": {"$cond": [{"$isNumber": f"${name}"}, 1, 0]}} for name in columns}
+            }
+        }
+        analytics_collect = sample_collect(analytics=True)
+        task_infos, archived, *group_datas = await asyncio.gather(
+            timed_task_collect.find(
+                {"_id": {"$in": timed_task_ids}, "isShow": True},
+                projection={"taskName": True, "taskID": True, "objIP": True}
+            ).to_list(None),
+            load_archived_columns(manifests, start_time, end_time, columns),
+            *(
+                analytics_collect.aggregate(
+                    [*sample_pipeline(ids, task_start, end_time, request.fields), group_stage]
+                ).to_list(None)
+                for task_start, ids in id_groups.items()
+            )
+        )
+        sums = {
+            task_info["_id"]: {name: np.zeros(bucket_count) for name in columns} for task_info in task_infos
+        }
+        counts = {
+            task_info["_id"]: {name: np.zeros(bucket_count, dtype=np.int64) for name in columns}
+            for task_info in task_infos
+        }
+        for datas in group_datas:
+            for data in datas:
+                _id = data["_id"]["timedTaskID"]
+                if _id not in sums:
+                    continue
+                bucket = min(int(data["_id"]["bucket"]), bucket_count - 1)
+                for name in columns:
+                    sums[_id][name][bucket] += data[name]
+                    counts[_id][name][bucket] += data[f"{name}Count"]
+        for _id, task_columns in archived.items():
+            if _id in sums:
+                _add_archived_buckets(sums[_id], counts[_id], task_columns, start_time, bucket_ms)
+        series = {
+            task_info["_id"]: {
+                "timedTaskID": task_info["_id"],
+                "taskID": task_info.get("taskID"),
+                "taskName": task_info.get("taskName"),
+                "objIP": task_info.get("objIP"),
+                **{
+                    name: [
+                        float(total) / int(count) if count else None
+                        for total, count in zip(sums[task_info["_id"]][name], counts[task_info["_id"]][name])
+                    ]
+                    for name in columns
+                }
+            } for task_info in task_infos
+        }
+        response["code"] = ResponseCode.SUCCESS
+        response["msg"] = '获取定时任务对比数据成功'
+        response["data"] = response_data_format({
+            "startTime": start_time,
+            "endTime": end_time,
+            "bucketSeconds": bucket_ms / 1000,
+            "times": [start_time + timedelta(milliseconds=bucket_ms * i) for i in range(bucket_count)],
+            "series": [series[_id] for _id in timed_task_ids if _id in series],
+        })
+    except Exception as e:
+        print(traceback.format_exc())
+        response['msg'] = '定时任务对比数据查询失败:' + str(e)
+    return response
+
+
+@router.post('/timedTask/{timedTaskID}/stats', summary="统计定时任务时间窗口内的运行状况")
+async def get_timed_task_stats(
+        *,
+        timed_task_id: PyandticObjectId = Path(..., alias="timedTaskID"),
+        request: GetTimedTaskStatsModel
+):
+    response = {
+        "code": ResponseCode.GENERAL_FAULT,
+        "msg": None,
+        "data": None
+    }
+    try:
+        datas = await get_sample_stats(timed_task_id, request.start_time, request.end_time)
+        response["code"] = ResponseCode.SUCCESS
+        response["msg"] = '获取定时任务统计成功'
+        response["data"] = datas
+    except Exception as e:
+        print(traceback.format_exc())
+        response['msg'] = '定时任务统计失败:' + str(e)
+    return response
+
+
+@router.post('/timedTask/{timedTaskID}/summary', summary="读取定时任务增量维护的汇总")
+async def get_timed_task_summary(
+        *,
+        timed_task_id: PyandticObjectId = Path(..., alias="timedTaskID"),
+        request: GetTimedTaskStatsModel
+):
+    response = {
+        "code": ResponseCode.GENERAL_FAULT,
+        "msg": None,
+        "data": None
+    }
+    try:
+        datas = await get_sample_summary(timed_task_id, request.start_time, request.end_time)
+        response["code"] = ResponseCode.SUCCESS
+        response["msg"] = '获取定时任务汇总成功'
+        response["data"] = datas
+    except Exception as e:
+        print(traceback.format_exc())
+        response['msg'] = '定时任务汇总查询失败:' + str(e)
+    return response
+
+
+@router.post('/timedTask/report', summary="所有设备按小时、按天的运行状况报表")
+async def get_timed_task_report(request: TimedTaskReportModel):
+    response = {
+        "code": ResponseCode.GENERAL_FAULT,
+        "msg": None,
+        "data": None
+    }
+    try:
+        end_time = request.end_time or datetime.now()
+        start_time = request.start_time or end_time - timedelta(days=90)
+        datas = await get_report(request.period, start_time, end_time, request.timed_task_ids, request.per_task)
+        response["code"] = ResponseCode.SUCCESS
+        response["msg"] = '获取报表成功'
+        response["data"] = response_data_format({
+            "period": request.period,
+            "startTime": start_time,
+            "endTime": end_time,
+            "results": datas,
+        })
+    except Exception as e:
+        print(traceback.format_exc())
+        response['msg'] = '报表查询失败:' + str(e)
+    return response
+
+
+@router.get("/timedTask/cache/stats", summary="定时任务查询缓存的命中情况")
+async def get_timed_task_cache_stats():
+    return {
+        "code": ResponseCode.SUCCESS,
+        "msg": "获取缓存统计成功",
+        "data": [
+            timed_task_search_cache.stats(),
+            timed_task_info_cache.stats(),
+            closed_window_stats_cache.stats(),
+        ]
+    }
@@ -0,0 +1,317 @@
+"""
+采样数据分层保存：超过保留天数的采样按任务、按天压缩成列式文件放到minio，并从mongodb删除
+每个文件在manifest集合里有一条记录（时间范围、条数、对象名、压缩方式），查询时根据manifest把归档的部分读回来
+文件为np.savez的npz（recordTime为datetime64[ms]，其他列为float64，isShow为bool），整体再用zstd压缩，没有安装zstandard时用zlib
+"""
+import asyncio
+import traceback
+import zlib
+from datetime import datetime, timedelta
+from io import BytesIO
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from motor.core import AgnosticCollection
+
+from config import Config
+from server.model import PyandticObjectId
+from server.timedTask.model import DEV_CPU_MEM_COLUMNS
+from server.timedTask.sample_storage import TimedTaskIDs, delete_samples, find_samples, first_record_time
+from utils.metrics import REGISTRY
+from utils.minio_client import async_minio_client
+from utils.mongo_client import AsyncMongoClient
+from utils.scheduler import job_lock
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ARCHIVE_COLLECT = "timed_task_dev_cpu_mem_archive_collect"
+CODEC = "zstd" if zstandard is not None else "zlib"
+ARCHIVE_COLUMNS = ("recordTime", "isShow", *DEV_CPU_MEM_COLUMNS)
+# 查询时同时下载的归档文件数
+_READ_CONCURRENCY = 8
+
+ARCHIVED_SAMPLES = REGISTRY.counter("sample_archived_total", "归档到minio并从mongodb删除的采样点数")
+
+
+def compress(data: bytes, codec: str = CODEC) -> bytes:
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=10).compress(data)
+    return zlib.compress(data, 6)
+
+
+def decompress(data: bytes, codec: str) -> bytes:
+    if codec == "zstd":
+        if zstandard is None:
+            raise Exception("归档文件使用zstd压缩，需要安装zstandard")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+def samples_to_columns(samples: List[dict]) -> Dict[str, np.ndarray]:
+    columns = {
+        "recordTime": np.array([sample["recordTime"] for sample in samples], dtype="datetime64[ms]"),
+        "isShow": np.array([sample.get("isShow", True) for sample in samples], dtype=bool),
+    }
+    for name in DEV_CPU_MEM_COLUMNS:
+        # 缺失的值存成nan
+        columns[name] = np.array([sample.get(name) for sample in samples], dtype=np.float64)
+    return columns
+
+
+def merge_columns(*parts: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    """合并多份列数据，按recordTime排序，同一时间的重复点只保留一个"""
+    merged = {name: np.concatenate([part[name] for part in parts]) for name in ARCHIVE_COLUMNS}
+    _, index = np.unique(merged["recordTime"], return_index=True)
+    return {name: column[index] for name, column in merged.items()}
+
+
+def encode_columns(columns: Dict[str, np.ndarray], task_id: str, codec: str = CODEC) -> bytes:
+    buffer = BytesIO()
+    np.savez(buffer, taskID=np.array(task_id), **columns)
+    return compress(buffer.getvalue(), codec)
+
+
+def decode_columns(data: bytes, codec: str) -> Dict[str, np.ndarray]:
+    with np.load(BytesIO(decompress(data, codec)), allow_pickle=False) as npz:
+        return {name: npz[name] for name in npz.files}
+
+
+def select_columns(
+        columns: Dict[str, np.ndarray],
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None,
+        fields: Optional[Sequence[str]] = None
+) -> Dict[str, np.ndarray]:
+    """只保留isShow为True且在时间范围内的点，返回recordTime和fields（为空时为所有采样列）"""
+    times = columns["recordTime"]
+    mask = columns["isShow"].copy()
+    if start_time is not None:
+        mask &= times >= np.datetime64(start_time, "ms")
+    if end_time is not None:
+        mask &= times <= np.datetime64(end_time, "ms")
+    return {name: columns[name][mask] for name in ("recordTime", *(fields or DEV_CPU_MEM_COLUMNS))}
+
+
+def columns_to_documents(
+        columns: Dict[str, np.ndarray],
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None,
+        fields: Optional[Sequence[str]] = None
+) -> List[dict]:
+    """
+    转成和采样集合一样的文档（不含_id、isShow、timedTaskID），只保留isShow为True且在时间范围内的点
+    :param fields: 只转换这些列
+    """
+    names = fields or DEV_CPU_MEM_COLUMNS
+    selected = select_columns(columns, start_time, end_time, names)
+    values = []
+    for name in names:
+        column = selected[name]
+        rows = column.tolist()
+        if np.isnan(column).any():
+            rows = [None if value != value else value for value in rows]
+        values.append(rows)
+    task_id = str(columns["taskID"])
+    return [
+        {"taskID": task_id, "recordTime": record_time, **dict(zip(names, row))}
+        for record_time, *row in zip(selected["recordTime"].astype("datetime64[us]").tolist(), *values)
+    ]
+
+
+def _object_name(timed_task_id: PyandticObjectId, day: datetime) -> str:
+    return f"{timed_task_id}/{day:%Y%m%d}.npz.{CODEC}"
+
+
+async def _load_manifest(manifest: dict) -> Dict[str, np.ndarray]:
+    data = await async_minio_client.get_bytes(Config.SAMPLE_ARCHIVE_BUCKET, manifest["objectName"])
+    # 解压、解析放到线程里，避免大文件阻塞事件循环
+    return await asyncio.to_thread(decode_columns, data, manifest["codec"])
+
+
+class SampleArchiver:
+    """按任务、按天把早于保留期限的采样归档到minio"""
+    _bucket_ready: bool = False
+
+    @classmethod
+    async def _ensure_bucket(cls):
+        if not cls._bucket_ready:
+            await async_minio_client.ensure_bucket(Config.SAMPLE_ARCHIVE_BUCKET)
+            cls._bucket_ready = True
+
+    @classmethod
+    async def archive_task(cls, task: dict, now: Optional[datetime] = None) -> int:
+        """
+        归档一个任务早于保留期限的采样，期限按天对齐
+        :param task: 定时任务文档，archiveAfterDays为空时使用Config.SAMPLE_ARCHIVE_DAYS，为0时不归档
+        :return: 归档的采样点数
+        """
+        days = task.get("archiveAfterDays")
+        if days is None:
+            days = Config.SAMPLE_ARCHIVE_DAYS
+        if not days:
+            return 0
+        cutoff = ((now or datetime.now()) - timedelta(days=days)).replace(hour=0, minute=0, second=0, microsecond=0)
+        archived = 0
+        while True:
+            # 通过索引直接跳到下一个有数据的一天
+            first = await first_record_time(task["_id"], before=cutoff)
+            if first is None:
+                return archived
+            day = first.replace(hour=0, minute=0, second=0, microsecond=0)
+            archived += await cls.archive_day(task, day, min(day + timedelta(days=1), cutoff))
+
+    @classmethod
+    async def archive_day(cls, task: dict, day: datetime, day_end: datetime) -> int:
+        """
+        先上传文件、写manifest，最后才删除mongodb中的采样，中途失败重新执行时会和已有的文件合并
+        """
+        await cls._ensure_bucket()
+        archive_collect: AgnosticCollection = AsyncMongoClient[ARCHIVE_COLLECT]
+        # day、day_end都是整点，bucket存储时正好是整桶
+        samples = [
+            sample for sample in await find_samples(task["_id"], day, day_end, include_hidden=True)
+            if sample["recordTime"] < day_end
+        ]
+        if len(samples) == 0:
+            await delete_samples(task["_id"], day, day_end)
+            return 0
+        columns = samples_to_columns(samples)
+        manifest = await archive_collect.find_one({"timedTaskID": task["_id"], "day": day})
+        if manifest is not None:
+            columns = merge_columns(await _load_manifest(manifest), columns)
+        task_id = samples[0].get("taskID") or task.get("taskID")
+        data = await asyncio.to_thread(encode_columns, columns, task_id)
+        object_name = _object_name(task["_id"], day)
+        await async_minio_client.put_bytes(Config.SAMPLE_ARCHIVE_BUCKET, object_name, data)
+        times = columns["recordTime"]
+        await archive_collect.update_one(
+            {"timedTaskID": task["_id"], "day": day},
+            {"$set": {
+                "taskID": task_id,
+                "start": times[0].astype("datetime64[us]").item(),
+                "end": times[-1].astype("datetime64[us]").item(),
+                "count": len(times),
+                "shownCount": int(np.count_nonzero(columns["isShow"])),
+                "objectName": object_name,
+                "codec": CODEC,
+                "size": len(data),
+                "updateTime": datetime.now(),
+            }},
+            upsert=True
+        )
+        # 压缩方式变了时对象名也变了，删掉旧文件
+        if manifest is not None and manifest["objectName"] != object_name:
+            await async_minio_client.remove_object(Config.SAMPLE_ARCHIVE_BUCKET, manifest["objectName"])
+        await delete_samples(task["_id"], day, day_end)
+        ARCHIVED_SAMPLES.inc(amount=len(samples))
+        return len(samples)
+
+
+@job_lock(expire_after_seconds=Config.SAMPLE_ARCHIVE_INTERVAL)
+async def archive_old_samples():
+    """定时执行：遍历需要归档的任务，单个任务失败不影响其他任务"""
+    timed_task_collect: AgnosticCollection = AsyncMongoClient["timed_task_collect"]
+    if Config.SAMPLE_ARCHIVE_DAYS:
+        query = {"archiveAfterDays": {"$ne": 0}}
+    else:
+        query = {"archiveAfterDays": {"$gt": 0}}
+    now = datetime.now()
+    total = 0
+    async for task in timed_task_collect.find(query, projection={"taskID": True, "archiveAfterDays": True}):
+        try:
+            total += await SampleArchiver.archive_task(task, now)
+        except Exception:
+            print(traceback.format_exc())
+    print(f"归档采样{total}条，耗时{(datetime.now() - now).total_seconds():.1f}秒")
+
+
+async def find_archive_manifests(
+        timed_task_ids: TimedTaskIDs,
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None
+) -> List[dict]:
+    """时间范围内有归档数据的manifest，按天升序"""
+    archive_collect: AgnosticCollection = AsyncMongoClient[ARCHIVE_COLLECT]
+    query = {}
+    if isinstance(timed_task_ids, (list, tuple, set)):
+        query["timedTaskID"] = {"$in": list(timed_task_ids)}
+    elif timed_task_ids is not None:
+        query["timedTaskID"] = timed_task_ids
+    if start_time is not None:
+        query["end"] = {"$gte": start_time}
+    if end_time is not None:
+        query["start"] = {"$lte": end_time}
+    return await archive_collect.find(query).sort("day", 1).to_list(None)
+
+
+def archive_version(manifests: List[dict]) -> Optional[Tuple[int, datetime]]:
+    """manifest的数量和最后更新时间，归档之后会变化，用作缓存key的一部分"""
+    if len(manifests) == 0:
+        return None
+    return len(manifests), max(manifest["updateTime"] for manifest in manifests)
+
+
+def archived_until(manifests: List[dict]) -> Dict[PyandticObjectId, datetime]:
+    """
+    每个任务归档到的最后时间
+    归档时先写manifest再删除mongodb里的采样，读取时mongodb只查这个时间之后的部分，避免中途重复统计
+    归档之后才写入的迟到采样会在下一次归档时合并到文件里
+    """
+    result = {}
+    for manifest in manifests:
+        task_id = manifest["timedTaskID"]
+        if task_id not in result or manifest["end"] > result[task_id]:
+            result[task_id] = manifest["end"]
+    return result
+
+
+async def load_archived_columns(
+        manifests: List[dict],
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None,
+        fields: Optional[Sequence[str]] = None
+) -> Dict[PyandticObjectId, Dict[str, np.ndarray]]:
+    """按任务读取manifest对应的归档文件，返回按recordTime升序的列数据（recordTime和fields）"""
+    semaphore = asyncio.Semaphore(_READ_CONCURRENCY)
+
+    async def _load(manifest: dict) -> Dict[str, np.ndarray]:
+        async with semaphore:
+            columns = await _load_manifest(manifest)
+        return select_columns(columns, start_time, end_time, fields)
+
+    parts: Dict[PyandticObjectId, List[Dict[str, np.ndarray]]] = {}
+    for manifest, columns in zip(manifests, await asyncio.gather(*(_load(manifest) for manifest in manifests))):
+        parts.setdefault(manifest["timedTaskID"], []).append(columns)
+    return {
+        task_id: {name: np.concatenate([part[name] for part in task_parts]) for name in task_parts[0]}
+        for task_id, task_parts in parts.items()
+    }
+
+
+def manifest_shown_count(
+        manifest: dict,
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None
+) -> Optional[int]:
+    """
+    整个文件都在时间范围内时，不读取文件直接返回isShow为True的条数
+    文件跨过时间范围的边界、或者是没有记录shownCount的旧manifest时返回None，需要读取文件才知道
+    """
+    if start_time is not None and manifest["start"] < start_time:
+        return None
+    if end_time is not None and manifest["end"] > end_time:
+        return None
+    return manifest.get("shownCount")
+
+
+async def load_manifest_samples(
+        manifest: dict,
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None,
+        fields: Optional[Sequence[str]] = None
+) -> List[dict]:
+    """读取一个归档文件里时间范围内的采样，按recordTime升序"""
+    return columns_to_documents(await _load_manifest(manifest), start_time, end_time, fields)
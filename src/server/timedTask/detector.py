@@ -0,0 +1,151 @@
+import math
+from typing import Dict, List, Optional
+
+from config import Config
+
+
+class _StreamingSlope:
+    """
+    带遗忘因子的流式线性回归，每个点O(1)更新，斜率反映最近大约 1 / (1 - decay) 个点的趋势
+    x为距第一个点的小时数，斜率单位为 每小时的变化量
+    """
+    __slots__ = ("decay", "origin", "n", "sx", "sy", "sxx", "sxy")
+
+    def __init__(self, decay: float):
+        self.decay = decay
+        self.origin: Optional[float] = None
+        self.n = self.sx = self.sy = self.sxx = self.sxy = 0.0
+
+    def add(self, ts: float, y: float):
+        if self.origin is None:
+            self.origin = ts
+        x = (ts - self.origin) / 3600
+        d = self.decay
+        self.n = d * self.n + 1
+        self.sx = d * self.sx + x
+        self.sy = d * self.sy + y
+        self.sxx = d * self.sxx + x * x
+        self.sxy = d * self.sxy + x * y
+
+    @property
+    def slope(self) -> Optional[float]:
+        denominator = self.n * self.sxx - self.sx * self.sx
+        if self.n < 2 or denominator <= 1e-12:
+            return None
+        return (self.n * self.sxy - self.sx * self.sy) / denominator
+
+
+class _Cusum:
+    """
+    双边CUSUM变点检测，均值和方差用EWMA估计，检测到变点后以新的水平重新开始
+    """
+    __slots__ = ("alpha", "drift", "threshold", "warmup", "count", "mean", "var", "pos", "neg")
+
+    def __init__(self, alpha: float, drift: float, threshold: float, warmup: int):
+        self.alpha = alpha
+        self.drift = drift
+        self.threshold = threshold
+        self.warmup = warmup
+        self.count = 0
+        self.mean = 0.0
+        self.var = 0.0
+        self.pos = 0.0
+        self.neg = 0.0
+
+    def add(self, value: float) -> Optional[str]:
+        self.count += 1
+        if self.count == 1:
+            self.mean = value
+            return None
+        std = math.sqrt(self.var) or 1e-3
+        change = None
+        if self.count > self.warmup:
+            z = (value - self.mean) / std
+            self.pos = max(0.0, self.pos + z - self.drift)
+            self.neg = max(0.0, self.neg - z - self.drift)
+            if self.pos > self.threshold:
+                change = "up"
+            elif self.neg > self.threshold:
+                change = "down"
+        diff = value - self.mean
+        self.mean += self.alpha * diff
+        self.var = (1 - self.alpha) * (self.var + self.alpha * diff * diff)
+        if change is not None:
+            self.mean, self.var, self.pos, self.neg = value, 0.0, 0.0, 0.0
+            self.count = 1
+        return change
+
+
+class _TaskState:
+    __slots__ = ("free_mem", "swpd_mem", "cpu", "samples", "last_flag")
+
+    def __init__(self):
+        self.free_mem = _StreamingSlope(TaskAnomalyDetector.slope_decay)
+        self.swpd_mem = _StreamingSlope(TaskAnomalyDetector.slope_decay)
+        self.cpu = _Cusum(
+            TaskAnomalyDetector.cpu_ewma_alpha, TaskAnomalyDetector.cpu_cusum_drift,
+            TaskAnomalyDetector.cpu_cusum_threshold, TaskAnomalyDetector.min_samples
+        )
+        self.samples = 0
+        self.last_flag: Dict[str, float] = dict()
+
+
+class TaskAnomalyDetector:
+    """
+    每个定时任务一份状态，每个采样点O(1)更新：
+    - freeMem持续下降、swpdMem持续增长时认为疑似内存泄漏
+    - cpu使用率（1 - idCpu）用CUSUM检测突变
+    同一类异常在cooldown时间内只报一次
+    """
+    slope_decay: float = Config.DETECTOR_SLOPE_DECAY
+    min_samples: int = Config.DETECTOR_MIN_SAMPLES
+    free_mem_slope_threshold: float = Config.DETECTOR_FREE_MEM_SLOPE  # KB/小时，小于 -该值时报警
+    swpd_mem_slope_threshold: float = Config.DETECTOR_SWPD_MEM_SLOPE  # KB/小时，大于该值时报警
+    cpu_ewma_alpha: float = 0.05
+    cpu_cusum_drift: float = 0.5
+    cpu_cusum_threshold: float = 8.0
+    cooldown: float = Config.DETECTOR_COOLDOWN
+
+    _states: Dict[str, _TaskState] = dict()
+
+    @classmethod
+    def feed(cls, key: str, ts: float, sample: dict) -> List[str]:
+        """
+        :param key: str(timedTaskID)
+        :param ts: 采样时间戳
+        :param sample: 采样数据，字段名为alias
+        :return: 本次新发现的异常描述
+        """
+        state = cls._states.get(key)
+        if state is None:
+            state = cls._states[key] = _TaskState()
+        state.samples += 1
+        anomalies = []
+
+        free_mem, swpd_mem, id_cpu = sample.get("freeMem"), sample.get("swpdMem"), sample.get("idCpu")
+        if free_mem is not None:
+            state.free_mem.add(ts, free_mem)
+        if swpd_mem is not None:
+            state.swpd_mem.add(ts, swpd_mem)
+        if id_cpu is not None and (change := state.cpu.add(1 - id_cpu)) is not None:
+            anomalies.append(("cpu", f"cpu使用率发生突变（{'升高' if change == 'up' else '降低'}），当前为{1 - id_cpu:.2%}"))
+
+        if state.samples >= cls.min_samples:
+            free_slope, swpd_slope = state.free_mem.slope, state.swpd_mem.slope
+            if free_slope is not None and free_slope < -cls.free_mem_slope_threshold:
+                anomalies.append(("freeMem", f"疑似内存泄漏：空闲内存持续下降，约{free_slope:.0f}KB/小时"))
+            if swpd_slope is not None and swpd_slope > cls.swpd_mem_slope_threshold and swpd_mem:
+                anomalies.append(("swpdMem", f"疑似内存泄漏：交换内存持续增长，约{swpd_slope:.0f}KB/小时"))
+
+        result = []
+        for kind, message in anomalies:
+            last = state.last_flag.get(kind)
+            if last is not None and ts - last < cls.cooldown:
+                continue
+            state.last_flag[kind] = ts
+            result.append(message)
+        return result
+
+    @classmethod
+    def drop(cls, key: str):
+        cls._states.pop(key, None)
@@ -1,8 +1,9 @@
 from datetime import datetime
 from enum import auto, IntEnum
-from typing import Optional, List, Tuple
+from typing import Optional, List, Literal, Tuple
 
-from pydantic import field_validator, BaseModel, Field
+from apscheduler.triggers.cron import CronTrigger
+from pydantic import field_validator, model_validator, BaseModel, Field
 
 from server.util import get_current_time_and_num
 from server.model import PyandticObjectId
@@ -18,15 +19,18 @@ class TimedTaskOperate(IntEnum):
     STOP = 2
     PAUSE = 3
     DELETE = 4
+    RESUME = 5
 
 
 class TaskStatus(IntEnum):
-    """0:待执行 1:执行完成 2:执行异常 3:已删除 4:执行错过"""
+    """0:待执行 1:执行完成 2:执行异常 3:已删除 4:执行错过 5:已暂停 6:已停止"""
     PENDING = 0
     COMPLETED = 1
     ERROR = 2
     DELETED = 3
     MISSED = 4
+    PAUSED = 5
+    STOPPED = 6
 
 
 class TimedTaskModel(BaseModel):
@@ -48,11 +52,19 @@ class TimedTaskModel(BaseModel):
     obj_ip: Optional[str] = Field(description="对象ip", default=None, alias="objIP")
     obj_ssh_user: Optional[str] = Field(description="ssh用户名", default=None, alias="objSshUser")
     obj_ssh_password: Optional[str] = Field(description="ssh密码", default=None, alias="objSshPassword")
+    obj_ssh_port: int = Field(description="ssh端口", default=22, ge=1, le=65535, alias="objSshPort")
 
     crontab: Optional[str] = Field(description="crontab表达式", default=None)
     interval: Optional[int] = Field(description="执行时间间隔", default=None)
     plan_execute_time: Optional[Tuple[datetime, datetime]] = Field(
         description="计划执行时间区间", default=None, alias="planExecuteTime")
+    coalesce: bool = Field(description="错过的多次执行是否合并成一次", default=True)
+    max_instances: int = Field(description="同时运行的最大实例数", default=1, ge=1, alias="maxInstances")
+    misfire_grace_time: Optional[int] = Field(
+        description="错过执行时间多少秒内仍然执行，为空时不限制", default=60, ge=1, alias="misfireGraceTime")
+    archive_after_days: Optional[int] = Field(
+        description="采样在mongodb保留的天数，超过的归档到minio，0为不归档，为空时使用默认配置",
+        default=None, ge=0, alias="archiveAfterDays")
 
     is_show: bool = Field(description="是否存在", default=True, alias="isShow")
 
@@ -63,6 +75,15 @@ class TimedTaskModel(BaseModel):
         except Exception as _:
             return value
 
+    @field_validator("crontab")
+    def crontab_check(cls, value: Optional[str]):
+        if value is not None:
+            try:
+                CronTrigger.from_crontab(value)
+            except ValueError as e:
+                raise ValueError(f"crontab表达式错误：{e}")
+        return value
+
     @field_validator("plan_execute_time")
     def double_time_check(cls, values):
         try:
@@ -93,6 +114,23 @@ class TimedTaskSysRecordModel(BaseModel):
             return value
 
 
+# 设备运行状况的数值列，和TimedTaskDevCPUAndMEMModel的alias一致
+DEV_CPU_MEM_COLUMNS = (
+    "freeMem", "swpdMem", "buffMem", "cacheMem", "biIo", "boIo",
+    "usCpu", "syCpu", "waCpu", "stCpu", "idCpu",
+)
+
+
+def check_sample_fields(fields: Optional[List[str]]) -> Optional[List[str]]:
+    """请求里的fields只能是采样的列，去重后保持顺序，为空时返回全部列"""
+    if not fields:
+        return None
+    unknown = [field for field in fields if field not in DEV_CPU_MEM_COLUMNS]
+    if unknown:
+        raise ValueError(f"不支持的字段：{','.join(unknown)}，可选：{','.join(DEV_CPU_MEM_COLUMNS)}")
+    return list(dict.fromkeys(fields))
+
+
 class TimedTaskDevCPUAndMEMModel(BaseModel):
     task_id: str = Field(description="任务id", alias="taskID")
     record_time: Optional[datetime] = Field(description="记录时间", default_factory=datetime.now, alias="recordTime")
@@ -124,8 +162,107 @@ class TimedTaskDevCPUAndMEMModel(BaseModel):
             return value
 
 
+class DevCPUAndMEMSample:
+    """
+    采集热路径上使用的轻量记录，不做pydantic校验，字段含义同TimedTaskDevCPUAndMEMModel
+    record_time为本地时间（无时区），和模型校验之后的结果一致
+    """
+    __slots__ = (
+        "task_id", "timed_task_id", "record_time",
+        "free_mem", "swpd_mem", "buff_mem", "cache_mem", "bi_io", "bo_io",
+        "us_cpu", "sy_cpu", "wa_cpu", "st_cpu", "id_cpu",
+    )
+
+    def __init__(
+            self, task_id: str, timed_task_id, record_time: datetime,
+            free_mem: float, swpd_mem: float, buff_mem: float, cache_mem: float, bi_io: float, bo_io: float,
+            us_cpu: float, sy_cpu: float, wa_cpu: float, st_cpu: float, id_cpu: float
+    ):
+        self.task_id = task_id
+        self.timed_task_id = timed_task_id
+        self.record_time = record_time
+        self.free_mem = free_mem
+        self.swpd_mem = swpd_mem
+        self.buff_mem = buff_mem
+        self.cache_mem = cache_mem
+        self.bi_io = bi_io
+        self.bo_io = bo_io
+        self.us_cpu = us_cpu
+        self.sy_cpu = sy_cpu
+        self.wa_cpu = wa_cpu
+        self.st_cpu = st_cpu
+        self.id_cpu = id_cpu
+
+    def to_document(self) -> dict:
+        """转成写入mongodb的文档，字段名为alias"""
+        return {
+            "taskID": self.task_id,
+            "recordTime": self.record_time,
+            "freeMem": self.free_mem,
+            "swpdMem": self.swpd_mem,
+            "buffMem": self.buff_mem,
+            "cacheMem": self.cache_mem,
+            "biIo": self.bi_io,
+            "boIo": self.bo_io,
+            "usCpu": self.us_cpu,
+            "syCpu": self.sy_cpu,
+            "waCpu": self.wa_cpu,
+            "stCpu": self.st_cpu,
+            "idCpu": self.id_cpu,
+            "timedTaskID": self.timed_task_id,
+            "isShow": True,
+        }
+
+
+VMSTAT_COMMAND = "vmstat | awk 'NR==3 {print $3,$4,$5,$6,$9,$10,$13,$14,$15,$16,$17}'"
+
+
+def _vmstat_fields(recv: str) -> List[float]:
+    # 通过终端执行时返回的内容里还有回显的命令和提示符，取第一行全是数字的
+    for line in recv.splitlines():
+        fields = line.split()
+        if len(fields) == 11:
+            try:
+                return list(map(float, fields))
+            except ValueError:
+                continue
+    raise ValueError(f"无法解析vmstat的输出：{recv!r}")
+
+
+def parse_vmstat_sample(recv: str, timed_task_id, task_id: str) -> DevCPUAndMEMSample:
+    """
+    解析VMSTAT_COMMAND的输出
+    顺序为 swpd free buff cache bi bo us sy id wa st，cpu换算成小数
+    """
+    swpd_mem, free_mem, buff_mem, cache_mem, bi_io, bo_io, us_cpu, sy_cpu, id_cpu, wa_cpu, st_cpu = \
+        _vmstat_fields(recv)
+    return DevCPUAndMEMSample(
+        task_id, timed_task_id, datetime.now(),
+        free_mem, swpd_mem, buff_mem, cache_mem, bi_io, bo_io,
+        us_cpu / 100, sy_cpu / 100, wa_cpu / 100, st_cpu / 100, id_cpu / 100
+    )
+
+
 class TimedTaskOperateModel(TimedTaskModel):
+    """
+    新增时taskName、timedTaskKind必填；其他操作通过taskID指定任务，编辑时只修改传了的字段
+    """
     operate: TimedTaskOperate = Field(description="操作类型")
+    task_name: Optional[str] = Field(description="任务名称", default=None, alias="taskName")
+    timedTaskKind: Optional[TimedTaskKind] = Field(description="任务类型", default=None)
+
+    @model_validator(mode="after")
+    def check_operate(self):
+        if self.operate == TimedTaskOperate.ADD:
+            if self.task_name is None or self.timedTaskKind is None:
+                raise ValueError("新增定时任务时taskName和timedTaskKind不能为空")
+        elif self.task_id is None:
+            raise ValueError("taskID不能为空")
+        return self
+
+
+class BulkTimedTaskOperateModel(BaseModel):
+    operations: List[TimedTaskOperateModel] = Field(description="批量操作", min_length=1, max_length=1000)
 
 
 class GetTimedTaskModel(BaseModel):
@@ -143,6 +280,78 @@ class GetTimedTaskDetailModel(BaseModel):
     record_limit: int = Field(description="单页显示的条数", ge=1, alias="recordLimit")
     result_page: int = Field(description="result要查询的页数", ge=1, alias="resultPage")
     result_limit: int = Field(description="result单页显示的条数", ge=1, alias="resultLimit")
+    fields: Optional[List[str]] = Field(
+        description="只返回这些采样字段（recordTime总是返回），为空时返回全部", default=None)
+
+    @field_validator("start_time", "end_time")
+    def check(cls, value: datetime):
+        try:
+            return value.astimezone().replace(tzinfo=None)
+        except Exception as _:
+            return value
+
+    @field_validator("fields")
+    def check_fields(cls, value: Optional[List[str]]):
+        return check_sample_fields(value)
+
+
+class GetTimedTaskRecentModel(BaseModel):
+    last_n: Optional[int] = Field(description="最近的N个点", default=None, ge=1, alias="lastN")
+    last_seconds: Optional[float] = Field(description="最近T秒内的点", default=None, gt=0, alias="lastSeconds")
+    fields: Optional[List[str]] = Field(
+        description="只返回这些采样字段（recordTime总是返回），为空时返回全部", default=None)
+
+    @field_validator("fields")
+    def check_fields(cls, value: Optional[List[str]]):
+        return check_sample_fields(value)
+
+    @model_validator(mode="after")
+    def check(self):
+        if (self.last_n is None) == (self.last_seconds is None):
+            raise ValueError("lastN和lastSeconds必须且只能传一个")
+        return self
+
+
+class GetTimedTaskStatsModel(BaseModel):
+    start_time: Optional[datetime] = Field(description='开始时间', default=None, alias="startTime")
+    end_time: Optional[datetime] = Field(description='结束时间', default=None, alias="endTime")
+
+    @field_validator("start_time", "end_time")
+    def check(cls, value: datetime):
+        try:
+            return value.astimezone().replace(tzinfo=None)
+        except Exception as _:
+            return value
+
+
+class CompareTimedTaskModel(BaseModel):
+    timed_task_ids: List[PyandticObjectId] = Field(
+        description="要对比的定时任务ID", min_length=1, max_length=50, alias="timedTaskIDs")
+    start_time: Optional[datetime] = Field(description='开始时间', default=None, alias="startTime")
+    end_time: Optional[datetime] = Field(description='结束时间', default=None, alias="endTime")
+    max_points: int = Field(description="每个任务最多返回的点数", default=500, ge=2, le=5000, alias="maxPoints")
+    fields: Optional[List[str]] = Field(
+        description="只返回这些采样字段（recordTime总是返回），为空时返回全部", default=None)
+
+    @field_validator("start_time", "end_time")
+    def check(cls, value: datetime):
+        try:
+            return value.astimezone().replace(tzinfo=None)
+        except Exception as _:
+            return value
+
+    @field_validator("fields")
+    def check_fields(cls, value: Optional[List[str]]):
+        return check_sample_fields(value)
+
+
+class TimedTaskReportModel(BaseModel):
+    period: Literal["hour", "day"] = Field(description="汇总粒度", default="day")
+    start_time: Optional[datetime] = Field(description='开始时间，默认为结束时间前90天', default=None, alias="startTime")
+    end_time: Optional[datetime] = Field(description='结束时间，默认为当前时间', default=None, alias="endTime")
+    timed_task_ids: Optional[List[PyandticObjectId]] = Field(
+        description="只统计这些定时任务，为空时统计全部", default=None, max_length=1000, alias="timedTaskIDs")
+    per_task: bool = Field(description="是否按任务分别返回，否则所有任务合并", default=False, alias="perTask")
 
     @field_validator("start_time", "end_time")
     def check(cls, value: datetime):
@@ -0,0 +1,266 @@
+"""
+报表用的预汇总：定时从原始采样按任务、按小时$merge到汇总集合，再从小时汇总$merge出按天的汇总
+只处理水位之后已经结束的小时，每处理完一段就推进水位，中途失败下次从水位继续
+迟到的采样：每次都重新汇总水位之前REPORT_ROLLUP_LOOKBACK_HOURS个小时；
+磁盘缓冲回放等更晚写入的采样通过mark_dirty在水位文档上记录最早的dirtyFrom，下次从那里开始重新汇总
+报表接口只读汇总集合，不会扫描原始采样
+"""
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from motor.core import AgnosticCollection
+
+from config import Config
+from server.model import PyandticObjectId
+from server.timedTask.aggregate import SUMMARY_METRICS
+from server.timedTask.sample_storage import first_record_time, sample_collect, sample_pipeline
+from utils.mongo_client import AsyncMongoClient
+from utils.scheduler import job_lock
+
+REPORT_COLLECT = "timed_task_dev_cpu_mem_report_collect"
+WATERMARK_COLLECT = "job_watermark"
+WATERMARK_ID = "timed_task_report"
+
+PERIOD_HOUR = "hour"
+PERIOD_DAY = "day"
+_PERIOD_MS = {PERIOD_HOUR: 3600 * 1000, PERIOD_DAY: 24 * 3600 * 1000}
+_EPOCH = datetime(1970, 1, 1)
+
+
+def _metric_expr(name: str):
+    # cpu为派生指标：1 - idCpu
+    return {"$subtract": [1, "$idCpu"]} if name == "cpu" else f"${name}"
+
+
+def _truncate_expr(field: str, period: str) -> dict:
+    """按小时、天取整，不依赖$dateTrunc（5.0才支持），两个日期相减得到毫秒数"""
+    return {"$subtract": [field, {"$mod": [{"$subtract": [field, _EPOCH]}, _PERIOD_MS[period]]}]}
+
+
+def _merge_stage() -> dict:
+    return {
+        "$merge": {
+            "into": REPORT_COLLECT,
+            "on": ["timedTaskID", "period", "start"],
+            "whenMatched": "replace",
+            "whenNotMatched": "insert",
+        }
+    }
+
+
+def hour_rollup_pipeline(start: datetime, end: datetime) -> List[dict]:
+    """[start, end)内的原始采样按任务、小时汇总，整小时重新计算，重复执行结果不变"""
+    return [
+        *sample_pipeline(None, start, end - timedelta(milliseconds=1)),
+        {
+            "$group": {
+                "_id": {"timedTaskID": "$timedTaskID", "start": _truncate_expr("$recordTime", PERIOD_HOUR)},
+                "count": {"$sum": 1},
+                **{
+                    f"{name}{suffix}": {op: _metric_expr(name)}
+                    for name in SUMMARY_METRICS
+                    for suffix, op in (("Sum", "$sum"), ("Min", "$min"), ("Max", "$max"))
+                },
+            }
+        },
+        {
+            "$project": {
+                "_id": 0,
+                "timedTaskID": "$_id.timedTaskID",
+                "period": {"$literal": PERIOD_HOUR},
+                "start": "$_id.start",
+                "count": 1,
+                "updateTime": "$$NOW",
+                **{
+                    name: {"sum": f"${name}Sum", "min": f"${name}Min", "max": f"${name}Max"}
+                    for name in SUMMARY_METRICS
+                },
+            }
+        },
+        _merge_stage(),
+    ]
+
+
+def day_rollup_pipeline(start: datetime, end: datetime) -> List[dict]:
+    """[start, end)内的天由小时汇总合并出来，start、end需要是0点"""
+    return [
+        {"$match": {"period": PERIOD_HOUR, "start": {"$gte": start, "$lt": end}}},
+        {
+            "$group": {
+                "_id": {"timedTaskID": "$timedTaskID", "start": _truncate_expr("$start", PERIOD_DAY)},
+                "count": {"$sum": "$count"},
+                **{
+                    f"{name}{suffix}": {op: f"${name}.{field}"}
+                    for name in SUMMARY_METRICS
+                    for suffix, op, field in (("Sum", "$sum", "sum"), ("Min", "$min", "min"), ("Max", "$max", "max"))
+                },
+            }
+        },
+        {
+            "$project": {
+                "_id": 0,
+                "timedTaskID": "$_id.timedTaskID",
+                "period": {"$literal": PERIOD_DAY},
+                "start": "$_id.start",
+                "count": 1,
+                "updateTime": "$$NOW",
+                **{
+                    name: {"sum": f"${name}Sum", "min": f"${name}Min", "max": f"${name}Max"}
+                    for name in SUMMARY_METRICS
+                },
+            }
+        },
+        _merge_stage(),
+    ]
+
+
+def _floor_hour(value: datetime) -> datetime:
+    return value.replace(minute=0, second=0, microsecond=0)
+
+
+def _floor_day(value: datetime) -> datetime:
+    return value.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+class ReportRollup:
+    """按水位增量汇总，水位为下一个需要汇总的小时"""
+
+    @classmethod
+    async def get_watermark(cls) -> Optional[datetime]:
+        watermark_collect: AgnosticCollection = AsyncMongoClient[WATERMARK_COLLECT]
+        doc = await watermark_collect.find_one({"_id": WATERMARK_ID})
+        return doc.get("hour") if doc is not None else None
+
+    @classmethod
+    async def mark_dirty(cls, record_time: datetime):
+        """record_time所在的小时及之后需要重新汇总，多次标记时保留最早的"""
+        watermark_collect: AgnosticCollection = AsyncMongoClient[WATERMARK_COLLECT]
+        await watermark_collect.update_one(
+            {"_id": WATERMARK_ID}, {"$min": {"dirtyFrom": _floor_hour(record_time)}}, upsert=True
+        )
+
+    @classmethod
+    async def mark_samples_dirty(cls, samples: List[dict]):
+        """BatchWriter的on_replay：回放的采样可能早于水位"""
+        times = [sample["recordTime"] for sample in samples if sample.get("recordTime") is not None]
+        if times:
+            await cls.mark_dirty(min(times))
+
+    @classmethod
+    async def _take_dirty(cls) -> Optional[datetime]:
+        """取出并清除dirtyFrom，处理期间新的标记会重新写入，不会丢失"""
+        watermark_collect: AgnosticCollection = AsyncMongoClient[WATERMARK_COLLECT]
+        doc = await watermark_collect.find_one_and_update(
+            {"_id": WATERMARK_ID, "dirtyFrom": {"$exists": True}}, {"$unset": {"dirtyFrom": ""}}
+        )
+        return doc["dirtyFrom"] if doc is not None else None
+
+    @classmethod
+    async def set_watermark(cls, hour: datetime):
+        watermark_collect: AgnosticCollection = AsyncMongoClient[WATERMARK_COLLECT]
+        await watermark_collect.update_one(
+            {"_id": WATERMARK_ID}, {"$set": {"hour": hour, "updateTime": datetime.now()}}, upsert=True
+        )
+
+    @classmethod
+    async def run(cls, now: Optional[datetime] = None) -> int:
+        """
+        汇总水位到(当前时间 - REPORT_ROLLUP_DELAY)之间已经结束的小时，最多REPORT_ROLLUP_MAX_HOURS个小时，
+        同时重新汇总水位之前REPORT_ROLLUP_LOOKBACK_HOURS个小时和dirtyFrom之后的小时
+        :return: 处理的小时数
+        """
+        upto = _floor_hour((now or datetime.now()) - timedelta(seconds=Config.REPORT_ROLLUP_DELAY))
+        watermark = await cls.get_watermark()
+        dirty_from = await cls._take_dirty()
+        if watermark is None:
+            first = await first_record_time(None)
+            if first is None:
+                return 0
+            watermark = _floor_hour(first)
+            dirty_from = None
+        upto = min(upto, watermark + timedelta(hours=Config.REPORT_ROLLUP_MAX_HOURS))
+        hour = watermark - timedelta(hours=Config.REPORT_ROLLUP_LOOKBACK_HOURS)
+        if dirty_from is not None:
+            hour = min(hour, dirty_from)
+        processed = 0
+        report_collect: AgnosticCollection = AsyncMongoClient[REPORT_COLLECT]
+        # 按天分段，每段处理完推进一次水位
+        try:
+            while hour < upto:
+                chunk_end = min(_floor_day(hour) + timedelta(days=1), upto)
+                await sample_collect().aggregate(hour_rollup_pipeline(hour, chunk_end)).to_list(None)
+                # 这一天已经汇总的小时重新合并成天，当天还没结束时天汇总也只包含已经结束的小时
+                day = _floor_day(hour)
+                await report_collect.aggregate(day_rollup_pipeline(day, day + timedelta(days=1))).to_list(None)
+                processed += int((chunk_end - hour).total_seconds() // 3600)
+                hour = chunk_end
+                if hour > watermark:
+                    watermark = hour
+                    await cls.set_watermark(watermark)
+        except Exception:
+            # 水位之前还没重新汇总的部分下次继续
+            if hour < watermark:
+                await cls.mark_dirty(hour)
+            raise
+        return processed
+
+
+@job_lock(expire_after_seconds=Config.REPORT_ROLLUP_INTERVAL)
+async def rollup_report():
+    start = datetime.now()
+    hours = await ReportRollup.run()
+    if hours:
+        print(f"报表汇总{hours}个小时，耗时{(datetime.now() - start).total_seconds():.1f}秒")
+
+
+async def get_report(
+        period: str,
+        start_time: datetime,
+        end_time: datetime,
+        timed_task_ids: Optional[List[PyandticObjectId]] = None,
+        per_task: bool = False
+) -> List[dict]:
+    """
+    读取汇总集合：per_task为False时把同一时间段所有任务合并成一个点，否则每个任务一个序列
+    每个指标返回mean、min、max
+    """
+    match = {"period": period, "start": {"$gte": start_time, "$lte": end_time}}
+    if timed_task_ids:
+        match["timedTaskID"] = {"$in": timed_task_ids}
+    group_id = {"start": "$start"}
+    if per_task:
+        group_id["timedTaskID"] = "$timedTaskID"
+    pipeline = [
+        {"$match": match},
+        {
+            "$group": {
+                "_id": group_id,
+                "count": {"$sum": "$count"},
+                "tasks": {"$sum": 1},
+                **{
+                    f"{name}{suffix}": {op: f"${name}.{field}"}
+                    for name in SUMMARY_METRICS
+                    for suffix, op, field in (("Sum", "$sum", "sum"), ("Min", "$min", "min"), ("Max", "$max", "max"))
+                },
+            }
+        },
+        {
+            "$project": {
+                "_id": 0,
+                "start": "$_id.start",
+                **({"timedTaskID": "$_id.timedTaskID"} if per_task else {"tasks": 1}),
+                "count": 1,
+                **{
+                    name: {
+                        "mean": {"$cond": [{"$gt": ["$count", 0]}, {"$divide": [f"${name}Sum", "$count"]}, None]},
+                        "min": f"${name}Min",
+                        "max": f"${name}Max",
+                    }
+                    for name in SUMMARY_METRICS
+                },
+            }
+        },
+        {"$sort": {"timedTaskID": 1, "start": 1} if per_task else {"start": 1}},
+    ]
+    report_collect: AgnosticCollection = AsyncMongoClient.analytics(REPORT_COLLECT)
+    return await report_collect.aggregate(pipeline).to_list(None)
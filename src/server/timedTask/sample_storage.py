@@ -0,0 +1,375 @@
+"""
+设备运行状况采样的两种存储方式，由Config.SAMPLE_STORAGE选择
+- document：每个采样点一个文档（timed_task_dev_cpu_mem_collect）
+- bucket：每个任务每小时一个或多个桶文档（timed_task_dev_cpu_mem_bucket_collect），每个桶最多SAMPLE_BUCKET_SIZE个点，
+  各列是平行的数组，写入时用$push + $inc upsert追加，文档数、索引条目数比document少两三个数量级
+读取统一通过sample_pipeline得到和document方式一样的采样文档，调用方在后面接自己的$sort、$group等阶段
+"""
+import os
+import traceback
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+from bson import ObjectId
+from motor.core import AgnosticCollection
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from config import Config
+from server.model import PyandticObjectId
+from server.timedTask.model import DEV_CPU_MEM_COLUMNS
+from utils.batch_writer import BatchWriter
+from utils.mongo_client import AsyncMongoClient
+from utils.spool import DiskSpool
+
+SAMPLE_COLLECT = "timed_task_dev_cpu_mem_collect"
+BUCKET_COLLECT = "timed_task_dev_cpu_mem_bucket_collect"
+# 桶里的平行数组，顺序决定$zip之后的下标
+BUCKET_COLUMNS = ("recordTime", *DEV_CPU_MEM_COLUMNS)
+
+# 为None时表示所有任务
+TimedTaskIDs = Optional[Union[PyandticObjectId, Sequence[PyandticObjectId]]]
+
+
+def is_bucket() -> bool:
+    return Config.SAMPLE_STORAGE == "bucket"
+
+
+def sample_collect_name() -> str:
+    return BUCKET_COLLECT if is_bucket() else SAMPLE_COLLECT
+
+
+def sample_collect(analytics: bool = False) -> AgnosticCollection:
+    """:param analytics: 只读的分析查询，使用MONGO_ANALYTICS_READ_PREFERENCE"""
+    if analytics:
+        return AsyncMongoClient.analytics(sample_collect_name())
+    return AsyncMongoClient[sample_collect_name()]
+
+
+def _bucket_start(record_time: datetime) -> datetime:
+    return record_time.replace(minute=0, second=0, microsecond=0)
+
+
+def _id_match(timed_task_ids: TimedTaskIDs) -> dict:
+    if timed_task_ids is None:
+        return {}
+    if isinstance(timed_task_ids, (list, tuple, set)):
+        return {"timedTaskID": {"$in": list(timed_task_ids)}}
+    return {"timedTaskID": timed_task_ids}
+
+
+def _time_range(start_time: Optional[datetime], end_time: Optional[datetime]) -> dict:
+    time_range = dict()
+    if start_time is not None:
+        time_range["$gte"] = start_time
+    if end_time is not None:
+        time_range["$lte"] = end_time
+    return time_range
+
+
+def _bucket_match(timed_task_ids: TimedTaskIDs, start_time: Optional[datetime], end_time: Optional[datetime]) -> dict:
+    """桶里的点都在start所在的一小时内，按start过滤可以用(timedTaskID, start)索引，边界上的桶展开后再过滤"""
+    match = {**_id_match(timed_task_ids), "isShow": True}
+    start_range = dict()
+    if start_time is not None:
+        start_range["$gte"] = _bucket_start(start_time)
+    if end_time is not None:
+        start_range["$lte"] = end_time
+    if start_range:
+        match["start"] = start_range
+    return match
+
+
+def _bucket_columns(fields: Optional[Sequence[str]]) -> Tuple[str, ...]:
+    return ("recordTime", *fields) if fields else BUCKET_COLUMNS
+
+
+def sample_pipeline(
+        timed_task_ids: TimedTaskIDs,
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None,
+        fields: Optional[Sequence[str]] = None
+) -> List[dict]:
+    """
+    读取采样的公共前缀，输出的文档包含timedTaskID、taskID、recordTime和各列，不保证顺序
+    :param fields: 只输出这些列，bucket方式下其他列的数组不会被展开
+    """
+    time_range = _time_range(start_time, end_time)
+    if not is_bucket():
+        match = {**_id_match(timed_task_ids), "isShow": True}
+        if time_range:
+            match["recordTime"] = time_range
+        pipeline = [{"$match": match}]
+        if fields:
+            pipeline.append({
+                "$project": {"timedTaskID": 1, "taskID": 1, "recordTime": 1, **{name: 1 for name in fields}}
+            })
+        return pipeline
+    columns = _bucket_columns(fields)
+    pipeline = [
+        {"$match": _bucket_match(timed_task_ids, start_time, end_time)},
+        {
+            "$project": {
+                "_id": 0, "timedTaskID": 1, "taskID": 1,
+                "sample": {"$zip": {"inputs": [f"${name}" for name in columns]}}
+            }
+        },
+        {"$unwind": "$sample"},
+        {
+            "$project": {
+                "timedTaskID": 1, "taskID": 1,
+                **{name: {"$arrayElemAt": ["$sample", index]} for index, name in enumerate(columns)}
+            }
+        },
+    ]
+    if time_range:
+        pipeline.append({"$match": {"recordTime": time_range}})
+    return pipeline
+
+
+def unroll_bucket(bucket: dict, columns: Sequence[str] = BUCKET_COLUMNS) -> List[dict]:
+    task_id = bucket.get("taskID")
+    return [
+        {"taskID": task_id, **dict(zip(columns, row))}
+        for row in zip(*(bucket[name] for name in columns))
+    ]
+
+
+async def find_samples(
+        timed_task_id: PyandticObjectId,
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None,
+        last_n: Optional[int] = None,
+        include_hidden: bool = False,
+        fields: Optional[Sequence[str]] = None
+) -> List[dict]:
+    """
+    一个任务时间范围内的采样（不含_id、isShow、timedTaskID），按recordTime升序
+    :param last_n: 只取最新的n个点
+    :param include_hidden: 同时返回isShow为False的点，这时结果里带isShow
+    :param fields: 只返回这些列
+    """
+    collect = sample_collect()
+    if not is_bucket():
+        query = {"timedTaskID": timed_task_id}
+        if not include_hidden:
+            query["isShow"] = True
+        if time_range := _time_range(start_time, end_time):
+            query["recordTime"] = time_range
+        if fields:
+            projection = {"_id": False, "taskID": True, "recordTime": True, **{name: True for name in fields}}
+            if include_hidden:
+                projection["isShow"] = True
+        else:
+            projection = {"_id": False, "timedTaskID": False}
+            if not include_hidden:
+                projection["isShow"] = False
+        cursor = collect.find(query, projection=projection)
+        if last_n is None:
+            return await cursor.sort("recordTime", 1).to_list(None)
+        datas = await cursor.sort("recordTime", -1).limit(last_n).to_list(None)
+        datas.reverse()
+        return datas
+
+    query = _bucket_match(timed_task_id, start_time, end_time)
+    if include_hidden:
+        query.pop("isShow")
+    columns = _bucket_columns(fields)
+    projection = {"taskID": True, **{name: True for name in columns}}
+    if include_hidden:
+        projection["isShow"] = True
+    cursor = collect.find(query, projection=projection)
+    datas = []
+    # 取最新的n个点时从最新的桶往前取，够n个点就停
+    async for bucket in cursor.sort("start", 1 if last_n is None else -1):
+        for sample in unroll_bucket(bucket, columns):
+            if _in_range(sample["recordTime"], start_time, end_time):
+                if include_hidden:
+                    sample["isShow"] = bucket.get("isShow", True)
+                datas.append(sample)
+        if last_n is not None and len(datas) >= last_n:
+            break
+    datas.sort(key=lambda x: x["recordTime"])
+    return datas[-last_n:] if last_n is not None else datas
+
+
+def _in_range(record_time: datetime, start_time: Optional[datetime], end_time: Optional[datetime]) -> bool:
+    return (start_time is None or record_time >= start_time) and (end_time is None or record_time <= end_time)
+
+
+async def first_record_time(
+        timed_task_ids: TimedTaskIDs,
+        before: Optional[datetime] = None
+) -> Optional[datetime]:
+    """最早的采样时间，before不为空时只看这个时间之前的（bucket方式按桶比较，before需要是整点）"""
+    collect = sample_collect()
+    if not is_bucket():
+        query = {**_id_match(timed_task_ids), "isShow": True}
+        if before is not None:
+            query["recordTime"] = {"$lt": before}
+        first = await collect.find_one(query, projection={"recordTime": True}, sort=[("recordTime", 1)])
+        return first["recordTime"] if first is not None else None
+    query = {**_id_match(timed_task_ids), "isShow": True}
+    if before is not None:
+        query["start"] = {"$lt": before}
+    # 同一小时可能有多个桶，第一个桶里的minTime不一定是最小的
+    first = await collect.find_one(query, projection={"start": True}, sort=[("start", 1)])
+    if first is None:
+        return None
+    buckets = await collect.find(
+        {**query, "start": first["start"]}, projection={"minTime": True}
+    ).to_list(None)
+    return min(bucket["minTime"] for bucket in buckets)
+
+
+async def count_samples(timed_task_id: PyandticObjectId) -> int:
+    if not is_bucket():
+        return await sample_collect().count_documents({"timedTaskID": timed_task_id, "isShow": True})
+    datas = await sample_collect().aggregate([
+        {"$match": {"timedTaskID": timed_task_id, "isShow": True}},
+        {"$group": {"_id": None, "count": {"$sum": "$count"}}},
+    ]).to_list(None)
+    return datas[0]["count"] if datas else 0
+
+
+async def delete_samples(timed_task_id: PyandticObjectId, start_time: datetime, end_time: datetime):
+    """
+    删除[start_time, end_time)内的采样
+    bucket方式按桶删除，两个时间都需要是整点，否则会多删或者少删
+    """
+    if not is_bucket():
+        await sample_collect().delete_many(
+            {"timedTaskID": timed_task_id, "recordTime": {"$gte": start_time, "$lt": end_time}}
+        )
+    else:
+        await sample_collect().delete_many(
+            {"timedTaskID": timed_task_id, "start": {"$gte": start_time, "$lt": end_time}}
+        )
+
+
+_BucketKey = Tuple[PyandticObjectId, datetime]
+
+
+def group_into_buckets(samples: List[dict]) -> Dict[_BucketKey, List[dict]]:
+    groups: Dict[_BucketKey, List[dict]] = defaultdict(list)
+    for sample in samples:
+        groups[(sample["timedTaskID"], _bucket_start(sample["recordTime"]))].append(sample)
+    return groups
+
+
+def bucket_update(key: _BucketKey, samples: List[dict], bucket_size: int) -> UpdateOne:
+    """
+    追加到这个小时还没满的桶，没有时新建一个
+    一次追加多个点时桶可能略微超过bucket_size
+    """
+    timed_task_id, start = key
+    times = [sample["recordTime"] for sample in samples]
+    return UpdateOne(
+        {"timedTaskID": timed_task_id, "start": start, "count": {"$lt": bucket_size}},
+        {
+            "$push": {name: {"$each": [sample.get(name) for sample in samples]} for name in BUCKET_COLUMNS},
+            "$inc": {"count": len(samples)},
+            "$min": {"minTime": min(times)},
+            "$max": {"maxTime": max(times)},
+            "$setOnInsert": {"taskID": samples[0].get("taskID"), "isShow": True},
+        },
+        upsert=True
+    )
+
+
+def build_bucket_documents(samples: List[dict], bucket_size: int) -> List[dict]:
+    """一次性生成完整的桶文档，用于批量导入，samples需要按recordTime升序"""
+    documents = []
+    for (timed_task_id, start), group in group_into_buckets(samples).items():
+        for offset in range(0, len(group), bucket_size):
+            chunk = group[offset:offset + bucket_size]
+            documents.append({
+                "timedTaskID": timed_task_id,
+                "taskID": chunk[0].get("taskID"),
+                "start": start,
+                "count": len(chunk),
+                "minTime": chunk[0]["recordTime"],
+                "maxTime": chunk[-1]["recordTime"],
+                "isShow": True,
+                **{name: [sample.get(name) for sample in chunk] for name in BUCKET_COLUMNS},
+            })
+    return documents
+
+
+class SampleBucketWriter(BatchWriter):
+    """
+    攒批之后按(任务, 小时)分组，每组一个$push upsert
+    $push/$inc不是幂等的，超时、断线等不知道是否已经写入的情况下，给这批采样分配_id（和写到磁盘缓冲的采样一样），
+    带_id的采样重新写入前先按(任务, recordTime)查一遍桶，已经在桶里的跳过
+    """
+
+    def __init__(self, *args, bucket_size: int = Config.SAMPLE_BUCKET_SIZE, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.bucket_size = bucket_size
+
+    async def _write(self, collect: AgnosticCollection, batch: List[dict]) -> List[dict]:
+        batch = await self._skip_written(collect, batch)
+        if not batch:
+            return []
+        groups = list(group_into_buckets(batch).items())
+        operations = [bucket_update(key, samples, self.bucket_size) for key, samples in groups]
+        try:
+            await collect.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            # 只重试失败的桶，成功的桶已经追加进去了
+            errors = e.details.get("writeErrors", [])
+            print(f"{self.collect_name}写入失败{len(errors)}个桶：{errors[0].get('errmsg') if errors else traceback.format_exc()}")
+            return [sample for err in errors for sample in groups[err["index"]][1]]
+        except Exception:
+            for sample in batch:
+                sample.setdefault("_id", ObjectId())
+            raise
+        return []
+
+    @staticmethod
+    async def _skip_written(collect: AgnosticCollection, batch: List[dict]) -> List[dict]:
+        """去掉之前写入结果未知、实际已经在桶里的采样，同一个任务的recordTime不会重复"""
+        retried = group_into_buckets([sample for sample in batch if "_id" in sample])
+        if not retried:
+            return batch
+        written = set()
+        cursor = collect.find(
+            {"$or": [
+                {"timedTaskID": timed_task_id, "start": start, "recordTime": {"$in": [s["recordTime"] for s in samples]}}
+                for (timed_task_id, start), samples in retried.items()
+            ]},
+            projection={"_id": False, "timedTaskID": True, "recordTime": True}
+        )
+        async for bucket in cursor:
+            written.update((bucket["timedTaskID"], record_time) for record_time in bucket["recordTime"])
+        return [
+            sample for sample in batch
+            if "_id" not in sample or (sample["timedTaskID"], _bson_time(sample["recordTime"])) not in written
+        ]
+
+
+def _bson_time(record_time: datetime) -> datetime:
+    """mongodb里的时间只精确到毫秒"""
+    return record_time.replace(microsecond=record_time.microsecond // 1000 * 1000)
+
+
+def create_sample_spool(collect_name: str) -> Optional[DiskSpool]:
+    if not Config.SPOOL_DIR:
+        return None
+    return DiskSpool(
+        os.path.join(Config.SPOOL_DIR, collect_name), collect_name,
+        max_bytes=Config.SPOOL_MAX_BYTES, segment_bytes=Config.SPOOL_SEGMENT_BYTES
+    )
+
+
+def create_sample_writer() -> BatchWriter:
+    """磁盘缓冲在真正开始采集时再通过attach_spool挂上"""
+    writer_class = SampleBucketWriter if is_bucket() else BatchWriter
+    return writer_class(
+        sample_collect_name(),
+        max_batch=Config.SAMPLE_WRITE_BATCH,
+        flush_interval=Config.SAMPLE_WRITE_INTERVAL,
+        spool_batch=Config.SPOOL_REPLAY_BATCH,
+        retry_interval=Config.SPOOL_RETRY_INTERVAL
+    )
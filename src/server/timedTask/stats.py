@@ -0,0 +1,212 @@
+import asyncio
+from datetime import datetime, timedelta
+from typing import Optional, Dict, List
+
+import numpy as np
+from motor.core import AgnosticCollection
+from pymongo import UpdateOne
+from pymongo.errors import OperationFailure
+
+from config import Config
+
+from server.model import PyandticObjectId
+from server.timedTask.archive import archive_version, archived_until, find_archive_manifests, load_archived_columns
+from server.timedTask.sample_storage import sample_collect, sample_pipeline
+from utils.cache import AsyncTTLCache, make_cache_key
+from utils.mongo_client import AsyncMongoClient
+
+# 已经结束的时间窗口结果不会再变化，缓存时间可以长一些，key为(timedTaskID, 查询参数)
+closed_window_stats_cache = AsyncTTLCache(maxsize=512, ttl=3600, name="timed_task_stats")
+# 每个任务最近一次从磁盘缓冲回放采样的时间和回放的最早recordTime，所有进程的统计缓存据此失效
+REPLAY_COLLECT = "timed_task_sample_replay_collect"
+
+PERCENTILES = (0.5, 0.95, 0.99)
+STATS_COLUMNS = ("idCpu", "freeMem", "swpdMem")
+# 不支持$percentile时的错误码：InvalidPipelineOperator、未知的阶段、未知的累加器（不同版本的错误码不一样）
+_UNSUPPORTED_OPERATOR_CODES = (168, 15952, 31325, 40324)
+
+
+class _MongoFeature:
+    # mongodb 7.0以下不支持$percentile，第一次失败后直接走numpy
+    percentile_supported: bool = True
+
+
+def _format_stats(count: int, cpu_mean, cpu_percentiles: List, cpu_max, free_mem_min, swpd_mem_max) -> dict:
+    cpu_percentiles = cpu_percentiles or [None] * len(PERCENTILES)
+    return {
+        "count": count,
+        "cpu": {
+            "mean": cpu_mean,
+            "p50": cpu_percentiles[0],
+            "p95": cpu_percentiles[1],
+            "p99": cpu_percentiles[2],
+            "max": cpu_max,
+        },
+        "freeMemMin": free_mem_min,
+        "swpdMemMax": swpd_mem_max,
+    }
+
+
+async def _stats_by_mongo(collect: AgnosticCollection, pipeline: List[dict]) -> dict:
+    # cpu使用率 = 1 - 空闲cpu
+    cpu_expr = {"$subtract": [1, "$idCpu"]}
+    datas = await collect.aggregate([
+        *pipeline,
+        {
+            "$group": {
+                "_id": None,
+                "count": {"$sum": 1},
+                "cpuMean": {"$avg": cpu_expr},
+                "cpuPercentiles": {
+                    "$percentile": {"input": cpu_expr, "p": list(PERCENTILES), "method": "approximate"}
+                },
+                "cpuMax": {"$max": cpu_expr},
+                "freeMemMin": {"$min": "$freeMem"},
+                "swpdMemMax": {"$max": "$swpdMem"},
+            }
+        }
+    ]).to_list(None)
+    if len(datas) == 0:
+        return _format_stats(0, None, [], None, None, None)
+    data = datas[0]
+    return _format_stats(
+        data["count"], data["cpuMean"], data["cpuPercentiles"],
+        data["cpuMax"], data["freeMemMin"], data["swpdMemMax"]
+    )
+
+
+def _vectorised_stats(columns: Dict[str, np.ndarray]) -> dict:
+    """在线程池中执行，numpy计算时会释放GIL"""
+    count = len(columns["idCpu"])
+    if count == 0:
+        return _format_stats(0, None, [], None, None, None)
+    cpu = 1 - columns["idCpu"]
+    cpu = cpu[~np.isnan(cpu)]
+
+    def _reduce(func, values: np.ndarray):
+        return float(func(values)) if values.size else None
+
+    free_mem = columns["freeMem"][~np.isnan(columns["freeMem"])]
+    swpd_mem = columns["swpdMem"][~np.isnan(columns["swpdMem"])]
+    return _format_stats(
+        count,
+        _reduce(np.mean, cpu),
+        [float(v) for v in np.quantile(cpu, PERCENTILES)] if cpu.size else [],
+        _reduce(np.max, cpu),
+        _reduce(np.min, free_mem),
+        _reduce(np.max, swpd_mem),
+    )
+
+
+async def _stats_by_numpy(
+        collect: AgnosticCollection,
+        pipeline: List[dict],
+        archived: Optional[Dict[str, np.ndarray]] = None,
+        batch_size: int = 10000
+) -> dict:
+    """
+    :param archived: 已经归档的部分，和mongodb中的数据合并之后再统计
+    """
+    columns = {name: [] for name in STATS_COLUMNS}
+    if archived is not None:
+        for name in STATS_COLUMNS:
+            columns[name].append(archived[name])
+    cursor = collect.aggregate(
+        [*pipeline, {"$project": {"_id": False, **{name: True for name in STATS_COLUMNS}}}],
+        batchSize=batch_size
+    )
+    # 按批次转成数组，避免一次性把所有文档放在内存里
+    batch = []
+    async for doc in cursor:
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            for name in STATS_COLUMNS:
+                columns[name].append(np.array([d.get(name) for d in batch], dtype=np.float64))
+            batch = []
+    for name in STATS_COLUMNS:
+        columns[name].append(np.array([d.get(name) for d in batch], dtype=np.float64))
+    arrays = {name: np.concatenate(values) for name, values in columns.items()}
+    return await asyncio.get_running_loop().run_in_executor(None, _vectorised_stats, arrays)
+
+
+async def _compute_sample_stats(pipeline: List[dict], archived: Optional[Dict[str, np.ndarray]] = None) -> dict:
+    collect = sample_collect(analytics=True)
+    # 有归档数据时分位数只能在本地合并计算
+    if archived is None and _MongoFeature.percentile_supported:
+        try:
+            return await _stats_by_mongo(collect, pipeline)
+        except OperationFailure as e:
+            # 超时、被中断这类错误直接抛出，不能因此永久改用numpy
+            if e.code not in _UNSUPPORTED_OPERATOR_CODES:
+                raise
+            print("mongodb不支持$percentile，改用numpy计算：", str(e))
+            _MongoFeature.percentile_supported = False
+    return await _stats_by_numpy(collect, pipeline, archived)
+
+
+async def _compute_stats_with_archive(
+        timed_task_id: PyandticObjectId,
+        start_time: Optional[datetime],
+        end_time: Optional[datetime],
+        manifests: List[dict]
+) -> dict:
+    if len(manifests) == 0:
+        return await _compute_sample_stats(sample_pipeline(timed_task_id, start_time, end_time))
+    # mongodb只查归档之后的部分
+    until = archived_until(manifests)[timed_task_id] + timedelta(milliseconds=1)
+    archived = (await load_archived_columns(manifests, start_time, end_time, STATS_COLUMNS))[timed_task_id]
+    pipeline = sample_pipeline(timed_task_id, max(start_time, until) if start_time else until, end_time)
+    return await _compute_sample_stats(pipeline, archived)
+
+
+async def mark_stats_replayed(samples: List[dict]):
+    """
+    BatchWriter的on_replay：回放的采样会改变已经结束的窗口，
+    清掉本进程对应任务的缓存，并记录回放时间，其他进程的缓存key会随之变化
+    """
+    earliest: Dict[PyandticObjectId, datetime] = dict()
+    for sample in samples:
+        timed_task_id, record_time = sample.get("timedTaskID"), sample.get("recordTime")
+        if timed_task_id is None or record_time is None:
+            continue
+        if timed_task_id not in earliest or record_time < earliest[timed_task_id]:
+            earliest[timed_task_id] = record_time
+    if not earliest:
+        return
+    task_keys = {str(_id) for _id in earliest}
+    closed_window_stats_cache.invalidate_if(lambda key: key[0] in task_keys)
+    now = datetime.now()
+    replay_collect: AgnosticCollection = AsyncMongoClient[REPLAY_COLLECT]
+    await replay_collect.bulk_write([
+        UpdateOne({"_id": _id}, {"$set": {"replayTime": now}, "$min": {"from": record_time}}, upsert=True)
+        for _id, record_time in earliest.items()
+    ], ordered=False)
+
+
+async def _replay_version(timed_task_id: PyandticObjectId, end_time: datetime) -> Optional[datetime]:
+    replay_collect: AgnosticCollection = AsyncMongoClient[REPLAY_COLLECT]
+    doc = await replay_collect.find_one({"_id": timed_task_id})
+    if doc is None or doc["from"] > end_time:
+        return None
+    return doc["replayTime"]
+
+
+async def get_sample_stats(
+        timed_task_id: PyandticObjectId,
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None
+) -> dict:
+    """
+    设备运行状况的统计：cpu的平均值、p50、p95、p99、最大值，最小空闲内存，最大交换内存
+    窗口内已经归档到minio的部分会合并进来
+    结束时间早于STATS_CACHE_SETTLE_SECONDS之前的窗口不会再有新数据，结果会被缓存，
+    归档、磁盘缓冲回放之后缓存key会变化，不会返回之前的结果
+    """
+    manifests = await find_archive_manifests(timed_task_id, start_time, end_time)
+    if end_time is not None and end_time < datetime.now() - timedelta(seconds=Config.STATS_CACHE_SETTLE_SECONDS):
+        version = (archive_version(manifests), await _replay_version(timed_task_id, end_time))
+        return await closed_window_stats_cache.get_or_load(
+            (str(timed_task_id), make_cache_key(start_time, end_time, version)),
+            lambda: _compute_stats_with_archive(timed_task_id, start_time, end_time, manifests)
+        )
+    return await _compute_stats_with_archive(timed_task_id, start_time, end_time, manifests)
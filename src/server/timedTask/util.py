@@ -1,24 +1,73 @@
 import time
 import itertools
 import traceback
+from datetime import datetime, timedelta
+from typing import Dict, Optional, List, Sequence
 
 from apscheduler.events import EVENT_JOB_ERROR, EVENT_JOB_MISSED, EVENT_JOB_EXECUTED, EVENT_JOB_REMOVED
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+from bson import ObjectId
 from motor.core import AgnosticCollection
-from pymongo import ReturnDocument
+from pymongo import ReturnDocument, InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
 
 from server.timedTask.model import (
     TimedTaskKind,
     TaskStatus,
+    TimedTaskModel,
+    TimedTaskOperate,
+    TimedTaskOperateModel,
     TimedTaskSysRecordModel,
     PyandticObjectId,
-    TimedTaskDevCPUAndMEMModel
+    DEV_CPU_MEM_COLUMNS,
+    VMSTAT_COMMAND,
+    parse_vmstat_sample,
 )
+from config import Config
+from server.timedTask.aggregate import SampleAggregator
+from server.timedTask.detector import TaskAnomalyDetector
+from server.timedTask.sample_storage import create_sample_writer, find_samples
+from utils.cache import AsyncTTLCache
+from utils.ring_buffer import RingBufferStore, SampleRing
 from utils.pydis import Pydis
 from utils.mongo_client import AsyncMongoClient
 from utils.scheduler import Scheduler, DistributedLockAcquireError, job_lock
 
 _task_num_counter = itertools.count(1).__next__
 
+# 定时任务列表查询结果的缓存，key为规范化后的查询参数
+timed_task_search_cache = AsyncTTLCache(maxsize=256, ttl=30, name="timed_task_search")
+# 定时任务本身的信息（detail里的find_one），key为timedTaskID
+timed_task_info_cache = AsyncTTLCache(maxsize=1024, ttl=300, name="timed_task_info")
+
+
+# 采集进程内每个定时任务最近的采样点，key为str(timedTaskID)
+# 注意：多个worker同时跑调度时，每个worker只保存自己抢到锁执行的那部分点，读取时以mongodb为准
+recent_sample_store = RingBufferStore(DEV_CPU_MEM_COLUMNS, Config.SAMPLE_RING_SIZE)
+
+
+class RecentSampleSource:
+    # 独立的采集进程只有一个，所有的采样都经过它的环形缓冲区，最近的点可以直接从内存读取
+    ring_complete: bool = False
+
+# 本进程调度器里的任务是按哪个版本（updateTime）的任务文档调度的，同一个版本不用重新调度
+_scheduled_versions: Dict[str, datetime] = dict()
+
+# 采样数据攒批之后写入，写入方式取决于Config.SAMPLE_STORAGE
+dev_cpu_mem_writer = create_sample_writer()
+
+
+def invalidate_timed_task_cache(timed_task_id=None, search: bool = True):
+    """
+    定时任务发生变化后清理缓存
+    :param timed_task_id: 为None时清空全部任务信息缓存
+    :param search: 是否同时清空列表查询缓存，只是执行次数变化时可以不清，依赖ttl过期
+    """
+    timed_task_info_cache.invalidate(None if timed_task_id is None else str(timed_task_id))
+    if search:
+        timed_task_search_cache.invalidate()
+
 
 def get_task_id(kind: TimedTaskKind, pre="TimedTask"):
     return f"{pre}_{int(time.time())}_{kind}_{_task_num_counter()}"
@@ -30,38 +79,443 @@ async def get_device_cpu_and_mem(
         task_id: str,
         ip: str,
         ssh_username: str,
-        ssh_password: str
+        ssh_password: str,
+        ssh_port: int = 22
 ):
-    # 由于没有例子把这块注释掉
-    # client = await Pydis.get_ssh_client(ip, ssh_username, ssh_password)
-    # recv, flag = await client.send_and_recv("vmstat | awk 'NR==3 {print $3,$4,$5,$6,$9,$10,$13,$14,$15,$16,$17}'")
-    # if flag is False:
-    #     raise Exception(f"返回的信息为：{recv}")
-    # swpd_mem, free_mem, buff_mem, cache_mem, bi_io, bo_io, us_cpu, sy_cpu, id_cpu, wa_cpu, st_cpu = \
-    #     recv.split()
-
-    # 示例
-    swpd_mem, free_mem, buff_mem, cache_mem, bi_io, bo_io, us_cpu, sy_cpu, id_cpu, wa_cpu, st_cpu = \
-        "5452595", "3352595", "2152595", "52595", "10", "10", "70", "10", "10", "1", "2"
-    timed_task_dev_cpu_mem_collect: AgnosticCollection = AsyncMongoClient["timed_task_dev_cpu_mem_collect"]
-    new_data = await timed_task_dev_cpu_mem_collect.insert_one(
-        TimedTaskDevCPUAndMEMModel(
-            taskID=task_id,
+    if Config.SAMPLE_SOURCE == "ssh":
+        client = await Pydis.get_ssh_client(ip, ssh_username, ssh_password, port=ssh_port)
+        recv, flag = await client.send_and_recv(VMSTAT_COMMAND)
+        if flag is False:
+            raise Exception(f"返回的信息为：{recv}")
+    else:
+        # 没有真实设备时使用示例数据
+        recv = "5452595 3352595 2152595 52595 10 10 70 10 10 1 2"
+    sample = parse_vmstat_sample(recv, timed_task_id, task_id).to_document()
+    dev_cpu_mem_writer.add(sample)
+    record_ts = sample["recordTime"].timestamp()
+    recent_sample_store.append(str(timed_task_id), record_ts, sample)
+    SampleAggregator.add(sample)
+    anomalies = TaskAnomalyDetector.feed(str(timed_task_id), record_ts, sample)
+    if anomalies:
+        await record_timed_task_anomalies(timed_task_id, task_id, anomalies)
+
+
+async def record_timed_task_anomalies(timed_task_id: PyandticObjectId, task_id: str, anomalies: List[str]):
+    """把检测到的异常写到定时任务的执行记录里"""
+    timed_task_collect: AgnosticCollection = AsyncMongoClient["timed_task_collect"]
+    task_info = await timed_task_info_cache.get_or_load(
+        str(timed_task_id),
+        lambda: timed_task_collect.find_one({"_id": timed_task_id, "isShow": True})
+    )
+    task_name = task_info["taskName"] if task_info is not None else task_id
+    timed_task_record_collect: AgnosticCollection = AsyncMongoClient["timed_task_record_collect"]
+    await timed_task_record_collect.insert_many([
+        TimedTaskSysRecordModel(
             timedTaskID=timed_task_id,
-            swpdMem=float(swpd_mem),
-            freeMem=float(free_mem),
-            buffMem=float(buff_mem),
-            cacheMem=float(buff_mem),
-            biIo=float(bi_io),
-            boIo=float(bo_io),
-            usCpu=float(us_cpu) / 100,
-            syCpu=float(sy_cpu) / 100,
-            idCpu=float(id_cpu) / 100,
-            waCpu=float(wa_cpu) / 100,
-            stCpu=float(st_cpu) / 100
-        ).model_dump()
+            taskName=task_name,
+            taskID=task_id,
+            operateResult=anomaly
+        ).model_dump(by_alias=True) for anomaly in anomalies
+    ])
+
+
+async def get_recent_samples(
+        timed_task_id: PyandticObjectId,
+        last_n: Optional[int] = None,
+        last_seconds: Optional[float] = None,
+        fields: Optional[Sequence[str]] = None
+) -> List[dict]:
+    """
+    最近的采样点，按recordTime升序
+    独立的采集进程（RecentSampleSource.ring_complete）：缓冲区覆盖了整个窗口时直接从内存返回，
+    否则只查缓冲区里最旧的点之前的部分
+    其他进程（多个worker同时采集时每个worker只有自己执行的那部分点，不运行调度器的api进程没有缓冲区）：
+    整个窗口都查mongodb，缓冲区只用来补上还在攒批、没有写入mongodb的点
+    :param fields: 只返回这些列
+    """
+    ring = recent_sample_store.get(str(timed_task_id))
+    if RecentSampleSource.ring_complete and ring is not None and len(ring) > 0:
+        return await _recent_samples_from_ring(ring, timed_task_id, last_n, last_seconds, fields)
+    start_time = None
+    if last_n is not None:
+        rows = ring.last_n(last_n, fields) if ring is not None else []
+    else:
+        since = time.time() - last_seconds
+        rows = ring.since(since, fields) if ring is not None else []
+        start_time = datetime.fromtimestamp(since)
+    datas = await find_samples(timed_task_id, start_time, last_n=last_n, fields=fields)
+    # mongodb里的时间精度为毫秒，按毫秒去重
+    written = {_truncate_ms(data["recordTime"]) for data in datas}
+    unwritten = [
+        {"recordTime": record_time, **row}
+        for record_time, row in ((datetime.fromtimestamp(ts), row) for ts, row in rows)
+        if _truncate_ms(record_time) not in written
+    ]
+    if not unwritten:
+        return datas
+    datas.extend(unwritten)
+    datas.sort(key=lambda x: x["recordTime"])
+    return datas[-last_n:] if last_n is not None else datas
+
+
+async def _recent_samples_from_ring(
+        ring: SampleRing,
+        timed_task_id: PyandticObjectId,
+        last_n: Optional[int],
+        last_seconds: Optional[float],
+        fields: Optional[Sequence[str]]
+) -> List[dict]:
+    # 缓冲区之前的部分只查到最旧的点之前1毫秒，不会和缓冲区重复
+    older_end = datetime.fromtimestamp(ring.oldest_time) - timedelta(milliseconds=1)
+    if last_n is not None:
+        rows = ring.last_n(last_n, fields)
+        older = []
+        if len(rows) < last_n:
+            older = await find_samples(timed_task_id, None, older_end, last_n=last_n - len(rows), fields=fields)
+    else:
+        since = time.time() - last_seconds
+        rows = ring.since(since, fields)
+        older = []
+        if ring.oldest_time > since:
+            older = await find_samples(timed_task_id, datetime.fromtimestamp(since), older_end, fields=fields)
+    return older + [{"recordTime": datetime.fromtimestamp(ts), **row} for ts, row in rows]
+
+
+def _truncate_ms(record_time: datetime) -> datetime:
+    return record_time.replace(microsecond=record_time.microsecond // 1000 * 1000)
+
+
+# 编辑定时任务时允许修改的字段
+EDITABLE_TIMED_TASK_FIELDS = {
+    "task_name", "resource_id", "obj_ip", "obj_ssh_user", "obj_ssh_password", "obj_ssh_port",
+    "crontab", "interval", "plan_execute_time",
+    "coalesce", "max_instances", "misfire_grace_time", "archive_after_days",
+}
+
+# 各个操作之后任务的状态
+_OPERATE_STATUS = {
+    TimedTaskOperate.STOP: TaskStatus.STOPPED,
+    TimedTaskOperate.PAUSE: TaskStatus.PAUSED,
+    TimedTaskOperate.DELETE: TaskStatus.DELETED,
+    TimedTaskOperate.RESUME: TaskStatus.PENDING,
+}
+
+
+def build_timed_task_trigger(task: dict):
+    """
+    crontab优先，其次是interval
+    interval没有计划开始时间时以创建时间为起点，执行时间不受调度的时间（重启、哪个进程）影响，
+    不运行调度器的进程也能推算出同样的执行时间
+    """
+    start_date, end_date = task.get("planExecuteTime") or (None, None)
+    if task.get("crontab"):
+        minute, hour, day, month, day_of_week = task["crontab"].split()
+        return CronTrigger(
+            minute=minute, hour=hour, day=day, month=month, day_of_week=day_of_week,
+            start_date=start_date, end_date=end_date
+        )
+    if task.get("interval") is not None:
+        return IntervalTrigger(
+            seconds=task["interval"], start_date=start_date or task.get("createTime"), end_date=end_date
+        )
+    raise Exception("crontab和interval不能同时为空")
+
+
+def is_trigger_exhausted(task: dict) -> bool:
+    """触发器已经没有下一次执行时间（超过了planExecuteTime的结束时间），说明任务执行完了"""
+    try:
+        trigger = build_timed_task_trigger(task)
+    except Exception:
+        return False
+    return trigger.get_next_fire_time(None, datetime.now().astimezone()) is None
+
+
+def get_next_run_times(task: dict, count: int = 3) -> List[datetime]:
+    """
+    任务接下来的几次执行时间，本进程有该任务的调度时以调度器为准，否则根据crontab、interval推算
+    """
+    job = Scheduler.get_job(task["taskID"]) if Scheduler.is_running() else None
+    if job is not None:
+        if job.next_run_time is None:
+            return []
+        trigger, fire_time = job.trigger, job.next_run_time
+    elif (
+            (task.get("crontab") or task.get("interval") is not None)
+            and task.get("taskStatus") in (TaskStatus.PENDING, TaskStatus.ERROR, TaskStatus.MISSED)
+    ):
+        trigger = build_timed_task_trigger(task)
+        fire_time = trigger.get_next_fire_time(None, datetime.now().astimezone())
+    else:
+        return []
+    run_times = []
+    while fire_time is not None and len(run_times) < count:
+        run_times.append(fire_time.astimezone().replace(tzinfo=None))
+        fire_time = trigger.get_next_fire_time(fire_time, fire_time + timedelta(microseconds=1))
+    return run_times
+
+
+def schedule_timed_task(task: dict):
+    """
+    根据数据库中的定时任务（字段为alias）添加调度，已经存在的同id任务会被替换
+    """
+    if task["timedTaskKind"] == TimedTaskKind.CPU_MEM_RECORD:
+        func = get_device_cpu_and_mem
+        args = (
+            task["_id"], task["taskID"], task.get("objIP"),
+            task.get("objSshUser"), task.get("objSshPassword"), task.get("objSshPort", 22)
+        )
+    else:
+        raise Exception("暂不支持该类型的定时任务")
+    job = Scheduler.add_job(
+        func, build_timed_task_trigger(task), _id=task["taskID"],
+        coalesce=task.get("coalesce", True),
+        max_instances=task.get("maxInstances", 1),
+        misfire_grace_time=task.get("misfireGraceTime", 60),
+        args=args
+    )
+    _scheduled_versions[task["taskID"]] = task.get("updateTime")
+    if task.get("taskStatus") == TaskStatus.PAUSED:
+        job.pause()
+    return job
+
+
+def sync_timed_task_job(task: dict, reschedule: bool = True):
+    """
+    让调度器里的任务和数据库中的状态一致
+    :param reschedule: 触发器、执行参数是否有变化，没有变化时已经存在的任务只做暂停、恢复
+    """
+    status = task.get("taskStatus")
+    if not task.get("isShow", True) or status in (TaskStatus.DELETED, TaskStatus.STOPPED, TaskStatus.COMPLETED):
+        Scheduler.remove(task["taskID"])
+        _scheduled_versions.pop(task["taskID"], None)
+        recent_sample_store.drop(str(task["_id"]))
+        TaskAnomalyDetector.drop(str(task["_id"]))
+        return
+    job = Scheduler.get_job(task["taskID"])
+    # 自己写入后收到的change stream、启动时重放的变化，任务文档还是调度时的那个版本
+    if reschedule and job is not None and task.get("updateTime") is not None:
+        reschedule = _scheduled_versions.get(task["taskID"]) != task.get("updateTime")
+    if job is None or reschedule:
+        schedule_timed_task(task)
+    elif status == TaskStatus.PAUSED:
+        job.pause()
+    elif job.next_run_time is None:
+        job.resume()
+
+
+async def load_timed_task_jobs(updated_since: Optional[datetime] = None):
+    """
+    从数据库加载定时任务到本进程的调度器
+    :param updated_since: 为None时加载全部需要运行的任务，并移除调度器里不在其中的定时任务
+                          （监听中断期间被删除、停止的任务）；否则只同步这个时间之后修改过的任务
+    """
+    timed_task_collect: AgnosticCollection = AsyncMongoClient["timed_task_collect"]
+    if updated_since is None:
+        query = {
+            "isShow": True,
+            "taskStatus": {"$in": [TaskStatus.PENDING, TaskStatus.ERROR, TaskStatus.MISSED, TaskStatus.PAUSED]}
+        }
+    else:
+        query = {"updateTime": {"$gte": updated_since}}
+    loaded = set()
+    async for task in timed_task_collect.find(query):
+        loaded.add(task["taskID"])
+        try:
+            sync_timed_task_job(task)
+        except Exception:
+            print(traceback.format_exc())
+    if updated_since is None and Scheduler.is_running():
+        for job in Scheduler.get_jobs():
+            if is_timed_task(job.id) and job.id not in loaded:
+                print(f"全量同步：移除已经不需要运行的定时任务{job.id}")
+                Scheduler.remove(job.id)
+                _scheduled_versions.pop(job.id, None)
+
+
+# 这些字段变化时需要同步调度器
+SCHEDULE_FIELDS = {
+    "timedTaskKind", "interval", "crontab", "planExecuteTime", "objIP", "objSshUser", "objSshPassword", "objSshPort",
+    "coalesce", "maxInstances", "misfireGraceTime",
+}
+STATUS_FIELDS = {"taskStatus", "isShow"}
+# 调度器根据执行结果写入的状态，不需要再同步回调度器
+RUNTIME_STATUSES = {TaskStatus.COMPLETED, TaskStatus.ERROR, TaskStatus.MISSED}
+
+
+# change stream中只关心调度相关字段的变化，执行次数这类变化在服务端就过滤掉
+TIMED_TASK_WATCH_PIPELINE = [{
+    "$match": {
+        "$or": [
+            {"operationType": {"$in": ["insert", "replace"]}},
+            *[{f"updateDescription.updatedFields.{name}": {"$exists": True}}
+              for name in sorted(SCHEDULE_FIELDS | STATUS_FIELDS)]
+        ]
+    }
+}]
+
+
+def handle_timed_task_cache_change(change: dict):
+    """定时任务可能是其他进程修改的（例如采集进程写入的执行状态），清掉本进程的缓存"""
+    invalidate_timed_task_cache((change.get("documentKey") or {}).get("_id"))
+
+
+async def resync_timed_task_cache(updated_since: Optional[datetime] = None):
+    # 执行状态的变化不会更新updateTime，没办法只清理修改过的任务
+    invalidate_timed_task_cache()
+
+
+def handle_timed_task_change(change: dict):
+    """处理timed_task_collect的一条change stream变化"""
+    handle_timed_task_cache_change(change)
+    task = change.get("fullDocument")
+    if task is None:
+        return
+    updated_fields = change.get("updateDescription", {}).get("updatedFields", {})
+    if (
+            change["operationType"] == "update"
+            and not (SCHEDULE_FIELDS | {"isShow"}) & set(updated_fields)
+            and updated_fields.get("taskStatus") in RUNTIME_STATUSES
+    ):
+        return
+    sync_timed_task_job(
+        task,
+        reschedule=change["operationType"] != "update" or bool(SCHEDULE_FIELDS & set(updated_fields))
+    )
+
+
+def watch_timed_task_changes():
+    """本进程的调度器监听定时任务的变化，各个worker最终都会和数据库一致"""
+    return Scheduler.watch(
+        "timed_task_collect",
+        handle_timed_task_change,
+        load_timed_task_jobs,
+        pipeline=TIMED_TASK_WATCH_PIPELINE,
+        token_key=f"timed_task_collect_{Config.SCHEDULER_NAME}",
+        poll_interval=Config.TASK_SYNC_INTERVAL,
+    )
+
+
+def watch_timed_task_cache():
+    """不运行调度器的进程只需要清理缓存"""
+    return Scheduler.watch(
+        "timed_task_collect",
+        handle_timed_task_cache_change,
+        resync_timed_task_cache,
+        pipeline=TIMED_TASK_WATCH_PIPELINE,
+        token_key=f"timed_task_cache_{Config.SCHEDULER_NAME}",
+        poll_interval=Config.TASK_SYNC_INTERVAL,
     )
-    print(new_data.inserted_id)
+
+
+async def apply_timed_task_operations(operations: List[TimedTaskOperateModel]) -> List[dict]:
+    """
+    批量操作定时任务：所有写操作合并成一次bulk_write，然后一次性同步调度器
+    unordered的bulk_write不保证执行顺序，同一个任务在一次请求中只能操作一次；
+    新增、编辑的触发器在写入之前检查，错误的配置不会写入数据库
+    :return: 每个操作的结果，顺序和operations一致
+    """
+    timed_task_collect: AgnosticCollection = AsyncMongoClient["timed_task_collect"]
+    results = [
+        {"operate": op.operate, "taskID": op.task_id, "success": False, "msg": None, "data": None}
+        for op in operations
+    ]
+
+    # 非新增的操作先一次查出已有的任务
+    task_ids = [op.task_id for op in operations if op.operate != TimedTaskOperate.ADD]
+    existing = dict()
+    if task_ids:
+        async for task in timed_task_collect.find({"taskID": {"$in": task_ids}, "isShow": True}):
+            existing[task["taskID"]] = task
+
+    now = datetime.now()
+    writes, write_indexes = [], []
+    seen_ids = set()
+    for index, op in enumerate(operations):
+        if op.operate == TimedTaskOperate.ADD:
+            task_id = get_task_id(op.timedTaskKind)
+            task = TimedTaskModel(
+                **op.model_dump(exclude={"task_id", "operate"}, by_alias=True), taskID=task_id
+            ).model_dump(by_alias=True)
+            task["_id"] = ObjectId()
+            results[index]["taskID"] = task_id
+            try:
+                build_timed_task_trigger(task)
+            except Exception as e:
+                results[index]["msg"] = f"调度失败：{e}"
+                continue
+            writes.append(InsertOne(task))
+        else:
+            if op.task_id in seen_ids:
+                results[index]["msg"] = f"同一次请求中重复操作定时任务{op.task_id}"
+                continue
+            seen_ids.add(op.task_id)
+            if op.task_id not in existing:
+                results[index]["msg"] = f"未找到定时任务{op.task_id}"
+                continue
+            update = {"updateTime": now, "updateUser": op.update_user}
+            if op.operate == TimedTaskOperate.EDIT:
+                update.update(op.model_dump(
+                    include=op.model_fields_set & EDITABLE_TIMED_TASK_FIELDS, by_alias=True
+                ))
+                try:
+                    build_timed_task_trigger({**existing[op.task_id], **update})
+                except Exception as e:
+                    results[index]["msg"] = f"调度失败：{e}"
+                    continue
+            else:
+                update["taskStatus"] = _OPERATE_STATUS[op.operate]
+                if op.operate == TimedTaskOperate.DELETE:
+                    update["isShow"] = False
+            writes.append(UpdateOne({"taskID": op.task_id, "isShow": True}, {"$set": update}))
+        write_indexes.append(index)
+
+    failed_writes = dict()
+    if writes:
+        try:
+            await timed_task_collect.bulk_write(writes, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get("writeErrors", []):
+                failed_writes[write_indexes[error["index"]]] = error.get("errmsg")
+
+    # 写入成功之后一次查出最新的任务，在同一轮中同步调度器
+    changed_ids = [
+        results[index]["taskID"] for index in write_indexes if index not in failed_writes
+    ]
+    changed = dict()
+    if changed_ids:
+        async for task in timed_task_collect.find({"taskID": {"$in": changed_ids}}):
+            changed[task["taskID"]] = task
+
+    hide_failed_adds = []
+    for index in write_indexes:
+        result = results[index]
+        if index in failed_writes:
+            result["msg"] = f"写入失败：{failed_writes[index]}"
+            continue
+        task = changed.get(result["taskID"])
+        if task is None:
+            result["msg"] = "写入后未找到定时任务"
+            continue
+        try:
+            if Scheduler.is_running():
+                sync_timed_task_job(
+                    task, reschedule=operations[index].operate in (TimedTaskOperate.ADD, TimedTaskOperate.EDIT)
+                )
+            elif task.get("isShow") and task.get("taskStatus") not in (TaskStatus.DELETED, TaskStatus.STOPPED):
+                # 本进程不运行调度器，由采集进程通过change stream同步，这里只检查触发器是否正确
+                build_timed_task_trigger(task)
+        except Exception as e:
+            print(traceback.format_exc())
+            result["msg"] = f"调度失败：{e}"
+            if operations[index].operate == TimedTaskOperate.ADD:
+                hide_failed_adds.append(UpdateOne({"_id": task["_id"]}, {"$set": {"isShow": False}}))
+            continue
+        result["success"] = True
+        result["data"] = {k: v for k, v in task.items() if k not in ("_id", "isShow")}
+    if hide_failed_adds:
+        await timed_task_collect.bulk_write(hide_failed_adds, ordered=False)
+    invalidate_timed_task_cache()
+    return results
 
 
 async def handle_event_timed_task(event_code: int, job_id: str, **kwargs):
@@ -72,6 +526,7 @@ async def handle_event_timed_task(event_code: int, job_id: str, **kwargs):
         result = None
         # trace_back = kwargs.get("trace_back")
         exc = kwargs.get("exc")
+        timed_task_collect: AgnosticCollection = AsyncMongoClient["timed_task_collect"]
         if event_code == EVENT_JOB_ERROR:
             if isinstance(exc, DistributedLockAcquireError):
                 return
@@ -95,29 +550,42 @@ async def handle_event_timed_task(event_code: int, job_id: str, **kwargs):
                 }
             }
             result = "定时任务执行！"
-        if event_code == EVENT_JOB_REMOVED:
-            update_data = {
-                "$set": {
-                    "taskStatus": TaskStatus.DELETED,
-                    "isShow": False
+        query = {"taskID": job_id}
+        completed = False
+        # 调度器里已经没有这个任务时，只有触发器没有下一次执行时间才算执行结束；
+        # 停止、删除、全量同步时移除的任务不能写成完成，暂停的任务next_run_time为None，但任务还在
+        if event_code == EVENT_JOB_REMOVED or Scheduler.get_job(job_id) is None:
+            task = await timed_task_collect.find_one({"taskID": job_id})
+            completed = task is not None and is_trigger_exhausted(task)
+            if completed:
+                update_data = {
+                    "$set": {
+                        "taskStatus": TaskStatus.COMPLETED
+                    }
                 }
-            }
-        job = Scheduler.get_job(job_id)
-        if job is None or job.next_run_time is None:
-            update_data = {
-                "$set": {
-                    "taskStatus": TaskStatus.COMPLETED
-                }
-            }
+            elif event_code == EVENT_JOB_REMOVED:
+                return
+        if update_data is not None and "$set" in update_data:
+            # 停止、删除的任务状态已经在操作时写好了，不能被覆盖；暂停的任务也不能被执行结果改掉
+            excluded = [TaskStatus.DELETED, TaskStatus.STOPPED]
+            if not completed:
+                excluded.append(TaskStatus.PAUSED)
+            query["taskStatus"] = {"$nin": excluded}
         if update_data is not None:
             print(update_data)
-            timed_task_collect: AgnosticCollection = AsyncMongoClient["timed_task_collect"]
             return_data = await timed_task_collect.find_one_and_update(
-                {"taskID": job_id},
+                query,
                 update_data,
                 return_document=ReturnDocument.AFTER
             )
             print(return_data)
+            if return_data is None:
+                return
+            if completed:
+                recent_sample_store.drop(str(return_data["_id"]))
+                TaskAnomalyDetector.drop(str(return_data["_id"]))
+            # 只有执行次数增加时不清列表缓存，否则每次执行都会把列表缓存清掉
+            invalidate_timed_task_cache(return_data["_id"], search="$set" in update_data)
             if result is not None:
                 timed_task_record = TimedTaskSysRecordModel(
                     timedTaskID=return_data["_id"],
@@ -126,7 +594,7 @@ async def handle_event_timed_task(event_code: int, job_id: str, **kwargs):
                     operateResult=result
                 )
                 timed_task_record_collect: AgnosticCollection = AsyncMongoClient["timed_task_record_collect"]
-                res = await timed_task_record_collect.insert_one(timed_task_record.model_dump())
+                res = await timed_task_record_collect.insert_one(timed_task_record.model_dump(by_alias=True))
                 print(res.inserted_id)
     except Exception as e:
         print(traceback.format_exc())
@@ -0,0 +1,345 @@
+"""
+模拟设备集群：在本机的多个端口上启动asyncssh服务，每个端口是一台虚拟设备
+设备提供交互式终端（提示符、回显），能回答vmstat、/proc下常用文件的读取，数值随时间变化
+可以配置响应延迟、执行命令时断开连接的概率、认证失败的概率，用来压测NoFTPAsyncSSH、Pydis和调度器
+
+运行：cd src && python -m simulator.device_fleet --devices 1000 --base-port 20000
+设备数较多时需要调大文件描述符限制：ulimit -n 65535
+--tasks-file 会输出 /interview/timedTask/bulk 的请求体，每台设备一个定时任务
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+import asyncssh
+
+try:
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    ...
+
+
+@dataclass
+class FleetOptions:
+    devices: int = 10
+    host: str = "127.0.0.1"
+    base_port: int = 20000
+    username: str = "root"
+    password: str = "root"
+    latency: float = 0.02  # 每条命令的平均响应延迟（秒）
+    jitter: float = 0.01  # 延迟的标准差
+    drop_rate: float = 0.0  # 执行命令时直接断开连接的概率
+    auth_fail_rate: float = 0.0  # 密码正确时仍然认证失败的概率
+    leak_rate: float = 0.0  # 发生内存泄漏的设备比例
+    seed: Optional[int] = None
+
+
+@dataclass
+class DeviceState:
+    """一台虚拟设备的状态，读取时根据经过的时间更新，不需要后台任务"""
+    name: str
+    total_mem: int  # KB
+    free_mem: float
+    buff_mem: float
+    cache_mem: float
+    swpd_mem: float
+    cpu_base: float  # 平均cpu使用率（0~100）
+    leak_per_hour: float = 0.0  # 空闲内存每小时减少的KB数
+    boot_time: float = field(default_factory=time.time)
+    last_update: float = field(default_factory=time.time)
+    cpu_ticks: List[float] = field(default_factory=lambda: [0.0] * 8)
+
+    def update(self) -> dict:
+        now = time.time()
+        elapsed = now - self.last_update
+        self.last_update = now
+        # 内存随机游走，泄漏的设备空闲内存持续下降，低于10%时开始使用交换空间
+        self.free_mem += random.gauss(0, self.total_mem * 0.002) - self.leak_per_hour * elapsed / 3600
+        self.free_mem = min(max(self.free_mem, self.total_mem * 0.02), self.total_mem * 0.9)
+        if self.free_mem < self.total_mem * 0.1:
+            self.swpd_mem += self.leak_per_hour * elapsed / 3600 * 0.5
+        self.cache_mem = min(max(self.cache_mem + random.gauss(0, self.total_mem * 0.001), 0), self.total_mem * 0.3)
+
+        # cpu在基线附近波动，偶尔出现尖峰
+        cpu = self.cpu_base + random.gauss(0, 5) + (40 if random.random() < 0.01 else 0)
+        cpu = min(max(cpu, 0), 100)
+        us = cpu * 0.7
+        sy = cpu * 0.25
+        wa = min(cpu * 0.05 + abs(random.gauss(0, 0.5)), 100 - cpu)
+        st = 0.0
+        idle = max(100 - us - sy - wa - st, 0)
+        # /proc/stat里的tick数（USER_HZ=100）
+        ticks = elapsed * 100 * 4
+        for index, percent in enumerate((us, 0, sy, idle, wa, 0, 0, st)):
+            self.cpu_ticks[index] += ticks * percent / 100
+        return {
+            "swpd": int(self.swpd_mem), "free": int(self.free_mem), "buff": int(self.buff_mem),
+            "cache": int(self.cache_mem), "bi": random.randint(0, 50), "bo": random.randint(0, 80),
+            "us": round(us), "sy": round(sy), "id": round(idle), "wa": round(wa), "st": round(st),
+        }
+
+
+def new_device(index: int, options: FleetOptions) -> DeviceState:
+    total_mem = random.choice((1, 2, 4, 8)) * 1024 * 1024
+    return DeviceState(
+        name=f"board{index:04d}",
+        total_mem=total_mem,
+        free_mem=total_mem * random.uniform(0.3, 0.7),
+        buff_mem=total_mem * random.uniform(0.01, 0.05),
+        cache_mem=total_mem * random.uniform(0.05, 0.2),
+        swpd_mem=0.0,
+        cpu_base=random.uniform(3, 60),
+        leak_per_hour=random.uniform(20, 200) * 1024 if random.random() < options.leak_rate else 0.0,
+    )
+
+
+def vmstat_output(state: DeviceState) -> str:
+    v = state.update()
+    return (
+        "procs -----------memory---------- ---swap-- -----io---- -system-- ------cpu-----\n"
+        " r  b   swpd   free   buff  cache   si   so    bi    bo   in   cs us sy id wa st\n"
+        f" 1  0 {v['swpd']:6d} {v['free']:6d} {v['buff']:6d} {v['cache']:6d}    0    0 "
+        f"{v['bi']:5d} {v['bo']:5d}  120  240 {v['us']:2d} {v['sy']:2d} {v['id']:2d} {v['wa']:2d} {v['st']:2d}\n"
+    )
+
+
+def vmstat_awk_output(state: DeviceState) -> str:
+    """对应 vmstat | awk 'NR==3 {print $3,$4,$5,$6,$9,$10,$13,$14,$15,$16,$17}'"""
+    v = state.update()
+    return " ".join(str(v[name]) for name in (
+        "swpd", "free", "buff", "cache", "bi", "bo", "us", "sy", "id", "wa", "st"
+    )) + "\n"
+
+
+def meminfo_output(state: DeviceState) -> str:
+    state.update()
+    available = state.free_mem + state.cache_mem + state.buff_mem
+    return (
+        f"MemTotal:       {state.total_mem} kB\n"
+        f"MemFree:        {int(state.free_mem)} kB\n"
+        f"MemAvailable:   {int(available)} kB\n"
+        f"Buffers:        {int(state.buff_mem)} kB\n"
+        f"Cached:         {int(state.cache_mem)} kB\n"
+        f"SwapTotal:      {state.total_mem} kB\n"
+        f"SwapFree:       {int(state.total_mem - state.swpd_mem)} kB\n"
+    )
+
+
+def stat_output(state: DeviceState) -> str:
+    state.update()
+    ticks = " ".join(str(int(t)) for t in state.cpu_ticks)
+    return f"cpu  {ticks} 0 0\nbtime {int(state.boot_time)}\n"
+
+
+def loadavg_output(state: DeviceState) -> str:
+    state.update()
+    load = state.cpu_base / 25
+    return f"{load:.2f} {load * 0.9:.2f} {load * 0.8:.2f} 1/120 {random.randint(1000, 30000)}\n"
+
+
+def uptime_output(state: DeviceState) -> str:
+    seconds = time.time() - state.boot_time
+    return f"{time.strftime('%H:%M:%S')} up {int(seconds // 60)} min,  1 user,  load average: {state.cpu_base / 25:.2f}\n"
+
+
+COMMANDS = {
+    "cat /proc/meminfo": meminfo_output,
+    "cat /proc/stat": stat_output,
+    "cat /proc/loadavg": loadavg_output,
+    "uptime": uptime_output,
+}
+
+
+def run_command(state: DeviceState, command: str) -> str:
+    if command.startswith("vmstat"):
+        return vmstat_awk_output(state) if "NR==3" in command else vmstat_output(state)
+    if command in COMMANDS:
+        return COMMANDS[command](state)
+    if command == "hostname":
+        return state.name + "\n"
+    if command.startswith("seq ") and command[4:].strip().isdigit():
+        # 用来产生指定大小的输出
+        return "".join(f"{i}\n" for i in range(1, int(command[4:]) + 1))
+    return f"-bash: {command.split()[0]}: command not found\n"
+
+
+class _DeviceServer(asyncssh.SSHServer):
+    def __init__(self, fleet: "DeviceFleet"):
+        self.fleet = fleet
+
+    def connection_made(self, conn: asyncssh.SSHServerConnection):
+        self.fleet.connections += 1
+
+    def connection_lost(self, exc: Optional[Exception]):
+        self.fleet.connections -= 1
+
+    def begin_auth(self, username: str) -> bool:
+        return True
+
+    def password_auth_supported(self) -> bool:
+        return True
+
+    def validate_password(self, username: str, password: str) -> bool:
+        options = self.fleet.options
+        if random.random() < options.auth_fail_rate:
+            self.fleet.auth_failures += 1
+            return False
+        return username == options.username and password == options.password
+
+
+class DeviceFleet:
+    def __init__(self, options: FleetOptions):
+        self.options = options
+        self.devices: List[DeviceState] = []
+        self.servers: List[asyncssh.SSHAcceptor] = []
+        self.connections = 0
+        self.commands = 0
+        self.drops = 0
+        self.auth_failures = 0
+
+    @property
+    def ports(self) -> range:
+        return range(self.options.base_port, self.options.base_port + self.options.devices)
+
+    async def _delay(self):
+        if self.options.latency > 0:
+            await asyncio.sleep(max(random.gauss(self.options.latency, self.options.jitter), 0))
+
+    async def _shell(self, process: asyncssh.SSHServerProcess, state: DeviceState):
+        prompt = f"[{self.options.username}@{state.name} ~]# "
+        process.stdout.write(f"Last login: {time.ctime()} from {self.options.host}\n{prompt}")
+        try:
+            while True:
+                line = await process.stdin.readline()
+                if line == "":
+                    break
+                command = line.strip()
+                if command in ("exit", "logout"):
+                    break
+                if command == "":
+                    process.stdout.write(prompt)
+                    continue
+                self.commands += 1
+                await self._delay()
+                if random.random() < self.options.drop_rate:
+                    self.drops += 1
+                    process.channel.get_connection().abort()
+                    return
+                process.stdout.write(run_command(state, command) + prompt)
+        except (asyncssh.BreakReceived, asyncssh.TerminalSizeChanged, asyncssh.SignalReceived):
+            process.stdout.write("^C\n" + prompt)
+        except (asyncssh.ConnectionLost, BrokenPipeError):
+            return
+        process.exit(0)
+
+    async def _handle(self, process: asyncssh.SSHServerProcess, state: DeviceState):
+        if process.command:
+            # ssh host "command" 形式，不开交互式终端
+            await self._delay()
+            process.stdout.write(run_command(state, process.command.strip()))
+            process.exit(0)
+            return
+        await self._shell(process, state)
+
+    async def start(self):
+        server_key = asyncssh.generate_private_key("ssh-ed25519")
+        for index, port in enumerate(self.ports):
+            state = new_device(index, self.options)
+            self.devices.append(state)
+            server = await asyncssh.create_server(
+                lambda: _DeviceServer(self), self.options.host, port,
+                server_host_keys=[server_key],
+                process_factory=lambda process, state=state: self._handle(process, state),
+                encoding="utf-8",
+            )
+            self.servers.append(server)
+
+    async def close(self):
+        for server in self.servers:
+            server.close()
+            await server.wait_closed()
+        self.servers.clear()
+
+    def stats(self) -> dict:
+        return {
+            "devices": len(self.devices),
+            "connections": self.connections,
+            "commands": self.commands,
+            "drops": self.drops,
+            "authFailures": self.auth_failures,
+        }
+
+    def timed_task_operations(self, interval: int = 5) -> dict:
+        """每台设备一个采集设备运行状况的定时任务，作为 /interview/timedTask/bulk 的请求体"""
+        return {
+            "operations": [
+                {
+                    "operate": 0,
+                    "taskName": f"模拟设备{state.name}",
+                    "timedTaskKind": 0,
+                    "objIP": self.options.host,
+                    "objSshPort": port,
+                    "objSshUser": self.options.username,
+                    "objSshPassword": self.options.password,
+                    "interval": interval,
+                }
+                for state, port in zip(self.devices, self.ports)
+            ]
+        }
+
+
+async def main(options: FleetOptions, tasks_file: Optional[str], task_interval: int, stats_interval: float):
+    if options.seed is not None:
+        random.seed(options.seed)
+    fleet = DeviceFleet(options)
+    await fleet.start()
+    print(f"已启动{options.devices}台模拟设备：{options.host}:{fleet.ports.start}-{fleet.ports.stop - 1}")
+    if tasks_file:
+        # bulk接口一次最多1000个操作，按1000个一组输出为多行
+        operations = fleet.timed_task_operations(task_interval)["operations"]
+        with open(tasks_file, "w", encoding="utf-8") as f:
+            for start in range(0, len(operations), 1000):
+                f.write(json.dumps({"operations": operations[start:start + 1000]}, ensure_ascii=False) + "\n")
+        print(f"定时任务请求体已写入{tasks_file}")
+    try:
+        while True:
+            await asyncio.sleep(stats_interval)
+            print(json.dumps(fleet.stats()))
+    finally:
+        await fleet.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="模拟设备集群")
+    parser.add_argument("--devices", type=int, default=10)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--base-port", type=int, default=20000)
+    parser.add_argument("--username", default="root")
+    parser.add_argument("--password", default="root")
+    parser.add_argument("--latency", type=float, default=0.02, help="平均响应延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.01, help="响应延迟的标准差（秒）")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="执行命令时断开连接的概率")
+    parser.add_argument("--auth-fail-rate", type=float, default=0.0, help="认证失败的概率")
+    parser.add_argument("--leak-rate", type=float, default=0.0, help="发生内存泄漏的设备比例")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--tasks-file", default=None, help="输出bulk接口请求体的文件")
+    parser.add_argument("--task-interval", type=int, default=5, help="定时任务的执行间隔（秒）")
+    parser.add_argument("--stats-interval", type=float, default=10)
+    args = parser.parse_args()
+    try:
+        asyncio.run(main(
+            FleetOptions(
+                devices=args.devices, host=args.host, base_port=args.base_port,
+                username=args.username, password=args.password,
+                latency=args.latency, jitter=args.jitter, drop_rate=args.drop_rate,
+                auth_fail_rate=args.auth_fail_rate, leak_rate=args.leak_rate, seed=args.seed,
+            ),
+            args.tasks_file, args.task_interval, args.stats_interval
+        ))
+    except KeyboardInterrupt:
+        ...
@@ -0,0 +1,205 @@
+import asyncio
+import time
+import traceback
+from collections import deque
+from typing import Awaitable, Callable, Optional, List
+
+from bson import ObjectId
+from motor.core import AgnosticCollection
+from pymongo.errors import BulkWriteError
+
+from utils.metrics import REGISTRY
+from utils.mongo_client import AsyncMongoClient
+from utils.spool import DiskSpool
+
+
+class BatchWriter:
+    """
+    把单条写入攒成insert_many，定时或者攒够max_batch条之后写入
+    只有一个协程负责写入，mongodb变慢时不会堆积大量并发的重试
+    写入失败的数据放回队列头部等待下次写入，超过max_pending时丢弃最旧的数据
+    设置了spool时写入失败的数据改为写到磁盘，磁盘上还有数据时新数据也先写磁盘（保证顺序），
+    每隔retry_interval秒尝试按spool_batch条一批回放，回放成功后调用on_replay（例如标记需要重新汇总的时间段）
+    """
+    instances: List["BatchWriter"] = list()
+
+    def __init__(
+            self,
+            collect_name: str,
+            max_batch: int = 1000,
+            flush_interval: float = 1,
+            max_pending: int = 100000,
+            spool: Optional[DiskSpool] = None,
+            spool_batch: int = 5000,
+            retry_interval: float = 5,
+            on_replay: Optional[Callable[[List[dict]], Awaitable[None]]] = None
+    ):
+        self.collect_name = collect_name
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.spool = spool
+        self.spool_batch = spool_batch
+        self.retry_interval = retry_interval
+        self.on_replay = on_replay
+        self._retry_at = 0.0
+        self._pending: deque = deque()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_event: Optional[asyncio.Event] = None
+        self._flush_lock = asyncio.Lock()
+        self.written = 0
+        self.dropped = 0
+        BatchWriter.instances.append(self)
+
+    def attach_spool(self, spool: DiskSpool):
+        """启动调度之后再挂上磁盘缓冲，只导入模块、不写入数据的进程不会占用槽位"""
+        self.spool = spool
+        # 遗留的数据不用等到有新数据写入才回放
+        if spool.has_data():
+            self._start_flush_loop()
+
+    def add(self, document: dict):
+        self._pending.append(document)
+        if len(self._pending) > self.max_pending:
+            self._pending.popleft()
+            self.dropped += 1
+        self._start_flush_loop()
+        if len(self._pending) >= self.max_batch:
+            self._flush_event.set()
+
+    def is_idle(self) -> bool:
+        """内存和磁盘缓冲里都没有等待写入的数据"""
+        return not self._pending and (self.spool is None or not self.spool.has_data())
+
+    def _start_flush_loop(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_event = asyncio.Event()
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_event.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event.clear()
+            await self.flush()
+
+    async def flush(self):
+        async with self._flush_lock:
+            collect: AgnosticCollection = AsyncMongoClient[self.collect_name]
+            if self.spool is not None and (self.spool.has_data() or time.monotonic() < self._retry_at):
+                await self._spool_pending()
+                if time.monotonic() < self._retry_at or not await self._replay(collect):
+                    return
+            while self._pending:
+                batch = [self._pending.popleft() for _ in range(min(self.max_batch, len(self._pending)))]
+                try:
+                    retry = await self._write(collect, batch)
+                except Exception:
+                    print(traceback.format_exc())
+                    self._pending.extendleft(reversed(batch))
+                    await self._on_write_failed()
+                    break
+                self.written += len(batch) - len(retry)
+                if retry:
+                    self._pending.extendleft(reversed(retry))
+                    await self._on_write_failed()
+                    break
+
+    async def _on_write_failed(self):
+        if self.spool is not None:
+            self._retry_at = time.monotonic() + self.retry_interval
+            await self._spool_pending()
+
+    async def _spool_pending(self):
+        """
+        内存里的数据全部转到磁盘，先分配好_id，回放时重复写入会因为_id重复被跳过
+        写磁盘（fsync）放到线程里，期间新加入的数据留在队列里等下一次
+        """
+        if not self._pending:
+            return
+        batch = [self._pending.popleft() for _ in range(len(self._pending))]
+        for document in batch:
+            document.setdefault("_id", ObjectId())
+        try:
+            await asyncio.to_thread(self.spool.append, batch)
+        except Exception:
+            # 磁盘也写不进去时放回内存，受max_pending限制
+            print(traceback.format_exc())
+            self._pending.extendleft(reversed(batch))
+
+    async def _replay(self, collect: AgnosticCollection) -> bool:
+        """
+        按顺序回放磁盘上的数据，全部写完返回True，失败时等retry_interval之后再试
+        只有部分写入成功时（例如按桶写入时部分桶失败）推进读取位置，只把失败的部分重新追加到磁盘，
+        不会重复写入已经成功的部分
+        """
+        while True:
+            batch, position = await asyncio.to_thread(self.spool.read, self.spool_batch)
+            if not batch:
+                return True
+            try:
+                retry = await self._write(collect, batch)
+            except Exception:
+                print(f"{self.collect_name}回放失败：{traceback.format_exc(limit=1)}")
+                retry = batch
+            if len(retry) >= len(batch):
+                # 整批都没有写入，下次从同一个位置重新回放
+                self._retry_at = time.monotonic() + self.retry_interval
+                return False
+            if retry:
+                await asyncio.to_thread(self.spool.requeue, position, len(batch) - len(retry), retry)
+                self._retry_at = time.monotonic() + self.retry_interval
+            else:
+                await asyncio.to_thread(self.spool.commit, position, len(batch))
+            self.written += len(batch) - len(retry)
+            if self.on_replay is not None:
+                try:
+                    await self.on_replay(batch)
+                except Exception:
+                    print(traceback.format_exc())
+            if retry:
+                return False
+
+    async def _write(self, collect: AgnosticCollection, batch: List[dict]) -> List[dict]:
+        """写入一批数据，返回需要重试的部分，子类可以改成其他写入方式"""
+        try:
+            await collect.insert_many(batch, ordered=False)
+        except BulkWriteError as e:
+            # 部分写入成功，重复的_id说明之前已经写进去了，只重试其他失败的
+            errors = e.details.get("writeErrors", [])
+            retry = [batch[err["index"]] for err in errors if err.get("code") != 11000]
+            if retry:
+                print(f"{self.collect_name}写入失败{len(retry)}条：{errors[0].get('errmsg')}")
+            return retry
+        return []
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "collect": self.collect_name,
+            "pending": len(self._pending),
+            "written": self.written,
+            "dropped": self.dropped,
+            "spool": self.spool.stats() if self.spool is not None else None,
+        }
+
+
+REGISTRY.func_counter(
+    "batch_writer_written_total", "批量写入成功的文档数",
+    lambda: {(w.collect_name,): w.written for w in BatchWriter.instances}, ("collect",)
+)
+REGISTRY.func_counter(
+    "batch_writer_dropped_total", "等待写入的数据过多时丢弃的文档数",
+    lambda: {(w.collect_name,): w.dropped for w in BatchWriter.instances}, ("collect",)
+)
+REGISTRY.gauge(
+    "batch_writer_pending", "等待写入的文档数",
+    lambda: {(w.collect_name,): len(w._pending) for w in BatchWriter.instances}, ("collect",)
+)
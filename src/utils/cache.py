@@ -0,0 +1,118 @@
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+
+def make_cache_key(*parts: Any) -> str:
+    """
+    把查询参数规范化成缓存的key：dict按key排序，ObjectId、datetime等转成字符串
+    """
+    return json.dumps(parts, sort_keys=True, default=str, ensure_ascii=False)
+
+
+class AsyncTTLCache:
+    """
+    进程内的TTL + LRU缓存，只在事件循环内使用
+    - 同一个key同时未命中时只会执行一次loader（single-flight），其他协程等待同一个结果
+    - invalidate之后，正在加载中的旧结果不会再写入缓存
+    """
+
+    def __init__(self, maxsize: int = 256, ttl: float = 30, name: str = ""):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._inflight: Dict[Hashable, asyncio.Future] = dict()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            return default
+        expire_at, value = item
+        if expire_at < time.monotonic():
+            self._data.pop(key, None)
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    async def get_or_load(
+            self,
+            key: Hashable,
+            loader: Callable[[], Awaitable[Any]],
+            ttl: Optional[float] = None
+    ) -> Any:
+        _missing = object()
+        value = self.get(key, _missing)
+        if value is not _missing:
+            self.hits += 1
+            return value
+        self.misses += 1
+        if (fut := self._inflight.get(key)) is not None:
+            return await asyncio.shield(fut)
+
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        generation = self._generation
+        try:
+            self.loads += 1
+            value = await loader()
+        except BaseException as e:
+            fut.set_exception(e)
+            # 没有其他协程等待的时候避免 "Future exception was never retrieved"
+            fut.exception()
+            raise
+        else:
+            if generation == self._generation:
+                self.set(key, value, ttl)
+            fut.set_result(value)
+            return value
+        finally:
+            if self._inflight.get(key) is fut:
+                self._inflight.pop(key)
+
+    def invalidate(self, key: Optional[Hashable] = None):
+        """key为None时清空全部"""
+        if key is None:
+            self._data.clear()
+            self._generation += 1
+            self._inflight.clear()
+        else:
+            self._data.pop(key, None)
+            if self._inflight.pop(key, None) is not None:
+                self._generation += 1
+
+    def invalidate_if(self, predicate: Callable[[Hashable], bool]):
+        """清掉predicate(key)为True的缓存"""
+        for key in [key for key in self._data if predicate(key)]:
+            self._data.pop(key, None)
+        for key in [key for key in self._inflight if predicate(key)]:
+            self._inflight.pop(key, None)
+            self._generation += 1
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            "name": self.name,
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "loads": self.loads,
+            "evictions": self.evictions,
+            "hitRate": round(self.hits / requests, 4) if requests else None,
+        }
@@ -0,0 +1,118 @@
+"""
+响应压缩：响应体超过minimum_size时按Accept-Encoding压缩，客户端支持br并且安装了brotli时用brotli，否则用gzip
+只处理一次性返回的响应（接口都是整个json），流式响应、已经设置了Content-Encoding的响应、图片等不压缩
+"""
+import asyncio
+import gzip
+from typing import Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from config import Config
+from utils.metrics import REGISTRY
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 已经压缩过的类型，再压缩没有效果
+_EXCLUDED_CONTENT_TYPES = ("image/", "video/", "audio/", "application/zip", "application/gzip", "text/event-stream")
+# 超过这个大小时放到线程里压缩，避免阻塞事件循环
+_THREAD_MINIMUM_SIZE = 256 * 1024
+
+RESPONSE_BYTES = REGISTRY.counter(
+    "http_response_compression_bytes_total", "压缩的响应体压缩前、后的字节数", ("encoding", "stage")
+)
+
+
+def accepted_encodings(accept_encoding: str) -> set:
+    """解析Accept-Encoding，去掉q=0的"""
+    encodings = set()
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                ...
+        if name and quality > 0:
+            encodings.add(name.strip().lower())
+    return encodings
+
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    encodings = accepted_encodings(accept_encoding)
+    if brotli is not None and "br" in encodings:
+        return "br"
+    if "gzip" in encodings:
+        return "gzip"
+    return None
+
+
+def compress_body(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        # 默认的11级太慢，5级压缩率和gzip 9级相当，速度快很多
+        return brotli.compress(body, quality=Config.RESPONSE_BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=Config.RESPONSE_GZIP_LEVEL)
+
+
+class CompressionMiddleware:
+
+    def __init__(self, app: ASGIApp, minimum_size: int = Config.RESPONSE_COMPRESS_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        start_message: Optional[Message] = None
+        # 不压缩的响应原样转发
+        passthrough = False
+
+        async def send_wrapper(message: Message):
+            nonlocal start_message, passthrough
+            if passthrough:
+                await send(message)
+                return
+            if message["type"] == "http.response.start":
+                headers = Headers(raw=message.get("headers", []))
+                content_type = headers.get("content-type", "")
+                if "content-encoding" in headers or content_type.startswith(_EXCLUDED_CONTENT_TYPES):
+                    passthrough = True
+                    await send(message)
+                else:
+                    # 等到拿到响应体再决定要不要压缩、Content-Length是多少
+                    start_message = message
+                return
+            passthrough = True
+            if message["type"] != "http.response.body":
+                await send(start_message)
+                await send(message)
+                return
+            body = message.get("body", b"")
+            if message.get("more_body", False) or len(body) < self.minimum_size:
+                await send(start_message)
+                await send(message)
+                return
+            if len(body) >= _THREAD_MINIMUM_SIZE:
+                compressed = await asyncio.to_thread(compress_body, body, encoding)
+            else:
+                compressed = compress_body(body, encoding)
+            RESPONSE_BYTES.inc(encoding, "raw", amount=len(body))
+            RESPONSE_BYTES.inc(encoding, "compressed", amount=len(compressed))
+            headers = MutableHeaders(raw=list(start_message.get("headers", [])))
+            headers["Content-Encoding"] = encoding
+            headers["Content-Length"] = str(len(compressed))
+            headers.add_vary_header("Accept-Encoding")
+            await send({**start_message, "headers": headers.raw})
+            await send({**message, "body": compressed})
+
+        await self.app(scope, receive, send_wrapper)
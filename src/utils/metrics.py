@@ -0,0 +1,248 @@
+"""
+简单的Prometheus文本格式指标，不依赖prometheus_client
+热路径上只有一次dict查找和几次加法，多线程（pymongo的监听器）下不加锁，极少数情况下可能丢失一次计数
+"""
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from starlette.responses import Response
+from starlette.types import ASGIApp, Receive, Scope, Send, Message
+
+from utils.monitor import LatencyHistogram, DEFAULT_BUCKETS, SchedulerMonitor, LoopMonitor
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+    def expose(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[Tuple, float] = dict()
+
+    def inc(self, *label_values, amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values) -> float:
+        return self._values.get(label_values, 0)
+
+    def expose(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+            for key, value in list(self._values.items())
+        ]
+
+
+class Gauge(_Metric):
+    """值由func在导出时计算，func返回 {label值元组: 值}，没有label时返回一个数"""
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, func: Callable, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self.func = func
+
+    def expose(self) -> List[str]:
+        value = self.func()
+        items = value.items() if isinstance(value, dict) else [((), value)]
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(v)}" for key, v in items]
+
+
+class FuncCounter(Gauge):
+    """已经在别处累计好的计数（比如BatchWriter.written），导出时读取"""
+    kind = "counter"
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+            self, name: str, documentation: str, labels: Sequence[str] = (),
+            buckets: Sequence[float] = DEFAULT_BUCKETS
+    ):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        self._histograms: Dict[Tuple, LatencyHistogram] = dict()
+
+    def labels(self, *label_values) -> LatencyHistogram:
+        histogram = self._histograms.get(label_values)
+        if histogram is None:
+            histogram = self._histograms[label_values] = LatencyHistogram(self.buckets)
+        return histogram
+
+    def observe(self, value: float, *label_values):
+        self.labels(*label_values).observe(value)
+
+    def time(self, *label_values):
+        return _Timer(self.labels(*label_values))
+
+    def expose(self) -> List[str]:
+        lines = []
+        for key, histogram in list(self._histograms.items()):
+            lines.extend(histogram_lines(self.name, self.label_names, key, histogram))
+        return lines
+
+
+class _Timer:
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram: LatencyHistogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+def histogram_lines(
+        name: str, label_names: Sequence[str], label_values: Sequence, histogram: LatencyHistogram
+) -> List[str]:
+    labels = _format_labels(label_names, label_values)
+    lines = []
+    cumulative = 0
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        le = 'le="%s"' % bound
+        lines.append(f"{name}_bucket{_format_labels(label_names, label_values, le)} {cumulative}")
+    le = 'le="+Inf"'
+    lines.append(f"{name}_bucket{_format_labels(label_names, label_values, le)} {histogram.count}")
+    lines.append(f"{name}_sum{labels} {_format_value(histogram.sum)}")
+    lines.append(f"{name}_count{labels} {histogram.count}")
+    return lines
+
+
+class _ExternalHistogram(_Metric):
+    """导出已经存在的LatencyHistogram，比如SchedulerMonitor里的"""
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, histogram: LatencyHistogram):
+        super().__init__(name, documentation)
+        self.histogram = histogram
+
+    def expose(self) -> List[str]:
+        return histogram_lines(self.name, (), (), self.histogram)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = dict()
+
+    def register(self, metric: _Metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"指标{metric.name}已经存在")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, func: Callable, labels: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, func, labels))
+
+    def func_counter(self, name: str, documentation: str, func: Callable, labels: Sequence[str] = ()) -> FuncCounter:
+        return self.register(FuncCounter(name, documentation, func, labels))
+
+    def histogram(
+            self, name: str, documentation: str, labels: Sequence[str] = (),
+            buckets: Optional[Iterable[float]] = None
+    ) -> Histogram:
+        return self.register(Histogram(name, documentation, labels, buckets or DEFAULT_BUCKETS))
+
+    def external_histogram(self, name: str, documentation: str, histogram: LatencyHistogram):
+        return self.register(_ExternalHistogram(name, documentation, histogram))
+
+    def expose(self) -> str:
+        lines = []
+        for metric in list(self._metrics.values()):
+            try:
+                samples = metric.expose()
+            except Exception as e:
+                print(f"导出指标{metric.name}失败：{e}")
+                continue
+            lines.extend(metric.header())
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HTTP_REQUEST_DURATION = REGISTRY.histogram(
+    "http_request_duration_seconds", "接口耗时，route为路由模板", ("method", "route", "status")
+)
+
+REGISTRY.external_histogram(
+    "scheduler_fire_lag_seconds", "定时任务实际执行时间比计划时间晚的时间", SchedulerMonitor.fire_lag
+)
+REGISTRY.external_histogram(
+    "scheduler_job_duration_seconds", "定时任务执行耗时", SchedulerMonitor.run_duration
+)
+REGISTRY.func_counter("scheduler_job_missed_total", "错过执行的定时任务次数", lambda: SchedulerMonitor.missed)
+REGISTRY.external_histogram("event_loop_lag_seconds", "事件循环延迟", LoopMonitor.lag)
+
+
+class MetricsMiddleware:
+    """
+    纯ASGI中间件，记录每个请求的耗时
+    路由匹配之后FastAPI会把路由放进scope["route"]，用路由模板做label，避免路径参数导致label无限增长
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message: Message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            HTTP_REQUEST_DURATION.observe(
+                time.perf_counter() - start,
+                scope["method"], getattr(route, "path", "<unmatched>"), status
+            )
+
+
+async def metrics_endpoint() -> Response:
+    return Response(REGISTRY.expose(), media_type="text/plain; version=0.0.4; charset=utf-8")
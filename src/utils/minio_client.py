@@ -8,7 +8,7 @@ import aiohttp
 from aiohttp import ClientResponse
 from miniopy_async import Minio as AsyncMinio
 
-from src.config import Config
+from config import Config
 
 
 def object_filename_and_ext(object_name) -> (str, str):
@@ -103,6 +103,32 @@ class AsyncMinioClient(metaclass=_SingleInstance):
             print(err)
         return None
 
+    async def put_bytes(self, bucket_name: str, object_name: str, data: bytes,
+                        content_type='application/octet-stream'):
+        """
+        Description: 上传内存中的数据，对象名不加UUID，失败时抛出异常
+        :param bucket_name: bucket名称
+        :param object_name: 对象名称
+        :param data: 数据
+        :param content_type: Content type of the object.
+        """
+        await self.minio_client.put_object(bucket_name, object_name, BytesIO(data), len(data), content_type)
+
+    async def get_bytes(self, bucket_name: str, object_name: str) -> bytes:
+        """
+        Description: 读取整个对象，失败时抛出异常
+        """
+        response: ClientResponse = await self.minio_client.get_object(bucket_name, object_name)
+        try:
+            return await response.read()
+        finally:
+            response.release()
+
+    async def ensure_bucket(self, bucket_name: str):
+        """bucket不存在时创建"""
+        if not await self.minio_client.bucket_exists(bucket_name):
+            await self.minio_client.make_bucket(bucket_name)
+
     async def put_object_by_buffer(self, bucket_name, file_data, sub_path='', object_name=None):
         """
         Description: 上传对象，适用于文件流，类似于HTTP网络流
@@ -1,14 +1,84 @@
 import asyncio
+import re
 from asyncio import AbstractEventLoop
-from typing import Optional, Dict
+from typing import Optional, Dict, Union
 
 from motor.core import AgnosticDatabase, AgnosticCollection
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import monitoring
+from pymongo.read_preferences import (
+    Nearest, Primary, PrimaryPreferred, ReadPreference, Secondary, SecondaryPreferred
+)
+
+from utils.metrics import REGISTRY
+from utils.slow_query import SlowQueryProfiler
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import snappy
+except ImportError:
+    snappy = None
+
+ReadPreferenceMode = Union[Primary, PrimaryPreferred, Secondary, SecondaryPreferred, Nearest]
+
+# 和连接串里readPreference的取值一致，比较时不区分大小写
+_READ_PREFERENCES: Dict[str, ReadPreferenceMode] = {
+    "primary": ReadPreference.PRIMARY,
+    "primaryPreferred": ReadPreference.PRIMARY_PREFERRED,
+    "secondary": ReadPreference.SECONDARY,
+    "secondaryPreferred": ReadPreference.SECONDARY_PREFERRED,
+    "nearest": ReadPreference.NEAREST,
+}
+
+MONGO_COMMAND_DURATION = REGISTRY.histogram(
+    "mongo_command_duration_seconds", "mongodb命令耗时", ("command", "result")
+)
+
+
+class CommandMetricsListener(monitoring.CommandListener):
+    """pymongo在执行命令的线程里回调，这里只做加法"""
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        ...
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        MONGO_COMMAND_DURATION.observe(event.duration_micros / 1e6, event.command_name, "ok")
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        MONGO_COMMAND_DURATION.observe(event.duration_micros / 1e6, event.command_name, "error")
+
+
+def available_compressors(names: str) -> list:
+    """逗号分隔的压缩方式中当前环境可用的，zlib为标准库，zstd、snappy需要安装对应的库"""
+    available = {
+        "zstd": zstandard is not None,
+        "snappy": snappy is not None,
+        "zlib": True,
+    }
+    return [name for name in (name.strip() for name in names.split(",")) if available.get(name)]
+
+
+def parse_read_preference(name: str) -> ReadPreferenceMode:
+    for key, mode in _READ_PREFERENCES.items():
+        if key.lower() == name.strip().lower():
+            return mode
+    raise ValueError(f"不支持的readPreference：{name!r}，可选值为{'、'.join(_READ_PREFERENCES)}")
+
+
+def mask_uri(uri: str) -> str:
+    """日志里隐藏连接串中的密码"""
+    return re.sub(r"(://[^:/@]+):[^@]*@", r"\1:***@", uri)
 
 
 class __MotorMongodbMeta(type):
     _client = None
     _db: AgnosticDatabase = None
+    _analytics_read_preference: ReadPreferenceMode = ReadPreference.PRIMARY
+    _options: dict = dict()
     motor_databases: Dict[str, AgnosticDatabase] = dict()
 
     def __init__(cls, *args, **kwargs):
@@ -27,9 +97,78 @@ class __MotorMongodbMeta(type):
 class AsyncMongoClient(metaclass=__MotorMongodbMeta):
 
     @classmethod
-    def start(cls, uri: str, lp: Optional[AbstractEventLoop] = None):
+    def start(
+            cls,
+            uri: str,
+            lp: Optional[AbstractEventLoop] = None,
+            analytics_read_preference: Optional[str] = None,
+            **options
+    ):
+        """
+        :param analytics_read_preference: analytics()返回的集合使用的读偏好
+        :param options: 传给AsyncIOMotorClient的连接池、压缩、超时等参数
+        """
+        # 配置错误时在建立连接之前报错
+        if analytics_read_preference:
+            cls._analytics_read_preference = parse_read_preference(analytics_read_preference)
         _loop = lp or asyncio.get_event_loop()
-        cls._client = AsyncIOMotorClient(uri, io_loop=_loop)
+        cls._client = AsyncIOMotorClient(
+            uri, io_loop=_loop, event_listeners=[CommandMetricsListener(), SlowQueryProfiler()], **options
+        )
+        cls._options = options
+        SlowQueryProfiler.bind(cls._client, _loop)
+
+    @classmethod
+    def analytics(cls, name: str) -> AgnosticCollection:
+        """只读的分析查询（详情、对比、统计、报表）使用的集合，可以配置为从secondary读"""
+        return cls[name].with_options(read_preference=cls._analytics_read_preference)
+
+    @classmethod
+    async def warm_up(cls, connections: int, timeout: float = 10) -> int:
+        """
+        并发执行ping，让连接池预先建立connections个连接，避免启动后的第一批请求等待建立连接、认证
+        :return: 成功的ping数
+        """
+        if connections <= 0:
+            return 0
+
+        async def _ping() -> bool:
+            try:
+                await cls._client.admin.command("ping")
+                return True
+            except Exception:
+                return False
+
+        try:
+            results = await asyncio.wait_for(asyncio.gather(*(_ping() for _ in range(connections))), timeout)
+        except asyncio.TimeoutError:
+            return 0
+        return sum(results)
+
+    @classmethod
+    def settings(cls) -> dict:
+        """实际生效的连接设置，用于启动日志"""
+        options = cls._client.options
+        pool = options.pool_options
+        return {
+            "hosts": [f"{host}:{port}" for host, port in cls._client.topology_description.server_descriptions()],
+            "maxPoolSize": pool.max_pool_size,
+            "minPoolSize": pool.min_pool_size,
+            "compressors": cls._options.get("compressors"),
+            "serverSelectionTimeoutMS": int(options.server_selection_timeout * 1000),
+            "connectTimeoutMS": int(pool.connect_timeout * 1000) if pool.connect_timeout else None,
+            "socketTimeoutMS": int(pool.socket_timeout * 1000) if pool.socket_timeout else None,
+            "readPreference": cls._client.read_preference.mongos_mode,
+            "analyticsReadPreference": cls._analytics_read_preference.mongos_mode,
+        }
+
+    @classmethod
+    async def ping(cls, timeout: float = 1) -> bool:
+        try:
+            await asyncio.wait_for(cls._client.admin.command("ping"), timeout)
+            return True
+        except Exception:
+            return False
 
     @classmethod
     def close(cls):
@@ -37,6 +176,9 @@ class AsyncMongoClient(metaclass=__MotorMongodbMeta):
             cls._client.close()
         except Exception:
             pass
+        # 缓存的db属于已关闭的client，重新start后不能再用
+        cls.motor_databases.clear()
+        cls._db = None
 
     @classmethod
     def switch_db(cls, db_name: str):
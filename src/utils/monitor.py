@@ -0,0 +1,213 @@
+import asyncio
+import bisect
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from datetime import datetime, UTC
+from typing import Dict, Optional, Sequence, Tuple
+
+from apscheduler.events import EVENT_JOB_SUBMITTED, EVENT_JOB_EXECUTED, EVENT_JOB_ERROR, EVENT_JOB_MISSED
+
+# 默认的桶边界（秒），从1ms到5min
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1, 2.5, 5, 10, 30, 60, 300,
+)
+
+
+class LatencyHistogram:
+    """
+    固定桶的直方图，observe为O(log 桶数)，分位数用所在桶的上边界估计
+    """
+    __slots__ = ("buckets", "counts", "count", "sum", "max")
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q: float) -> Optional[float]:
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= rank and count:
+                return self.buckets[index] if index < len(self.buckets) else self.max
+        return self.max
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count else None,
+            "max": self.max if self.count else None,
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "p99": self.percentile(0.99),
+            "buckets": {
+                **{str(bound): count for bound, count in zip(self.buckets, self.counts)},
+                "+Inf": self.counts[-1],
+            },
+        }
+
+
+class _JobStats:
+    __slots__ = ("runs", "missed", "last_lag", "max_lag", "last_duration", "max_duration")
+
+    def __init__(self):
+        self.runs = 0
+        self.missed = 0
+        self.last_lag = None
+        self.max_lag = 0.0
+        self.last_duration = None
+        self.max_duration = 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "runs": self.runs,
+            "missed": self.missed,
+            "lastLag": self.last_lag,
+            "maxLag": self.max_lag,
+            "lastDuration": self.last_duration,
+            "maxDuration": self.max_duration,
+        }
+
+
+class SchedulerMonitor:
+    """
+    根据apscheduler的事件统计任务实际执行时间比计划时间晚了多少（fire lag），以及执行耗时
+    """
+    fire_lag = LatencyHistogram()
+    run_duration = LatencyHistogram()
+    missed = 0
+    max_jobs = 10000
+
+    _jobs: Dict[str, _JobStats] = dict()
+    _running: Dict[Tuple[str, datetime], float] = dict()
+
+    @classmethod
+    def _job(cls, job_id: str) -> _JobStats:
+        stats = cls._jobs.get(job_id)
+        if stats is None:
+            if len(cls._jobs) >= cls.max_jobs:
+                cls._jobs.pop(next(iter(cls._jobs)))
+            stats = cls._jobs[job_id] = _JobStats()
+        return stats
+
+    @classmethod
+    def record(cls, event):
+        code = event.code
+        if code == EVENT_JOB_SUBMITTED:
+            now = datetime.now(UTC)
+            stats = cls._job(event.job_id)
+            for run_time in event.scheduled_run_times:
+                lag = max((now - run_time).total_seconds(), 0.0)
+                cls.fire_lag.observe(lag)
+                stats.last_lag = lag
+                stats.max_lag = max(stats.max_lag, lag)
+                cls._running[(event.job_id, run_time)] = time.monotonic()
+        elif code in (EVENT_JOB_EXECUTED, EVENT_JOB_ERROR):
+            start = cls._running.pop((event.job_id, event.scheduled_run_time), None)
+            if start is None:
+                return
+            duration = time.monotonic() - start
+            cls.run_duration.observe(duration)
+            stats = cls._job(event.job_id)
+            stats.runs += 1
+            stats.last_duration = duration
+            stats.max_duration = max(stats.max_duration, duration)
+        elif code == EVENT_JOB_MISSED:
+            cls.missed += 1
+            cls._job(event.job_id).missed += 1
+
+    @classmethod
+    def snapshot(cls, top: int = 20) -> dict:
+        slowest = sorted(cls._jobs.items(), key=lambda x: x[1].max_lag, reverse=True)[:top]
+        return {
+            "fireLag": cls.fire_lag.snapshot(),
+            "runDuration": cls.run_duration.snapshot(),
+            "missed": cls.missed,
+            "running": len(cls._running),
+            "slowestJobs": {job_id: stats.to_dict() for job_id, stats in slowest},
+        }
+
+
+class LoopMonitor:
+    """
+    事件循环延迟探针：协程每隔interval醒来一次，实际醒来时间比预期晚的部分就是事件循环被阻塞的时间
+    另外有一个看门狗线程，事件循环超过slow_threshold没有心跳时抓取事件循环线程当前的调用栈
+    """
+    interval: float = 0.5
+    slow_threshold: float = 0.2
+
+    lag = LatencyHistogram()
+    slow_reports: deque = deque(maxlen=50)
+
+    _task: Optional[asyncio.Task] = None
+    _watchdog: Optional[threading.Thread] = None
+    _stop = threading.Event()
+    _last_beat: float = 0.0
+    _loop_thread_id: Optional[int] = None
+
+    @classmethod
+    def start(cls):
+        if cls._task is not None and not cls._task.done():
+            return
+        cls._loop_thread_id = threading.get_ident()
+        cls._last_beat = time.monotonic()
+        cls._stop.clear()
+        cls._task = asyncio.get_running_loop().create_task(cls._probe())
+        cls._watchdog = threading.Thread(target=cls._watch, name="loop-watchdog", daemon=True)
+        cls._watchdog.start()
+
+    @classmethod
+    def stop(cls):
+        cls._stop.set()
+        if cls._task is not None:
+            cls._task.cancel()
+            cls._task = None
+
+    @classmethod
+    async def _probe(cls):
+        while True:
+            expected = time.monotonic() + cls.interval
+            await asyncio.sleep(cls.interval)
+            now = time.monotonic()
+            cls._last_beat = now
+            cls.lag.observe(max(now - expected, 0.0))
+
+    @classmethod
+    def _watch(cls):
+        reported_beat = None
+        while not cls._stop.wait(cls.slow_threshold / 2):
+            last_beat = cls._last_beat
+            blocked = time.monotonic() - last_beat - cls.interval
+            if blocked < cls.slow_threshold or reported_beat == last_beat:
+                continue
+            # 同一次阻塞只记录一次
+            reported_beat = last_beat
+            frame = sys._current_frames().get(cls._loop_thread_id)
+            cls.slow_reports.append({
+                "time": datetime.now(),
+                "blockedSeconds": round(blocked, 3),
+                "stack": traceback.format_stack(frame) if frame is not None else [],
+            })
+
+    @classmethod
+    def snapshot(cls) -> dict:
+        return {
+            "lag": cls.lag.snapshot(),
+            "slowCallbacks": list(cls.slow_reports),
+        }
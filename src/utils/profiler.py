@@ -0,0 +1,192 @@
+"""
+在运行中的进程里按需做cpu和内存分析：
+- sample：独立线程定时读取所有线程的调用栈，输出flamegraph.pl / speedscope可以直接使用的折叠栈格式
+- cprofile：在事件循环线程上开启cProfile，统计这段时间内事件循环执行的所有回调
+- yappi：可选依赖，能区分协程的耗时，未安装时不可用
+- tracemalloc：保存一个基准快照，之后的快照和基准比较，找出增长最多的分配位置
+"""
+import asyncio
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from typing import Optional
+
+try:
+    import yappi
+except ImportError:
+    yappi = None
+
+PROFILE_MODES = ("sample", "cprofile", "yappi")
+
+
+class ProfilerBusyError(Exception):
+    ...
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    path = code.co_filename.replace("\\", "/").split("/")
+    return f"{code.co_name} ({'/'.join(path[-2:])}:{code.co_firstlineno})"
+
+
+def _collapse(frame) -> str:
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    names.reverse()
+    return ";".join(names)
+
+
+class CpuProfiler:
+    _lock = asyncio.Lock()
+
+    @classmethod
+    async def run(cls, seconds: float, mode: str = "sample", interval: float = 0.005, top: int = 50) -> str:
+        if cls._lock.locked():
+            raise ProfilerBusyError("已经有一个分析任务在运行")
+        async with cls._lock:
+            if mode == "sample":
+                return await cls._sample(seconds, interval)
+            if mode == "cprofile":
+                return await cls._cprofile(seconds, top)
+            if mode == "yappi":
+                return await cls._yappi(seconds, top)
+            raise ValueError(f"不支持的分析方式{mode}，可选：{PROFILE_MODES}")
+
+    @classmethod
+    async def _sample(cls, seconds: float, interval: float) -> str:
+        stacks: Counter = Counter()
+        stop = threading.Event()
+
+        def sampler():
+            own_id = threading.get_ident()
+            thread_names = dict()
+            while not stop.wait(interval):
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id == own_id:
+                        continue
+                    if thread_id not in thread_names:
+                        thread_names = {t.ident: t.name for t in threading.enumerate()}
+                    name = thread_names.get(thread_id, str(thread_id))
+                    stacks[f"{name};{_collapse(frame)}"] += 1
+
+        thread = threading.Thread(target=sampler, name="cpu-sampler", daemon=True)
+        thread.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            stop.set()
+            await asyncio.get_running_loop().run_in_executor(None, thread.join)
+        return "\n".join(f"{stack} {count}" for stack, count in stacks.most_common()) + "\n"
+
+    @classmethod
+    async def _cprofile(cls, seconds: float, top: int) -> str:
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profile.disable()
+        output = io.StringIO()
+        pstats.Stats(profile, stream=output).sort_stats("cumulative").print_stats(top)
+        return output.getvalue()
+
+    @classmethod
+    async def _yappi(cls, seconds: float, top: int) -> str:
+        if yappi is None:
+            raise ValueError("未安装yappi，pip install yappi")
+        yappi.clear_stats()
+        yappi.set_clock_type("cpu")
+        yappi.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            yappi.stop()
+        stats = yappi.get_func_stats()
+        stats.sort("ttot", "desc")
+        lines = [f"{'ncall':>10} {'tsub':>10} {'ttot':>10}  function"]
+        for stat in list(stats)[:top]:
+            lines.append(
+                f"{stat.ncall:>10} {stat.tsub:>10.4f} {stat.ttot:>10.4f}  "
+                f"{stat.name} ({os.path.basename(stat.module)}:{stat.lineno})"
+            )
+        yappi.clear_stats()
+        return "\n".join(lines) + "\n"
+
+
+_SNAPSHOT_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+)
+
+
+class MemoryProfiler:
+    _baseline: Optional[tracemalloc.Snapshot] = None
+    _baseline_time: Optional[float] = None
+
+    @classmethod
+    async def start(cls, frames: int = 10) -> dict:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+        cls._baseline = await asyncio.to_thread(cls._take_snapshot)
+        cls._baseline_time = time.time()
+        return cls.status()
+
+    @classmethod
+    def stop(cls) -> dict:
+        tracemalloc.stop()
+        cls._baseline = cls._baseline_time = None
+        return cls.status()
+
+    @staticmethod
+    def _take_snapshot() -> tracemalloc.Snapshot:
+        """快照和过滤要遍历所有的分配记录，对象多时耗时可达秒级，放到线程里执行"""
+        return tracemalloc.take_snapshot().filter_traces(_SNAPSHOT_FILTERS)
+
+    @staticmethod
+    def _compare(snapshot: tracemalloc.Snapshot, baseline: tracemalloc.Snapshot, group_by: str, top: int) -> list:
+        return [
+            {
+                "sizeDiff": stat.size_diff,
+                "size": stat.size,
+                "countDiff": stat.count_diff,
+                "count": stat.count,
+                "traceback": stat.traceback.format(),
+            }
+            for stat in snapshot.compare_to(baseline, group_by)[:top]
+        ]
+
+    @classmethod
+    def status(cls) -> dict:
+        tracing = tracemalloc.is_tracing()
+        current, peak = tracemalloc.get_traced_memory() if tracing else (0, 0)
+        return {
+            "tracing": tracing,
+            "frames": tracemalloc.get_traceback_limit() if tracing else None,
+            "tracedBytes": current,
+            "peakBytes": peak,
+            "baselineAge": time.time() - cls._baseline_time if cls._baseline_time else None,
+        }
+
+    @classmethod
+    async def diff(cls, top: int = 30, group_by: str = "lineno", reset: bool = False) -> dict:
+        """和基准快照比较，返回增长最多的分配位置，reset为True时用当前快照作为新的基准"""
+        if not tracemalloc.is_tracing() or cls._baseline is None:
+            raise ValueError("请先开启tracemalloc")
+        baseline = cls._baseline
+        snapshot = await asyncio.to_thread(cls._take_snapshot)
+        result = {
+            **cls.status(),
+            "top": await asyncio.to_thread(cls._compare, snapshot, baseline, group_by, top),
+        }
+        if reset:
+            cls._baseline = snapshot
+            cls._baseline_time = time.time()
+        return result
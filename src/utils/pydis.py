@@ -8,6 +8,7 @@ from typing import Dict, Any, Union, Callable, Optional, Literal, cast
 
 from utils.auth.base import AsyncSession, PasswordError
 from utils.auth.example_session import ExampleSession
+from utils.metrics import REGISTRY
 from utils.ssh import NoFTPAsyncSSH
 from utils.vnc import AsyncVNCClient
 
@@ -16,10 +17,13 @@ SESSION_CLASS = {
     "EXAMPLE": ExampleSession,
 }
 
+POOL_REQUESTS = REGISTRY.counter("pydis_requests_total", "获取连接的次数，miss表示新建了连接", ("kind", "result"))
+
 
 class Pydis:
     _lock = asyncio.Lock()
-    _create_lock = asyncio.Lock()
+    # 每个key一把锁，同一个对象不会重复创建，不同对象可以并发建立连接
+    _create_locks: Dict[str, asyncio.Lock] = dict()
     clear_task = None
 
     _object_map: Dict[str, Any] = dict()
@@ -57,10 +61,13 @@ class Pydis:
 
     @classmethod
     async def create_object(cls, _class: Callable, key: str, *args: Any, **kwargs: Any) -> Any:
-        async with cls._create_lock:
+        lock = cls._create_locks.get(key)
+        if lock is None:
+            lock = cls._create_locks[key] = asyncio.Lock()
+        async with lock:
             if key in cls._object_map:
                 handler = cls._object_map[key]
-                if hasattr(handler, "is_closing") and handler.is_closed:
+                if getattr(handler, "is_closed", False):
                     await handler.close()
                     cls._object_map.pop(key)
                 else:
@@ -90,6 +97,7 @@ class Pydis:
         """
         key = f"{ip}_{user}_{kind.lower()}"
         if key not in cls._object_map:
+            POOL_REQUESTS.inc(kind.lower(), "miss")
             try:
                 handler = await cls.create_object(
                     SESSION_CLASS.get(kind), key, ip, user, password,
@@ -98,6 +106,7 @@ class Pydis:
             except TimeoutError:
                 raise TimeoutError(f"连接{ip}超时，请检查对象是否在线")
         else:
+            POOL_REQUESTS.inc(kind.lower(), "hit")
             handler = cls._object_map[key]
             if handler.password != password and handler.status is True:
                 raise PasswordError(f"{ip}用户名或者密码错误！")
@@ -117,6 +126,7 @@ class Pydis:
     ) -> AsyncVNCClient:
         key = f"{ip}_vnc"
         if key not in cls._object_map or cls._object_map[key].is_closed is True:
+            POOL_REQUESTS.inc("vnc", "miss")
             try:
 
                 handler = await cls.create_object(
@@ -125,6 +135,7 @@ class Pydis:
             except TimeoutError:
                 raise TimeoutError(f"连接{ip}超时，请检查设备是否在线")
         else:
+            POOL_REQUESTS.inc("vnc", "hit")
             handler = cls._object_map[key]
             if handler.password != password:
                 raise PasswordError(f"{ip}VNC密码错误！")
@@ -141,8 +152,9 @@ class Pydis:
             port: int = 22,
             connect_times: int = 600
     ):
-        key = f"{ip}_{user}_ssh"
+        key = f"{ip}_{user}_ssh" if port == 22 else f"{ip}:{port}_{user}_ssh"
         if key not in cls._object_map or cls._object_map[key].is_closed:
+            POOL_REQUESTS.inc("ssh", "miss")
             try:
                 handler = await cls.create_object(
                     NoFTPAsyncSSH, key, ip, user, password, port=port
@@ -150,6 +162,7 @@ class Pydis:
             except TimeoutError:
                 raise TimeoutError(f"连接{ip}超时，请检查对象是否在线")
         else:
+            POOL_REQUESTS.inc("ssh", "hit")
             handler: NoFTPAsyncSSH = cls._object_map[key]
             if handler.password != password:
                 raise PasswordError(f"{ip}用户名或者密码错误！")
@@ -174,3 +187,14 @@ class Pydis:
                 cls._object_stop_map.clear()
                 break
             await asyncio.sleep(300)
+
+
+def _pool_size() -> dict:
+    sizes = dict()
+    for key in list(Pydis._object_map):
+        kind = (key.rsplit("_", 1)[-1],)
+        sizes[kind] = sizes.get(kind, 0) + 1
+    return sizes
+
+
+REGISTRY.gauge("pydis_objects", "连接池中的连接数", _pool_size, ("kind",))
@@ -0,0 +1,109 @@
+from array import array
+from typing import Dict, Hashable, List, Optional, Sequence, Tuple
+
+_NAN = float("nan")
+
+
+class SampleRing:
+    """
+    固定长度的环形缓冲区，每一列是一个array('d')，时间戳单独一列（秒）
+    写满后覆盖最旧的数据，占用内存为 capacity * (列数 + 1) * 8 字节
+    """
+    __slots__ = ("capacity", "columns", "times", "values", "head", "size", "_index")
+
+    def __init__(self, columns: Sequence[str], capacity: int):
+        if capacity <= 0:
+            raise ValueError("capacity必须大于0")
+        self.capacity = capacity
+        self.columns = tuple(columns)
+        self.times = array("d", bytes(8 * capacity))
+        self.values = tuple(array("d", bytes(8 * capacity)) for _ in self.columns)
+        self.head = 0  # 下一个写入的位置
+        self.size = 0
+        self._index = {c: i for i, c in enumerate(self.columns)}
+
+    def __len__(self):
+        return self.size
+
+    def append(self, ts: float, row: Dict[str, Optional[float]]):
+        head = self.head
+        self.times[head] = ts
+        for col, values in zip(self.columns, self.values):
+            value = row.get(col)
+            values[head] = _NAN if value is None else value
+        self.head = (head + 1) % self.capacity
+        if self.size < self.capacity:
+            self.size += 1
+
+    @property
+    def oldest_time(self) -> Optional[float]:
+        if self.size == 0:
+            return None
+        return self.times[(self.head - self.size) % self.capacity]
+
+    def _positions(self, count: int) -> List[int]:
+        """最近count个点在数组中的位置，按时间从旧到新"""
+        count = min(count, self.size)
+        start = self.head - count
+        return [(start + i) % self.capacity for i in range(count)]
+
+    def _rows(self, positions: List[int], columns: Optional[Sequence[str]]) -> List[Tuple[float, Dict[str, Optional[float]]]]:
+        cols = self.columns if columns is None else [c for c in columns if c in self._index]
+        arrays = [(c, self.values[self._index[c]]) for c in cols]
+        rows = []
+        for pos in positions:
+            row = {}
+            for col, values in arrays:
+                value = values[pos]
+                row[col] = None if value != value else value
+            rows.append((self.times[pos], row))
+        return rows
+
+    def last_n(self, n: int, columns: Optional[Sequence[str]] = None):
+        return self._rows(self._positions(n), columns)
+
+    def since(self, ts: float, columns: Optional[Sequence[str]] = None):
+        """时间戳大于等于ts的点，时间是单调递增写入的，二分查找边界即可"""
+        positions = self._positions(self.size)
+        lo, hi = 0, len(positions)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.times[positions[mid]] < ts:
+                lo = mid + 1
+            else:
+                hi = mid
+        return self._rows(positions[lo:], columns)
+
+
+class RingBufferStore:
+    """
+    按key（比如timedTaskID）管理多个SampleRing
+    每个key的内存上限由capacity决定，max_keys限制key的数量，超出时丢弃最早创建的
+    """
+
+    def __init__(self, columns: Sequence[str], capacity: int, max_keys: int = 10000):
+        self.columns = tuple(columns)
+        self.capacity = capacity
+        self.max_keys = max_keys
+        self._rings: Dict[Hashable, SampleRing] = dict()
+
+    def append(self, key: Hashable, ts: float, row: Dict[str, Optional[float]]):
+        ring = self._rings.get(key)
+        if ring is None:
+            if len(self._rings) >= self.max_keys:
+                self._rings.pop(next(iter(self._rings)))
+            ring = self._rings[key] = SampleRing(self.columns, self.capacity)
+        ring.append(ts, row)
+
+    def get(self, key: Hashable) -> Optional[SampleRing]:
+        return self._rings.get(key)
+
+    def drop(self, key: Hashable):
+        self._rings.pop(key, None)
+
+    def stats(self) -> dict:
+        return {
+            "keys": len(self._rings),
+            "capacity": self.capacity,
+            "bytesPerKey": self.capacity * (len(self.columns) + 1) * 8,
+        }
@@ -1,6 +1,8 @@
 import asyncio
 import functools
-from typing import Optional, Literal, Callable, cast
+import time
+import traceback
+from typing import Optional, Literal, Callable, Awaitable, List, cast
 from datetime import datetime, timedelta, UTC
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
@@ -9,14 +11,25 @@ from apscheduler.events import JobEvent, JobSubmissionEvent, JobExecutionEvent,
     EVENT_JOB_MODIFIED, EVENT_JOB_ERROR, EVENT_JOB_MISSED, EVENT_JOB_MAX_INSTANCES, EVENT_JOB_REMOVED, \
     EVENT_JOB_SUBMITTED, EVENT_JOB_EXECUTED, EVENT_JOB_ADDED
 from motor.core import AgnosticCollection
+from pymongo.errors import OperationFailure, DuplicateKeyError
+from utils.metrics import REGISTRY
 from utils.mongo_client import AsyncMongoClient
+from utils.monitor import SchedulerMonitor
 
 SCHEDULER_KIND = Literal["unasync", "async"]
 
+# change stream相关的错误码：不是副本集、resume token已经不在oplog中、resume token无效
+_CHANGE_STREAM_UNSUPPORTED = (40573,)
+_CHANGE_STREAM_HISTORY_LOST = (286, 280, 260)
+
 
 class DistributedLockAcquireError(Exception):
     ...
 
+JOB_LOCK_ACQUIRE = REGISTRY.counter(
+    "job_lock_acquire_total", "获取分布式锁的次数，contended表示锁已被其他进程持有", ("result",)
+)
+
 
 class _DistributedLockByMongodb:
 
@@ -31,9 +44,11 @@ class _DistributedLockByMongodb:
             doc["ttl_time"] = self.ttl
         try:
             await self.job_lock_db.insert_one(doc)
-        except Exception:
+        except Exception as e:
+            JOB_LOCK_ACQUIRE.inc("contended" if isinstance(e, DuplicateKeyError) else "error")
             print(self.key, f" failed! {datetime.now()}")
             raise DistributedLockAcquireError("获取锁失败！")
+        JOB_LOCK_ACQUIRE.inc("acquired")
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
@@ -76,6 +91,7 @@ def job_lock(
 class Scheduler(object):
     async_scheduler: AsyncIOScheduler = None
     event_dispatch_dict = dict()
+    watch_tasks: List[asyncio.Task] = list()
 
     @classmethod
     def init(cls, kind: SCHEDULER_KIND, scheduler: BaseScheduler):
@@ -98,17 +114,115 @@ class Scheduler(object):
     def start(cls):
         Scheduler.async_scheduler.start()
 
+    @classmethod
+    def shutdown(cls):
+        for task in cls.watch_tasks:
+            task.cancel()
+        cls.watch_tasks.clear()
+        if cls.is_running():
+            Scheduler.async_scheduler.shutdown(wait=False)
+
+    @classmethod
+    def watch(
+            cls,
+            collect_name: str,
+            on_change: Callable[[dict], None],
+            resync: Callable[[Optional[datetime]], Awaitable],
+            pipeline: Optional[list] = None,
+            token_key: Optional[str] = None,
+            poll_interval: float = 10,
+    ):
+        """
+        通过change stream监听保存任务定义的集合，把其他worker、进程的修改同步到本进程的调度器
+        resume token保存在scheduler_resume_token集合中，重启或者断线后从上次的位置继续
+        没有token（第一次启动、token失效）时先打开change stream再全量同步，同步期间的修改留在stream里，不会丢失
+        :param collect_name: 集合名称
+        :param on_change: 处理一条变化
+        :param resync: resync(None)全量同步；resync(since)同步since之后修改过的，token失效或者不支持change stream时使用
+        :param pipeline: change stream的过滤条件
+        :param token_key: 保存resume token的key，默认为集合名称
+        :param poll_interval: 不支持change stream时定时同步的间隔
+        """
+        task = asyncio.get_running_loop().create_task(cls._watch(
+            collect_name, on_change, resync, pipeline or [], token_key or collect_name, poll_interval
+        ))
+        cls.watch_tasks.append(task)
+        return task
+
+    @classmethod
+    async def _watch(cls, collect_name, on_change, resync, pipeline, token_key, poll_interval):
+        collect = cast(AgnosticCollection, AsyncMongoClient[collect_name])
+        token_collect = cast(AgnosticCollection, AsyncMongoClient["scheduler_resume_token"])
+        token_doc = await token_collect.find_one({"_id": token_key})
+        resume_token = token_doc["token"] if token_doc is not None else None
+        while True:
+            try:
+                async with collect.watch(pipeline, full_document="updateLookup", resume_after=resume_token) as stream:
+                    if resume_token is None:
+                        # 之前的全量加载和打开stream之间的修改只能通过再全量同步一次补上
+                        await resync(None)
+                        resume_token = stream.resume_token
+                        if resume_token is not None:
+                            await token_collect.update_one(
+                                {"_id": token_key}, {"$set": {"token": resume_token}}, upsert=True
+                            )
+                    last_saved = time.monotonic()
+                    async for change in stream:
+                        try:
+                            on_change(change)
+                        except Exception:
+                            print(traceback.format_exc())
+                        resume_token = stream.resume_token
+                        # 每次变化都写token没有必要，最多每秒一次
+                        if time.monotonic() - last_saved > 1:
+                            await token_collect.update_one(
+                                {"_id": token_key}, {"$set": {"token": resume_token}}, upsert=True
+                            )
+                            last_saved = time.monotonic()
+            except asyncio.CancelledError:
+                if resume_token is not None:
+                    await token_collect.update_one(
+                        {"_id": token_key}, {"$set": {"token": resume_token}}, upsert=True
+                    )
+                raise
+            except OperationFailure as e:
+                if e.code in _CHANGE_STREAM_HISTORY_LOST:
+                    print(f"{collect_name} resume token已失效，重新打开后全量同步：{e}")
+                    resume_token = None
+                elif e.code in _CHANGE_STREAM_UNSUPPORTED:
+                    print(f"{collect_name} 不支持change stream，改为定时同步：{e}")
+                    last_sync = datetime.now()
+                    while True:
+                        await asyncio.sleep(poll_interval)
+                        now = datetime.now()
+                        try:
+                            await resync(last_sync)
+                            last_sync = now
+                        except Exception:
+                            print(traceback.format_exc())
+                else:
+                    print(traceback.format_exc())
+                    await asyncio.sleep(5)
+            except Exception:
+                print(traceback.format_exc())
+                await asyncio.sleep(5)
+
+    @staticmethod
+    def is_running() -> bool:
+        return Scheduler.async_scheduler is not None and Scheduler.async_scheduler.running
+
     @staticmethod
     def add_job(func, tigger=None, _id: Optional[str] = None, job_store="default", executor="default", **kw):
-        """增加任务会先查询是否存在任务，有的话会直接删除"""
-        old_job = Scheduler.get_job(_id)
-        if old_job is not None:
-            old_job.remove()
+        """
+        已经存在同id的任务时原地替换，不会先删除，
+        否则会触发EVENT_JOB_REMOVED，被当成任务执行结束
+        """
         scheduler = Scheduler.async_scheduler
         return scheduler.add_job(
             func, tigger, id=_id,
             jobstore=job_store,
             executor=executor,
+            replace_existing=True,
             **kw
         )
 
@@ -116,6 +230,10 @@ class Scheduler(object):
     def get_job(_id: str):
         return Scheduler.async_scheduler.get_job(_id)
 
+    @staticmethod
+    def get_jobs():
+        return Scheduler.async_scheduler.get_jobs()
+
     @staticmethod
     def is_job_exist(_id: str):
         return Scheduler.get_job(_id) is not None
@@ -155,6 +273,7 @@ class Scheduler(object):
 
     @classmethod
     def listener_all_job(cls, event: JobEvent | JobSubmissionEvent | JobExecutionEvent):
+        SchedulerMonitor.record(event)
         _event_loop = Scheduler.async_scheduler.__getattribute__("_eventloop")
         job_id = None
         if event.code != EVENT_ALL_JOBS_REMOVED:
@@ -169,3 +288,9 @@ class Scheduler(object):
                     event.code, job_id, trace_back=trace_back, exc=_exception,
                 ))
                 break
+
+
+REGISTRY.gauge(
+    "scheduler_jobs", "调度器中的任务数",
+    lambda: len(Scheduler.async_scheduler.get_jobs()) if Scheduler.is_running() else 0
+)
@@ -0,0 +1,57 @@
+import math
+from typing import Dict, Iterable, Optional
+
+ZERO_KEY = "z"
+
+
+class DDSketch:
+    """
+    相对误差的分位数草图（DDSketch），值按对数分桶计数，桶之间直接相加就能合并
+    桶的key是字符串，可以直接作为mongodb的字段名用$inc累加
+    只处理非负数，小于min_value的值都放进ZERO_KEY桶
+    """
+
+    def __init__(self, relative_accuracy: float = 0.01, min_value: float = 1e-9):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.min_value = min_value
+        self.bins: Dict[str, int] = dict()
+        self.count = 0
+
+    def key(self, value: float) -> str:
+        if value < self.min_value:
+            return ZERO_KEY
+        return str(math.ceil(math.log(value) / self._log_gamma))
+
+    def add(self, value: float, count: int = 1):
+        key = self.key(value)
+        self.bins[key] = self.bins.get(key, 0) + count
+        self.count += count
+
+    def merge_bins(self, bins: Dict[str, int]):
+        for key, count in bins.items():
+            self.bins[key] = self.bins.get(key, 0) + count
+            self.count += count
+
+    def _value(self, key: str) -> float:
+        if key == ZERO_KEY:
+            return 0.0
+        return 2 * self.gamma ** int(key) / (self.gamma + 1)
+
+    def quantiles(self, qs: Iterable[float]) -> list:
+        if self.count == 0:
+            return [None for _ in qs]
+        ordered = sorted(self.bins.items(), key=lambda x: -math.inf if x[0] == ZERO_KEY else int(x[0]))
+        result = []
+        for q in qs:
+            rank = q * (self.count - 1)
+            cumulative = 0
+            value: Optional[float] = None
+            for key, count in ordered:
+                cumulative += count
+                if cumulative > rank:
+                    value = self._value(key)
+                    break
+            result.append(value)
+        return result
@@ -0,0 +1,168 @@
+"""
+mongodb慢查询记录：通过pymongo的CommandListener给每个命令计时，超过阈值时记录命令的结构（值已脱敏），
+并按采样率执行一次explain("executionStats")，结果放在内存里的环形缓冲区中
+"""
+import asyncio
+import random
+import threading
+import traceback
+from collections import deque
+from datetime import datetime
+from typing import Any, Dict, Optional, Tuple
+
+from pymongo import monitoring
+
+from config import Config
+from utils.metrics import REGISTRY
+
+SLOW_QUERIES = REGISTRY.counter("mongo_slow_queries_total", "超过阈值的mongodb命令数", ("command",))
+
+# 只关心这些命令，其他命令（hello、getMore、endSessions等）不记录
+PROFILED_COMMANDS = frozenset(("find", "aggregate", "count", "distinct", "update", "delete", "findAndModify"))
+EXPLAINABLE_COMMANDS = frozenset(("find", "aggregate", "count", "distinct"))
+# 这些字段是驱动加上的会话、集群信息，explain时不能带上
+_DRIVER_FIELDS = frozenset(("lsid", "txnNumber", "autocommit", "startTransaction", "cursor"))
+_MAX_SHAPE_ITEMS = 3
+
+
+def query_shape(value: Any) -> Any:
+    """
+    保留字段名和操作符，把值替换成类型名，长数组只保留前几个元素的结构，避免记录到敏感数据
+    """
+    if isinstance(value, dict):
+        return {key: query_shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        shape = [query_shape(item) for item in value[:_MAX_SHAPE_ITEMS]]
+        if len(value) > _MAX_SHAPE_ITEMS:
+            shape.append(f"...共{len(value)}项")
+        return shape
+    if value is None or isinstance(value, bool):
+        return value
+    return f"<{type(value).__name__}>"
+
+
+def _find_key(data: Any, key: str) -> list:
+    """explain的结果在分片、聚合时嵌套的位置不一样，直接递归找"""
+    found = []
+    if isinstance(data, dict):
+        for k, v in data.items():
+            if k == key:
+                found.append(v)
+            else:
+                found.extend(_find_key(v, key))
+    elif isinstance(data, list):
+        for item in data:
+            found.extend(_find_key(item, key))
+    return found
+
+
+def summarize_explain(explain: dict) -> dict:
+    stats = _find_key(explain, "executionStats")
+    plans = _find_key(explain, "winningPlan")
+    indexes = sorted(set(_find_key(plans, "indexName")))
+    stages = set(_find_key(plans, "stage"))
+    return {
+        "nReturned": sum(s.get("nReturned", 0) for s in stats),
+        "totalDocsExamined": sum(s.get("totalDocsExamined", 0) for s in stats),
+        "totalKeysExamined": sum(s.get("totalKeysExamined", 0) for s in stats),
+        "executionTimeMillis": max((s.get("executionTimeMillis", 0) for s in stats), default=None),
+        "indexes": indexes,
+        "collectionScan": "COLLSCAN" in stages,
+    }
+
+
+class SlowQueryProfiler(monitoring.CommandListener):
+    """
+    started里只保存需要关注的命令，succeeded/failed里判断耗时，没超过阈值时只有一次dict的pop
+    pymongo在执行命令的线程里回调，explain需要通过call_soon_threadsafe交给事件循环执行
+    """
+    threshold: float = Config.SLOW_QUERY_THRESHOLD
+    explain_sample_rate: float = Config.SLOW_QUERY_EXPLAIN_RATE
+    records: deque = deque(maxlen=Config.SLOW_QUERY_RECORDS)
+
+    _client = None
+    _loop: Optional[asyncio.AbstractEventLoop] = None
+    _commands: Dict[Tuple[int, Any], dict] = dict()
+    _lock = threading.Lock()
+
+    @classmethod
+    def bind(cls, client, loop: asyncio.AbstractEventLoop):
+        cls._client = client
+        cls._loop = loop
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        if event.command_name in PROFILED_COMMANDS:
+            self._commands[(event.request_id, event.connection_id)] = event.command
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        self._finish(event, None)
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        self._finish(event, str(event.failure.get("errmsg", event.failure)))
+
+    def _finish(self, event, error: Optional[str]):
+        command = self._commands.pop((event.request_id, event.connection_id), None)
+        if command is None:
+            return
+        duration = event.duration_micros / 1e6
+        if duration < self.threshold:
+            return
+        SLOW_QUERIES.inc(event.command_name)
+        record = {
+            "time": datetime.now(),
+            "database": event.database_name,
+            "collection": command.get(event.command_name),
+            "command": event.command_name,
+            "durationMs": round(duration * 1000, 3),
+            "error": error,
+            "shape": query_shape({
+                k: v for k, v in command.items()
+                if k != event.command_name and not k.startswith("$") and k not in _DRIVER_FIELDS
+            }),
+            "explain": None,
+        }
+        with self._lock:
+            self.records.append(record)
+        if error is None and self._should_explain(event.command_name, command):
+            loop = self._loop
+            if loop is not None and not loop.is_closed():
+                loop.call_soon_threadsafe(loop.create_task, self._explain(record, event.database_name, command))
+
+    def _should_explain(self, command_name: str, command: dict) -> bool:
+        if command_name not in EXPLAINABLE_COMMANDS or self._client is None:
+            return False
+        if command_name == "aggregate":
+            # 带$out/$merge的聚合explain executionStats时会有写入的限制，不做explain
+            for stage in command.get("pipeline", []):
+                if "$out" in stage or "$merge" in stage:
+                    return False
+        return random.random() < self.explain_sample_rate
+
+    @classmethod
+    async def _explain(cls, record: dict, database: str, command: dict):
+        explain_command = {
+            k: v for k, v in command.items() if not k.startswith("$") and k not in _DRIVER_FIELDS
+        }
+        if "pipeline" in explain_command:
+            explain_command["cursor"] = {}
+        try:
+            result = await cls._client[database].command(
+                {"explain": explain_command, "verbosity": "executionStats"}
+            )
+            record["explain"] = summarize_explain(result)
+        except Exception:
+            record["explain"] = {"error": traceback.format_exc(limit=1)}
+
+    @classmethod
+    def snapshot(cls, limit: int = 50, collection: Optional[str] = None) -> list:
+        with cls._lock:
+            records = list(cls.records)
+        if collection is not None:
+            records = [r for r in records if r["collection"] == collection]
+        records.sort(key=lambda r: r["durationMs"], reverse=True)
+        return records[:limit]
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls.records.clear()
@@ -0,0 +1,288 @@
+"""
+本地磁盘的只追加队列，mongodb不可用时暂存待写入的文档，恢复后按写入顺序读出来回放
+目录下是编号递增的段文件，每条记录为 4字节长度 + BSON + 4字节crc32（小端），写到一半的记录在读取时丢弃
+总大小超过max_bytes时删除最旧的段文件
+多个进程使用同一个目录时，每个进程用文件锁占住其中一个槽位（slot_0、slot_1...），
+打开时把其他没有进程占用、还有数据的槽位里的段文件移到自己的槽位，重启后会接手所有遗留的数据
+append、read、commit会做磁盘io，调用方放到线程里执行，修改状态时加锁；size、stats不加锁，不会阻塞事件循环
+"""
+import os
+import struct
+import threading
+import zlib
+from typing import List, Optional, Tuple
+
+import bson
+
+from utils.metrics import REGISTRY
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+_HEADER = struct.Struct("<I")
+_SEGMENT_SUFFIX = ".seg"
+
+# 读取位置：(段编号, 段内偏移)
+SpoolPosition = Tuple[int, int]
+
+
+class DiskSpool:
+    instances: List["DiskSpool"] = list()
+
+    def __init__(
+            self,
+            directory: str,
+            name: str,
+            max_bytes: int = 512 * 1024 * 1024,
+            segment_bytes: int = 4 * 1024 * 1024,
+            fsync: bool = True
+    ):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self._lock = threading.RLock()
+        self.directory = self._lock_slot(directory)
+        self._adopt_orphans(directory)
+        self._segments: List[int] = sorted(
+            int(file[:-len(_SEGMENT_SUFFIX)]) for file in os.listdir(self.directory) if file.endswith(_SEGMENT_SUFFIX)
+        )
+        self._sizes = {segment: os.path.getsize(self._path(segment)) for segment in self._segments}
+        self._bytes = sum(self._sizes.values())
+        self._read_position: SpoolPosition = (self._segments[0], 0) if self._segments else (0, 0)
+        # 上次退出时最后一个段的末尾可能是写了一半的记录，重新打开后写到新的段
+        self._sealed = True
+        self.appended = 0
+        self.replayed = 0
+        self.dropped = 0
+        self.corrupted = 0
+        DiskSpool.instances.append(self)
+
+    def _lock_slot(self, directory: str) -> str:
+        slot = 0
+        while True:
+            path = os.path.join(directory, f"slot_{slot}")
+            os.makedirs(path, exist_ok=True)
+            if fcntl is None:
+                return path
+            lock_file = open(os.path.join(path, "lock"), "w")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                slot += 1
+                continue
+            # 文件对象需要一直持有，进程退出时锁自动释放
+            self._lock_file = lock_file
+            return path
+
+    def _adopt_orphans(self, directory: str):
+        """其他槽位能加锁说明占用它的进程已经退出，把它的段文件按顺序改名到自己的槽位末尾"""
+        if fcntl is None:
+            return
+        own = os.path.basename(self.directory)
+        last = max(
+            (int(file[:-len(_SEGMENT_SUFFIX)]) for file in os.listdir(self.directory) if file.endswith(_SEGMENT_SUFFIX)),
+            default=0
+        )
+        for slot in sorted(os.listdir(directory)):
+            path = os.path.join(directory, slot)
+            if slot == own or not slot.startswith("slot_") or not os.path.isdir(path):
+                continue
+            with open(os.path.join(path, "lock"), "w") as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue
+                files = sorted(file for file in os.listdir(path) if file.endswith(_SEGMENT_SUFFIX))
+                for file in files:
+                    last += 1
+                    os.rename(os.path.join(path, file), self._path(last))
+                if files:
+                    print(f"{self.name}接手{path}遗留的{len(files)}个段文件")
+
+    def _path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"{segment:012d}{_SEGMENT_SUFFIX}")
+
+    @property
+    def size(self) -> int:
+        return self._bytes
+
+    def has_data(self) -> bool:
+        with self._lock:
+            if not self._segments:
+                return False
+            segment, offset = self._read_position
+            return segment != self._segments[-1] or offset < self._sizes[segment]
+
+    def append(self, documents: List[dict]):
+        if not documents:
+            return
+        with self._lock:
+            self._append(documents)
+
+    def _append(self, documents: List[dict]):
+        chunks = []
+        for document in documents:
+            data = bson.encode(document)
+            chunks.append(_HEADER.pack(len(data)))
+            chunks.append(data)
+            chunks.append(_HEADER.pack(zlib.crc32(data)))
+        payload = b"".join(chunks)
+        if not self._segments or self._sealed or self._sizes[self._segments[-1]] >= self.segment_bytes:
+            self._sealed = False
+            segment = self._segments[-1] + 1 if self._segments else 1
+            self._segments.append(segment)
+            self._sizes[segment] = 0
+            if len(self._segments) == 1:
+                self._read_position = (segment, 0)
+        segment = self._segments[-1]
+        try:
+            with open(self._path(segment), "ab") as f:
+                f.write(payload)
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+        except Exception:
+            self._discard_torn(segment)
+            raise
+        self._sizes[segment] += len(payload)
+        self._bytes += len(payload)
+        self.appended += len(documents)
+        self._enforce_limit()
+
+    def _discard_torn(self, segment: int):
+        """
+        写到一半失败（例如磁盘满）时把段文件截断回写入前的大小，截断也失败时封住这个段，
+        后面的数据写到新的段，不会接在残缺的记录后面导致读取时被整段丢弃
+        """
+        self._sealed = True
+        try:
+            if self._sizes[segment] == 0:
+                self._segments.remove(segment)
+                del self._sizes[segment]
+                if os.path.exists(self._path(segment)):
+                    os.remove(self._path(segment))
+                if not self._segments:
+                    self._read_position = (0, 0)
+            else:
+                os.truncate(self._path(segment), self._sizes[segment])
+        except OSError:
+            print(f"{self.name}截断段文件{segment}失败")
+
+    def _enforce_limit(self):
+        """超过总大小时从最旧的段开始删除，至少保留正在写的段"""
+        while self.size > self.max_bytes and len(self._segments) > 1:
+            segment = self._segments[0]
+            offset = self._read_position[1] if self._read_position[0] == segment else 0
+            self.dropped += self._count_records(segment, offset)
+            self._remove_segment(segment)
+            if self._read_position[0] <= segment:
+                self._read_position = (self._segments[0], 0)
+
+    def _count_records(self, segment: int, offset: int) -> int:
+        documents, _ = self._read_segment(segment, offset, None)
+        return len(documents)
+
+    def _read_segment(self, segment: int, offset: int, limit: Optional[int]) -> Tuple[List[dict], int]:
+        documents = []
+        with open(self._path(segment), "rb") as f:
+            f.seek(offset)
+            while limit is None or len(documents) < limit:
+                header = f.read(_HEADER.size)
+                if len(header) < _HEADER.size:
+                    break
+                (length,) = _HEADER.unpack(header)
+                data = f.read(length)
+                crc = f.read(_HEADER.size)
+                if len(data) < length or len(crc) < _HEADER.size or _HEADER.unpack(crc)[0] != zlib.crc32(data):
+                    # 写到一半的记录（进程崩溃）或者损坏，段内后面的数据都不要了
+                    self.corrupted += 1
+                    return documents, self._sizes[segment]
+                documents.append(bson.decode(data))
+                offset += _HEADER.size * 2 + length
+        return documents, offset
+
+    def read(self, limit: int) -> Tuple[List[dict], SpoolPosition]:
+        """从读取位置开始最多读limit条，确认写入后调用commit推进位置"""
+        with self._lock:
+            return self._read(limit)
+
+    def _read(self, limit: int) -> Tuple[List[dict], SpoolPosition]:
+        segment, offset = self._read_position
+        while self._segments:
+            if offset < self._sizes[segment]:
+                documents, offset = self._read_segment(segment, offset, limit)
+                if documents:
+                    return documents, (segment, offset)
+            if segment == self._segments[-1]:
+                break
+            # 这个段已经读完，删掉后接着读下一个
+            self._remove_segment(segment)
+            segment, offset = self._segments[0], 0
+            self._read_position = (segment, offset)
+        return [], (segment, offset)
+
+    def commit(self, position: SpoolPosition, count: int):
+        with self._lock:
+            self._commit(position, count)
+
+    def requeue(self, position: SpoolPosition, count: int, documents: List[dict]):
+        """
+        一批数据只有部分写入成功时，先把失败的documents追加到末尾，再把读取位置推进到这一批之后
+        :param count: 写入成功的条数
+        """
+        with self._lock:
+            self._append(documents)
+            self._commit(position, count)
+
+    def _commit(self, position: SpoolPosition, count: int):
+        segment, offset = position
+        self.replayed += count
+        if segment not in self._sizes:
+            # 超过总大小时已经被删掉了
+            return
+        self._read_position = position
+        if offset >= self._sizes.get(segment, 0) and segment != self._segments[-1]:
+            self._remove_segment(segment)
+            self._read_position = (self._segments[0], 0)
+        elif offset >= self._sizes.get(segment, 0) and len(self._segments) == 1:
+            # 全部回放完，清空文件，下次从新的段开始写
+            self._remove_segment(segment)
+            self._read_position = (0, 0)
+
+    def _remove_segment(self, segment: int):
+        self._segments.remove(segment)
+        self._bytes -= self._sizes.pop(segment)
+        os.remove(self._path(segment))
+
+    def stats(self) -> dict:
+        return {
+            "directory": self.directory,
+            "segments": len(self._segments),
+            "bytes": self.size,
+            "appended": self.appended,
+            "replayed": self.replayed,
+            "dropped": self.dropped,
+            "corrupted": self.corrupted,
+        }
+
+
+REGISTRY.gauge(
+    "spool_bytes", "磁盘暂存占用的字节数",
+    lambda: {(s.name,): s.size for s in DiskSpool.instances}, ("name",)
+)
+REGISTRY.func_counter(
+    "spool_appended_total", "写入磁盘暂存的文档数",
+    lambda: {(s.name,): s.appended for s in DiskSpool.instances}, ("name",)
+)
+REGISTRY.func_counter(
+    "spool_replayed_total", "从磁盘暂存回放到mongodb的文档数",
+    lambda: {(s.name,): s.replayed for s in DiskSpool.instances}, ("name",)
+)
+REGISTRY.func_counter(
+    "spool_dropped_total", "超过磁盘占用上限时丢弃的文档数",
+    lambda: {(s.name,): s.dropped for s in DiskSpool.instances}, ("name",)
+)
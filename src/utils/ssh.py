@@ -1,6 +1,7 @@
 import asyncio
 import re
 import sys
+import time
 from asyncio import wait_for
 from typing import Optional, Tuple
 
@@ -8,6 +9,11 @@ import asyncssh
 from asyncssh import SSHClientConnection, SSHClient, SSHClientSession, SSHClientChannel, SSHKey, \
     SSHClientConnectionOptions
 
+from utils.metrics import REGISTRY
+
+SSH_CONNECT_DURATION = REGISTRY.histogram("ssh_connect_duration_seconds", "ssh建立连接耗时", ("result",))
+SSH_COMMAND_DURATION = REGISTRY.histogram("ssh_command_duration_seconds", "ssh执行命令耗时", ("result",))
+
 
 class SSHUserOrPasswordError(Exception):
     ...
@@ -38,7 +44,7 @@ class NoFTPSSHClientSession(SSHClientSession):
         self._response = value
 
     def clear(self):
-        self.response = None
+        self._response = None
         self.received_data = ""
 
     def data_received(self, data: str, datatype: asyncssh.DataType) -> None:
@@ -47,7 +53,6 @@ class NoFTPSSHClientSession(SSHClientSession):
         if self.response is not None and self.expect_end_flag is not None:
             if self.received_data.endswith(self.expect_end_flag):
                 self.response.set_result(self.received_data)
-                del self._response
                 self.clear()
 
     def connection_lost(self, exc) -> None:
@@ -82,12 +87,15 @@ class NoFTPAsyncSSH:
         self.chan: Optional[SSHClientChannel] = None
         self.conn: Optional[SSHClientConnection] = None
 
+    @property
     def is_closed(self) -> bool:
         if self.chan is None:
             return True
         return self.chan.is_closing() or self.session.is_lost
 
     async def set_connection(self):
+        start = time.perf_counter()
+        result = "error"
         try:
             conn, _ = await asyncssh.create_connection(
                 NoFTPSSHClient,
@@ -98,8 +106,15 @@ class NoFTPAsyncSSH:
                 options=SSHClientConnectionOptions(connect_timeout=3)
             )
             self.conn = conn
+            result = "ok"
         except asyncssh.misc.PermissionDenied:
+            result = "auth_failed"
             raise SSHUserOrPasswordError("用户名或者密码错误！")
+        except (asyncio.TimeoutError, TimeoutError):
+            result = "timeout"
+            raise
+        finally:
+            SSH_CONNECT_DURATION.observe(time.perf_counter() - start, result)
 
     async def set_session(self):
         """
@@ -118,15 +133,22 @@ class NoFTPAsyncSSH:
 
     async def set_end_content(self, content: Optional[str] = None):
         if content is None:
-            if self.chan is None or self.is_closed():
+            if self.chan is None or self.is_closed:
                 raise Exception("连接已经关闭了！")
+            # 发送一个空行，等输出稳定之后最后一行就是提示符
+            # 这里不能write_eof，对端的shell收到EOF之后会退出
             self.chan.write("\n")
-            self.chan.write_eof()
+            content = ""
             while True:
-                content = self.session.received_data
-                if content != "":
-                    break
                 await asyncio.sleep(0.1)
+                if self.is_closed:
+                    raise SSHClientLostError("ssh连接断开")
+                received = self.session.received_data
+                if received != "" and received == content:
+                    break
+                content = received
+            content = content.rsplit("\n", 1)[-1]
+            self.session.received_data = ""
         self.session.expect_end_flag = content
 
     async def close(self):
@@ -148,6 +170,7 @@ class NoFTPAsyncSSH:
         except Exception:
             await self.__aexit__(None, None, None)
             raise
+        return self
 
     async def send_and_recv(
         self,
@@ -181,13 +204,17 @@ class NoFTPAsyncSSH:
         self.chan.write(command)
         fut = asyncio.Future()
         self.session.response = fut
+        start = time.perf_counter()
         try:
             res = await wait_for(fut, timeout)
         except asyncio.TimeoutError:
             if self.session.is_lost:
+                SSH_COMMAND_DURATION.observe(time.perf_counter() - start, "lost")
                 raise SSHClientLostError("ssh连接断开")
             else:
+                SSH_COMMAND_DURATION.observe(time.perf_counter() - start, "timeout")
                 raise
+        SSH_COMMAND_DURATION.observe(time.perf_counter() - start, "ok")
         # res需要去除颜色，和一些异常信息
         res_without_color = re.sub("\\x1b\[[\d;]*m", "", res)
         rec = res_without_color.strip().split("\r\n")
@@ -0,0 +1,153 @@
+"""
+请求耗时分段：中间件为每个请求创建一个Trace放进contextvar，接口里用span记录各阶段耗时
+- validation：收到请求到进入接口函数，包括读取body和pydantic校验
+- handler：接口函数本身，其中的span单独列出
+- encode：接口函数返回到开始发送响应，即FastAPI序列化和json编码
+结果写在Server-Timing响应头里，按采样率（以及所有慢请求）写入mongodb
+"""
+import functools
+import random
+import time
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from fastapi.routing import APIRoute
+from starlette.types import ASGIApp, Receive, Scope, Send, Message
+
+from config import Config
+from utils.batch_writer import BatchWriter
+
+TRACE_COLLECT = "request_trace_collect"
+
+trace_writer = BatchWriter(TRACE_COLLECT, max_batch=200, flush_interval=5, max_pending=10000)
+
+_current_trace: ContextVar[Optional["Trace"]] = ContextVar("current_trace", default=None)
+
+
+class Trace:
+    __slots__ = ("start", "handler_start", "handler_end", "response_start", "spans")
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.handler_start: Optional[float] = None
+        self.handler_end: Optional[float] = None
+        self.response_start: Optional[float] = None
+        # 名称 -> [耗时, 次数]，同名的span累加
+        self.spans: Dict[str, List[float]] = dict()
+
+    def add_span(self, name: str, duration: float):
+        span_data = self.spans.get(name)
+        if span_data is None:
+            self.spans[name] = [duration, 1]
+        else:
+            span_data[0] += duration
+            span_data[1] += 1
+
+    def stages(self) -> Dict[str, float]:
+        """各阶段耗时（毫秒）"""
+        end = self.response_start or time.perf_counter()
+        result = dict()
+        if self.handler_start is not None:
+            result["validation"] = (self.handler_start - self.start) * 1000
+            if self.handler_end is not None:
+                result["handler"] = (self.handler_end - self.handler_start) * 1000
+                result["encode"] = (end - self.handler_end) * 1000
+        for name, (duration, _) in self.spans.items():
+            result[name] = duration * 1000
+        result["total"] = (end - self.start) * 1000
+        return result
+
+
+class span:
+    """
+    with span("aggregate"):
+        ...
+    不在请求里时几乎没有开销
+    """
+    __slots__ = ("name", "trace", "start")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.trace = _current_trace.get()
+
+    def __enter__(self):
+        if self.trace is not None:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.trace is not None:
+            self.trace.add_span(self.name, time.perf_counter() - self.start)
+
+
+class TracedRoute(APIRoute):
+    """记录接口函数开始和结束的时间，用来区分校验、接口本身和响应编码的耗时"""
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        # include_router会用同一个endpoint再创建一次路由，已经包装过的不再包装
+        if getattr(endpoint, "__traced__", False):
+            super().__init__(path, endpoint, **kwargs)
+            return
+        original = endpoint
+
+        @functools.wraps(original)
+        async def traced_endpoint(*args, **kw):
+            trace = _current_trace.get()
+            if trace is None:
+                return await original(*args, **kw)
+            trace.handler_start = time.perf_counter()
+            try:
+                return await original(*args, **kw)
+            finally:
+                trace.handler_end = time.perf_counter()
+
+        traced_endpoint.__traced__ = True
+        super().__init__(path, traced_endpoint, **kwargs)
+
+
+def server_timing(stages: Dict[str, float]) -> str:
+    return ", ".join(f"{name};dur={duration:.3f}" for name, duration in stages.items())
+
+
+class TracingMiddleware:
+    sample_rate: float = Config.TRACE_SAMPLE_RATE
+    slow_threshold: float = Config.TRACE_SLOW_THRESHOLD
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        trace = Trace()
+        token = _current_trace.set(trace)
+        status = 500
+
+        async def send_wrapper(message: Message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                trace.response_start = time.perf_counter()
+                status = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", server_timing(trace.stages()).encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current_trace.reset(token)
+            stages = trace.stages()
+            if stages["total"] >= self.slow_threshold * 1000 or random.random() < self.sample_rate:
+                route = scope.get("route")
+                trace_writer.add({
+                    "time": datetime.now(),
+                    "method": scope["method"],
+                    "route": getattr(route, "path", None),
+                    "path": scope["path"],
+                    "status": status,
+                    "stages": stages,
+                    "spanCounts": {name: int(count) for name, (_, count) in trace.spans.items()},
+                })